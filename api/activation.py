@@ -0,0 +1,104 @@
+"""
+模板按需激活：``AGENTS_LAZY_ACTIVATION=1`` 时，模板登记后不立即实例化，第一次用到才激活。
+
+``activate_template`` 会实例化 Agent 类：拼 system prompt、收集内置工具、起连通性测试线程。
+启动时逐个激活，启动耗时和内存随 ``agent_template_pool`` 里的模板数增长，没人调用的 Agent 也一样。
+
+惰性模式下：
+
+- ``GET /agents`` 除了已激活的实例，还按 ``agent_template_pool`` 的元数据列出未激活的模板
+  （``active: false``），不实例化
+- ``get_agent_or_404`` / ``ask_for_help`` 找不到实例时按名字或 uuid 找模板，当场激活；
+  async 路由用 ``aget_agent_or_404``，激活放到线程池里跑
+- 同一个模板的并发首次请求走 single-flight：按模板名一把锁，先到的激活，其余等它完成后直接用同一个实例；
+  激活失败不缓存，下一个请求重试
+
+配置脚本（如 ``examples/api/agents_config.py``）在惰性模式下应跳过 import 时的 ``activate_template``，
+见 ``lazy_activation_enabled``。
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+
+def lazy_activation_enabled() -> bool:
+    """是否开启惰性激活（``AGENTS_LAZY_ACTIVATION``，默认关）"""
+    return os.getenv("AGENTS_LAZY_ACTIVATION", "0").lower() in ("1", "true", "yes")
+
+
+def _effective_uuid(tpl: Dict[str, Any]) -> str:
+    # 与 activate_template 写入 agent_list 时用的 key 一致
+    return tpl.get("uuid") or tpl["name"]
+
+
+class TemplateActivator:
+    """从 ``agent_template_pool`` 按需激活模板；同一模板的并发激活只做一次"""
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks: Dict[str, threading.Lock] = {}
+        self._activations = 0
+
+    @staticmethod
+    def _tables() -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+        from tangyuanAI.Agent_list import agent_list, agent_template_pool
+
+        return agent_list, agent_template_pool
+
+    def find(self, name_or_uuid: str) -> Optional[Dict[str, Any]]:
+        """按模板名或 uuid 找模板"""
+        _, pool = self._tables()
+        tpl = pool.get(name_or_uuid)
+        if tpl is not None:
+            return tpl
+        return next((t for t in list(pool.values()) if t.get("uuid") == name_or_uuid), None)
+
+    def pending(self) -> Tuple[Tuple[str, Dict[str, Any]], ...]:
+        """还没激活的模板 ``(名字, 模板)``（登记顺序）"""
+        agent_list, pool = self._tables()
+        return tuple(
+            (name, tpl) for name, tpl in list(pool.items())
+            if _effective_uuid(tpl) not in agent_list and name not in agent_list
+        )
+
+    def activate(self, name_or_uuid: str) -> Optional[Any]:
+        """
+        激活模板并返回实例；模板不存在返回 None。
+
+        已经被别的请求（或配置脚本）激活过时直接返回那个实例。
+        """
+        tpl = self.find(name_or_uuid)
+        if tpl is None:
+            return None
+        name = tpl["name"]
+        with self._guard:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            agent_list, _ = self._tables()
+            inst = agent_list.get(_effective_uuid(tpl))
+            if inst is not None:
+                return inst
+            from tangyuanAI.Agent_list import activate_template
+
+            inst = activate_template(name)
+            self._activations += 1
+        from .provider_health import get_provider_health
+        from .snapshots import get_agent_snapshot
+
+        get_agent_snapshot().invalidate()
+        get_provider_health().subscribe(inst)
+        return inst
+
+    def stats(self) -> Dict[str, int]:
+        return {"activations": self._activations, "pending": len(self.pending())}
+
+
+_activator = TemplateActivator()
+
+
+def get_template_activator() -> TemplateActivator:
+    """返回进程级 TemplateActivator"""
+    return _activator
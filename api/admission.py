@@ -0,0 +1,214 @@
+"""
+准入控制 + 背压：限制同时进行的对话数，超出部分排队，队列满了快速拒绝。
+
+为什么需要？
+
+以前每个 ``/agents/{id}/chat`` 请求都立刻开线程跑对话，没有任何上限。突发流量下
+几百个对话同时打到 LLM provider，一起撞上限流、一起变慢。这里加三道闸：
+
+1. **全局并发上限**（``CHAT_MAX_CONCURRENCY``）：同一 worker 同时跑的对话数
+2. **单 Agent 并发上限**（``CHAT_MAX_CONCURRENCY_PER_AGENT``）：防止一个热门 Agent 吃满全局配额
+3. **有界等待队列**（``CHAT_MAX_QUEUE`` / ``CHAT_QUEUE_TIMEOUT``）：
+
+   - 队列已满 → 立即 ``429 Too Many Requests``
+   - 排队超时 → ``503 Service Unavailable``
+   - 两者都带 ``Retry-After``（按最近对话平均耗时估算）
+
+排队时间作为独立的延迟分量返回：响应头 ``X-Queue-Wait-Ms``，累计值见 ``/health``。
+
+线程安全：TestClient / 多 event loop 场景下也能用 —— 状态用 ``threading.Lock`` 保护，
+唤醒等待者时走各自 loop 的 ``call_soon_threadsafe``。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+from .env import env_float, env_int
+from .models import AdmissionStats
+
+
+class AdmissionController:
+    """全局 + 单 Agent 并发闸门，附带有界 FIFO 等待队列。"""
+
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        max_per_agent: Optional[int] = None,
+        max_queue: Optional[int] = None,
+        queue_timeout: Optional[float] = None,
+    ):
+        self.max_concurrency = max_concurrency if max_concurrency is not None else env_int("CHAT_MAX_CONCURRENCY", 64)
+        self.max_per_agent = max_per_agent if max_per_agent is not None else env_int("CHAT_MAX_CONCURRENCY_PER_AGENT", 16)
+        self.max_queue = max_queue if max_queue is not None else env_int("CHAT_MAX_QUEUE", 128)
+        self.queue_timeout = queue_timeout if queue_timeout is not None else env_float("CHAT_QUEUE_TIMEOUT", 30.0)
+
+        self._lock = threading.Lock()
+        self._active = 0
+        self._active_per_agent: Dict[str, int] = {}
+        self._waiters: Deque[Tuple[str, asyncio.Future]] = deque()
+
+        self._admitted = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        # 对话持有时长的指数滑动平均，用来估算 Retry-After
+        self._hold_ewma = 1.0
+
+    # ---- 公共 API ----
+
+    async def acquire(self, agent_key: str) -> float:
+        """
+        申请一个对话名额，返回排队等待秒数。
+
+        Raises:
+            HTTPException(429): 等待队列已满
+            HTTPException(503): 排队超时
+        """
+        started = time.perf_counter()
+        with self._lock:
+            # 排在前面的其他 Agent 的等待者只可能卡在它自己的单 Agent 上限上（全局有空位时 release 已经放行），
+            # 不挡这次请求；同一 Agent 有人在排队时照 FIFO 排到后面
+            if self._has_room(agent_key) and not any(key == agent_key for key, _ in self._waiters):
+                self._grant(agent_key)
+                self._admitted += 1
+                return 0.0
+            if len(self._waiters) >= self.max_queue:
+                self._rejected += 1
+                raise self._overloaded(429, "对话排队已满，请稍后重试")
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters.append((agent_key, fut))
+
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                try:
+                    self._waiters.remove((agent_key, fut))
+                    granted = False
+                except ValueError:
+                    # 超时 / 取消的同时刚好被授予了名额 —— 还回去
+                    granted = True
+                if not isinstance(e, asyncio.CancelledError):
+                    self._timed_out += 1
+            if granted:
+                self.release(agent_key)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise self._overloaded(503, f"对话排队超时（{self.queue_timeout:g}s），请稍后重试") from None
+
+        waited = time.perf_counter() - started
+        with self._lock:
+            self._admitted += 1
+            self._wait_total += waited
+            if waited > self._wait_max:
+                self._wait_max = waited
+        return waited
+
+    def release(self, agent_key: str, held: Optional[float] = None) -> None:
+        """归还名额，并按 FIFO 唤醒第一个能跑的等待者（跳过单 Agent 已满的）"""
+        with self._lock:
+            self._ungrant(agent_key)
+            if held is not None:
+                self._hold_ewma = 0.8 * self._hold_ewma + 0.2 * held
+
+            for waiter in list(self._waiters):
+                key, fut = waiter
+                if fut.done():
+                    continue
+                if not self._has_room(key):
+                    if self._active >= self.max_concurrency:
+                        break
+                    continue
+                self._waiters.remove(waiter)
+                self._grant(key)
+                try:
+                    fut.get_loop().call_soon_threadsafe(_resolve, fut)
+                except RuntimeError:
+                    # 等待者所在的 loop 已关
+                    self._ungrant(key)
+
+    @asynccontextmanager
+    async def admit(self, agent_key: str) -> AsyncIterator[float]:
+        """``async with ctrl.admit(uuid) as waited: ...``"""
+        waited = await self.acquire(agent_key)
+        started = time.perf_counter()
+        try:
+            yield waited
+        finally:
+            self.release(agent_key, held=time.perf_counter() - started)
+
+    def stats(self) -> AdmissionStats:
+        with self._lock:
+            return AdmissionStats(
+                max_concurrency=self.max_concurrency,
+                max_per_agent=self.max_per_agent,
+                max_queue=self.max_queue,
+                active=self._active,
+                waiting=len(self._waiters),
+                admitted=self._admitted,
+                rejected=self._rejected,
+                timed_out=self._timed_out,
+                wait_seconds_total=self._wait_total,
+                wait_seconds_max=self._wait_max,
+            )
+
+    # ---- 内部（调用方持锁） ----
+
+    def _has_room(self, agent_key: str) -> bool:
+        return (
+            self._active < self.max_concurrency
+            and self._active_per_agent.get(agent_key, 0) < self.max_per_agent
+        )
+
+    def _grant(self, agent_key: str) -> None:
+        self._active += 1
+        self._active_per_agent[agent_key] = self._active_per_agent.get(agent_key, 0) + 1
+
+    def _ungrant(self, agent_key: str) -> None:
+        self._active -= 1
+        n = self._active_per_agent.get(agent_key, 1) - 1
+        if n > 0:
+            self._active_per_agent[agent_key] = n
+        else:
+            self._active_per_agent.pop(agent_key, None)
+
+    def _overloaded(self, status_code: int, detail: str) -> HTTPException:
+        retry_after = max(1, math.ceil(self._hold_ewma))
+        return HTTPException(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+def _resolve(fut: asyncio.Future) -> None:
+    if not fut.done():
+        fut.set_result(None)
+
+
+# ---------------------------------------------------------------------------
+# 进程级单例
+# ---------------------------------------------------------------------------
+
+_default_controller: Optional[AdmissionController] = None
+_default_lock = threading.Lock()
+
+
+def get_admission() -> AdmissionController:
+    """返回进程级默认 AdmissionController"""
+    global _default_controller
+    if _default_controller is None:
+        with _default_lock:
+            if _default_controller is None:
+                _default_controller = AdmissionController()
+    return _default_controller
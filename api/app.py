@@ -29,7 +29,16 @@ from fastapi import FastAPI
 
 import tangyuanAI
 
-from .routes import agents, health, mcp, skills, tools
+from .executor import shutdown_executor
+from .http_pool import get_http_pool, shutdown_http_pool
+from .llm_replay import shutdown_llm_replay
+from .provider_health import get_provider_health, install as install_provider_health
+from .provider_health import uninstall as uninstall_provider_health
+from .registry import get_registry_watcher
+from .routes import agents, health, mcp, metrics, skills, tools, usage
+from .tool_dispatch import install as install_tool_dispatch
+from .tool_dispatch import shutdown_tool_dispatcher
+from .tool_exec import shutdown_process_pool, warm_process_pool
 
 logger = logging.getLogger(__name__)
 
@@ -67,8 +76,26 @@ def _load_agents_config(app: FastAPI) -> Optional[str]:
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # 先接管注册表（版本号 + ACL 倒排索引），Agent 初始化时构建 prompt 就能用上
+    get_registry_watcher()
+    # 配置脚本里的 register_tool 可以带 parallel_safe / cache / timeout / executor
+    install_tool_dispatch()
+    # Agent 实例化不再各自起线程探测连通性，加载完统一按 provider 去重探测一次
+    previous = install_provider_health()
     _load_agents_config(app)
+    if previous is not None:
+        get_provider_health().sync(tangyuanAI.agent_list.values())
+    # 配置脚本里注册了 executor="process" 的工具：先把工具进程拉起来
+    warm_process_pool()
     yield
+    uninstall_provider_health(previous)
+    shutdown_executor()
+    shutdown_tool_dispatcher()
+    shutdown_process_pool()
+    # 原生异步引擎在主 loop 上建的异步客户端只能在这里关
+    await get_http_pool().aclose()
+    shutdown_http_pool()
+    shutdown_llm_replay()
 
 
 def create_app() -> FastAPI:
@@ -87,6 +114,8 @@ def create_app() -> FastAPI:
     app.include_router(tools.router)
     app.include_router(skills.router)
     app.include_router(mcp.router)
+    app.include_router(usage.router)
+    app.include_router(metrics.router)
     return app
 
 
@@ -0,0 +1,374 @@
+"""
+原生异步对话引擎：在 event loop 上直接跑 ``conversation_with_tool`` 的对话循环，不占线程。
+
+tangyuanAI 的 ``conversation_with_tool`` 是同步的，API 层只能每个对话占一个线程
+（流式 ``asyncio.to_thread``、非流式 ``ConversationExecutor``）：线程大部分时间都在等 provider 的网络响应。
+框架自带的 ``aconversation`` 也不够用：
+
+- 工具仍然同步执行（整轮工具调用卡住 event loop），``async def`` 工具拿到的是没人 await 的协程
+- 流式下每个 ``usage`` 事件都会 ``pack(finish_task=True)``，SSE 会提前收到 ``done``
+- 每次 LLM 调用新建一个 ``httpx.AsyncClient``
+
+这里按同步版 ``conversation`` / ``_execute_tool_calls``（Anthropic：``conversation`` /
+``_execute_anthropic_tool_use``）的语义重写一遍循环，``pack`` 出来的事件、写进 ``history`` 的消息都与同步版一致：
+
+- 一轮的多个工具调用并发执行，钩子 / 事件 / 回填顺序不变（准备 / 收尾与同步路径共用 ``api/tool_dispatch.py``）
+
+- LLM 调用走计量 transport 的 ``achat`` / ``achat_stream``（共享的异步连接池，见 ``api/http_pool.py``）
+- ``async def`` 工具直接 await（``tool_timeout`` 内没完成就转后台，和 ``ToolRunner`` 一样返回 task_id 占位；
+  注册时声明了 ``timeout=`` 的，超时取消并按工具错误返回，见 ``api/tool_exec.py``）
+- MCP 工具：会话建在当前 event loop 上时直接 await ``session.call_tool``，否则走线程
+- 其余同步工具（含 ``ask_for_help``）用 ``asyncio.to_thread`` 执行，只在工具运行期间占线程；
+  对话被取消时等线程收尾后再退出，副本不会在线程还在用时被还回池子
+- OpenAI XML 标签模式的工具轮沿用同步实现，在线程里跑
+
+只接管没有覆写对话循环 / 工具执行的 ``tangyuanAI.agent`` 新版 Agent（``supports_native_async``）；
+其余 Agent 仍走线程。``CHAT_ASYNC_ENGINE=1`` 时 ``/agents/{id}/chat`` 的两条路径都用这里（``api/deps.py``）。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import inspect
+import json
+import logging
+import os
+import time
+import uuid as _uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from .cancellation import current_cancel_token
+from .metrics import TOOL_DURATION, TOOL_TIMEOUTS
+from .tool_dispatch import (
+    arun_calls,
+    builtin_tool_names,
+    finish_fc_call,
+    finish_tool_use,
+    prepare_fc_call,
+    prepare_tool_use,
+)
+from .tool_exec import ToolTimeoutError
+
+logger = logging.getLogger(__name__)
+
+# 超时转后台的原生异步工具：保住引用，跑完自动移除
+_background: Set["asyncio.Task[Any]"] = set()
+
+_MCP_WRAPPER = "_make_session_wrapper.<locals>.sync_wrapper"
+
+
+def native_async_enabled() -> bool:
+    """``/agents/{id}/chat`` 是否用原生异步引擎（``CHAT_ASYNC_ENGINE``，默认关）"""
+    return os.getenv("CHAT_ASYNC_ENGINE", "0").lower() in ("1", "true", "yes")
+
+
+def _library_methods() -> Dict[str, Tuple[Any, ...]]:
+    from tangyuanAI.agent import _AgentCommon, _AnthropicBase
+
+    return {
+        "conversation": (_AgentCommon.conversation, _AnthropicBase.conversation),
+        "conversation_with_tool": (_AgentCommon.conversation_with_tool, _AnthropicBase.conversation_with_tool),
+        "_execute_tool_calls": (_AgentCommon._execute_tool_calls,),
+        "_execute_anthropic_tool_use": (None, _AnthropicBase._execute_anthropic_tool_use),
+        "_finish_anthropic_round": (None, _AnthropicBase._finish_anthropic_round),
+        "_dispatch_tool": (_AgentCommon._dispatch_tool,),
+    }
+
+
+def supports_native_async(agent: Any) -> bool:
+    """Agent 的对话循环 / 工具执行都是 tangyuanAI 原版（没被子类覆写）时才能由这里接管"""
+    try:
+        methods = _library_methods()
+    except ImportError:  # pragma: no cover
+        return False
+    cls = type(agent)
+    return all(getattr(cls, name, None) in allowed for name, allowed in methods.items())
+
+
+async def _in_thread(fn: Callable[..., Any], /, *args: Any) -> Any:
+    """
+    ``asyncio.to_thread``，但对话被取消时先等线程跑完再往外抛：线程停不下来，
+    提前返回会让副本在线程还在用它的时候就被还回池子。取消标记先置上，线程在下一个检查点收尾。
+    """
+    fut = asyncio.ensure_future(asyncio.to_thread(fn, *args))
+    try:
+        return await asyncio.shield(fut)
+    except asyncio.CancelledError:
+        token = current_cancel_token.get()
+        if token is not None:
+            token.cancel("cancelled")
+        await asyncio.wait({fut})
+        raise
+
+
+def _is_anthropic(agent: Any) -> bool:
+    from tangyuanAI.agent import _AnthropicBase
+
+    return isinstance(agent, _AnthropicBase)
+
+
+def _mcp_call(func: Callable[..., Any]) -> Optional[Callable[..., Awaitable[Any]]]:
+    """MCP 桥接出来的同步包装器 → 直接 await 会话的协程版本；会话不在当前 loop 上时返回 None"""
+    if getattr(func, "__qualname__", "") != _MCP_WRAPPER:
+        return None
+    try:
+        from tangyuanAI import mcp_bridge
+    except ImportError:  # pragma: no cover - mcp 依赖可选
+        return None
+    if mcp_bridge._event_loop is not asyncio.get_running_loop():
+        return None
+    bound = inspect.getclosurevars(func).nonlocals
+    server_path, name, is_tool = bound["server_path"], bound["name"], bound["is_tool"]
+
+    async def call(**kwargs: Any) -> Any:
+        info = mcp_bridge._global_session_pool._pool.get(server_path)
+        if not info or not info.get("initialized"):
+            raise RuntimeError(f"MCP 会话未初始化：{server_path}")
+        session = info["session"]
+        if is_tool:
+            return (await session.call_tool(name, kwargs)).content or ""
+        return (await session.read_resource(name)).contents or ""
+
+    return call
+
+
+class AsyncConversation:
+    """在一个 Agent 副本上跑一次对话（``AgentPool`` 派生的副本，已装好计量 transport）"""
+
+    def __init__(self, agent: Any):
+        self.agent = agent
+
+    async def run(self, messages: Any = None, images: Any = None) -> str:
+        """等价于 ``agent.conversation_with_tool(messages, images=images)``，返回最终文本"""
+        from tangyuanAI.persistence import auto_save, is_enabled
+
+        agent = self.agent
+        if messages:
+            agent.history.append(agent._build_user_message(messages, images))
+        try:
+            if _is_anthropic(agent):
+                return await self._anthropic_loop()
+            return await self._openai_loop(messages, images)
+        finally:
+            if is_enabled():
+                await _in_thread(auto_save, agent)
+
+    # ---- OpenAI / Responses ----
+
+    async def _openai_loop(self, messages: Any, images: Any) -> str:
+        agent = self.agent
+        history = agent.history
+        while True:
+            full_content, tool_calls = await self._openai_round(messages, images)
+            messages = images = None
+            if agent.fc_model and tool_calls:
+                await self._execute_tool_calls(history, tool_calls)
+                logger.debug("工具执行完成，继续对话")
+                self._checkpoint()
+                continue
+            if "</" in full_content and type(agent)._handle_xml_mode is not _common_xml_mode():
+                # XML 标签模式：解析 + 执行 + 续轮都沿用同步实现
+                xml_result = await _in_thread(agent._handle_xml_mode, history, full_content)
+                if xml_result is not None:
+                    return xml_result
+            return full_content
+
+    async def _openai_round(self, messages: Any, images: Any) -> Tuple[str, List[dict]]:
+        from tangyuanAI.tracing import CostCalculator, current_span, trace_llm_call
+
+        agent = self.agent
+        req = agent._build_openai_request(messages, images, agent.history, True, True)
+        transport = agent._transport_cls(
+            endpoint=agent._endpoint(),
+            api_key=agent.api_key,
+            **agent._transport_kwargs(),
+        )
+        full_content = ""
+        tool_calls: List[dict] = []
+        if agent.stream:
+            try:
+                full_content, tool_calls = await self._collect_stream(transport, req)
+            except Exception as e:
+                logger.error("流式响应处理错误: %s", e)
+                full_content = ""
+        else:
+            try:
+                with trace_llm_call(name="llm.achat", model=agent.model_name, stream=False):
+                    llm_rsp = await transport.achat(req)
+                    if llm_rsp.usage:
+                        span = current_span()
+                        if span:
+                            CostCalculator.add_to_span(
+                                span,
+                                model=agent.model_name,
+                                prompt_tokens=llm_rsp.usage.prompt_tokens,
+                                completion_tokens=llm_rsp.usage.completion_tokens,
+                            )
+                full_content, tool_calls = agent._collect_plain_response(llm_rsp)
+            except Exception as e:
+                logger.error("非流式响应处理错误: %s", e)
+                full_content = ""
+        return full_content, tool_calls
+
+    async def _collect_stream(self, transport: Any, req: Any) -> Tuple[str, List[dict]]:
+        """同 ``_collect_stream_events``：text / tool_call / usage"""
+        from tangyuanAI.tracing import trace_llm_call
+
+        agent = self.agent
+        full_content = ""
+        tool_calls: List[dict] = []
+        agent.stream_run = True
+        with trace_llm_call(name="llm.achat_stream", model=agent.model_name, stream=True):
+            async for evt in transport.achat_stream(req):
+                if evt.type == "text":
+                    full_content += evt.text
+                    agent.pack(evt.text, finish_task=False)
+                elif evt.type == "tool_call" and evt.tool_call is not None:
+                    tc = evt.tool_call
+                    tool_calls.append({
+                        "id": tc.id, "type": "function",
+                        "function": {
+                            "name": tc.name,
+                            "arguments": json.dumps(tc.arguments, ensure_ascii=False),
+                        },
+                    })
+                elif evt.type == "usage" and evt.usage is not None:
+                    agent.pack(
+                        f"\n本次请求用量：提示 {evt.usage.prompt_tokens} tokens，"
+                        f"生成 {evt.usage.completion_tokens} tokens，"
+                        f"总计 {evt.usage.total_tokens} tokens。",
+                        other=True,
+                    )
+                elif evt.type == "done":
+                    agent.stream_run = False
+        return full_content, tool_calls
+
+    async def _execute_tool_calls(self, history: List[dict], tool_calls: List[dict]) -> None:
+        """同 ``_execute_tool_calls``；一轮的多个调用并发执行（``api/tool_dispatch.py``）"""
+        from tangyuanAI.tool_reliability import get_default_idempotency_store
+
+        agent = self.agent
+        history.append({"role": "assistant", "content": None, "tool_calls": tool_calls})
+        idem_store = get_default_idempotency_store()
+        calls = [prepare_fc_call(agent, tc, idem_store) for tc in tool_calls]
+        await arun_calls(agent, calls, self.dispatch)
+        for result in [finish_fc_call(agent, call, idem_store) for call in calls]:
+            history.append({
+                "role": "tool",
+                "tool_call_id": result["tool_call_id"],
+                "name": result["name"],
+                "content": result["content"],
+            })
+
+    def _checkpoint(self) -> None:
+        # 同步版在 FC 续轮前存一次 mid-flight 快照
+        try:
+            from tangyuanAI.checkpoint import capture_snapshot, get_default_checkpoint_store
+
+            get_default_checkpoint_store().save(capture_snapshot(self.agent))
+        except Exception as e:
+            logger.debug("mid-flight checkpoint 失败(不影响对话): %s", e)
+
+    # ---- Anthropic ----
+
+    async def _anthropic_loop(self) -> str:
+        from tangyuanAI.tracing import trace_llm_call
+
+        agent = self.agent
+        history = agent.history
+        while True:
+            req, transport = agent._build_anthropic_request()
+            if not req.messages:
+                from tangyuanAI.errors import ConversationError
+
+                raise ConversationError("messages 为空：history 里只有 system message，无法构造有效请求。")
+            blocks: List[dict] = []
+            tool_uses: List[dict] = []
+            try:
+                if agent.stream:
+                    with trace_llm_call(name="anthropic.achat_stream", model=agent.model_name, stream=True):
+                        async for evt in transport.achat_stream(req):
+                            agent._accumulate_anthropic_evt(blocks, tool_uses, evt)
+                else:
+                    with trace_llm_call(name="anthropic.achat", model=agent.model_name, stream=False):
+                        agent._accumulate_anthropic_rsp(blocks, tool_uses, "", await transport.achat(req))
+            except Exception as e:
+                logger.error("%s Anthropic 调用失败：%s", agent.name, e)
+                raise
+
+            history.append({"role": "assistant", "content": blocks})
+            if not tool_uses:
+                return "".join(b.get("text", "") for b in blocks if b.get("type") == "text")
+            calls = [prepare_tool_use(agent, tu) for tu in tool_uses]
+            await arun_calls(agent, calls, self.dispatch)
+            history.append({"role": "user", "content": [finish_tool_use(agent, call) for call in calls]})
+
+    # ---- 工具执行 ----
+
+    def _native_tool(self, name: str) -> Optional[Callable[..., Awaitable[Any]]]:
+        """能直接 await 的工具（``async def`` 注册工具 / 当前 loop 上的 MCP 会话）；其余返回 None"""
+        from tangyuanAI.agent_tool import tool_registry
+
+        agent = self.agent
+        if name in builtin_tool_names(agent) or not tool_registry.check_permission(agent.uuid, name):
+            return None
+        func = (tool_registry.get_tool_info(name) or {}).get("function")
+        if func is None:
+            return None
+        if inspect.iscoroutinefunction(func):
+            return func
+        return _mcp_call(func)
+
+    async def dispatch(self, name: str, arguments: dict) -> Tuple[Any, Optional[str]]:
+        """
+        同 ``_dispatch_tool``，返回 ``(结果, None)`` 或 ``(None, 后台 task_id)``。
+
+        原生异步工具在当前 loop 上 await；其余交给副本原来的 ``_dispatch_tool``（``ToolRunner``）在线程里跑。
+        """
+        agent = self.agent
+        func = self._native_tool(name)
+        if func is None:
+            return await _in_thread(agent._dispatch_tool, name, arguments)
+
+        from tangyuanAI.agent_tool import _validate_tool_args_for
+
+        try:
+            arguments = _validate_tool_args_for(agent, name, arguments)
+        except Exception as e:
+            return f"工具参数校验失败：{e}", None
+
+        from tangyuanAI.agent_tool import tool_registry
+
+        limit = (tool_registry.get_tool_info(name) or {}).get("timeout")
+        started = time.perf_counter()
+        task = asyncio.ensure_future(func(**(arguments or {})))
+        task.add_done_callback(lambda _: TOOL_DURATION.observe(time.perf_counter() - started, name))
+        try:
+            done, _ = await asyncio.wait({task}, timeout=limit or agent.tool_timeout)
+        except asyncio.CancelledError:
+            task.cancel()  # 对话被取消：还没跑完的工具一起取消
+            raise
+        if not done and limit is not None:
+            task.cancel()  # 工具自己声明的 timeout：取消并按工具错误返回（api/tool_exec.py）
+            TOOL_TIMEOUTS.inc(name, "async")
+            raise ToolTimeoutError(name, limit)
+        if not done:
+            task_id = str(_uuid.uuid4())
+            logger.warning(
+                "async tool %s timed out after %ss, moved to background as %s", name, agent.tool_timeout, task_id,
+            )
+            _background.add(task)
+            task.add_done_callback(_background.discard)
+            return None, task_id
+        return task.result(), None
+
+
+def _common_xml_mode() -> Any:
+    from tangyuanAI.agent import _AgentCommon
+
+    return _AgentCommon._handle_xml_mode
+
+
+async def aconversation_with_tool(agent: Any, messages: Any = None, images: Any = None) -> str:
+    """在 Agent 副本上跑一次原生异步对话，返回最终文本（事件照常经副本的 ``out`` 发出）"""
+    return await AsyncConversation(agent).run(messages, images)
@@ -0,0 +1,71 @@
+"""
+协作式取消：SSE 客户端断开后，让后台对话线程尽快停下来。
+
+问题：客户端中途断开时，SSE 生成器不再读 queue，但后台 ``runner`` 线程还在继续
+调 LLM、执行工具，直到整个对话结束 —— 白白浪费 token、provider 并发名额，
+还可能产生工具副作用。
+
+做法：每个对话一枚 ``CancelToken``，断开时由 SSE 生成器 ``cancel()``；对话线程在
+这些"检查点"上调 ``raise_if_cancelled()``：
+
+- 每次 ``out``（每个流式文本 chunk 都会 ``pack → out`` 一次）→ 最多再读一个 chunk 就停
+- 工具调用的 ``before`` 钩子 → 尚未开始的工具不再执行
+- transport 层读到的每个事件（见 ``check_cancelled``，供 transport 包装层调用）
+
+``ConversationCancelled`` 故意继承 ``BaseException`` 而不是 ``Exception``：
+tangyuanAI 的对话循环 / 钩子执行里有不少 ``except Exception`` 兜底，
+普通异常会被吞掉、对话照常继续；``BaseException`` 能一路冒泡到 runner。
+异常穿过 transport 的 ``for evt in chat_stream(...)`` 时生成器被关闭，
+底层 HTTP 流随之释放。
+"""
+
+from __future__ import annotations
+
+import contextvars
+import threading
+from typing import Optional
+
+
+class ConversationCancelled(BaseException):
+    """对话被取消（客户端断开等）。继承 BaseException，绕过框架里的 except Exception。"""
+
+
+class CancelToken:
+    """线程安全的一次性取消标记"""
+
+    __slots__ = ("_event", "reason")
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason: Optional[str] = None
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self) -> None:
+        if self._event.is_set():
+            raise ConversationCancelled(self.reason)
+
+    def tool_hook(self, event_type, tool_name, tool_args, tool_result=None, task_id=None) -> None:
+        """挂到 ``tool_call_hooks`` 上：取消后不再开始新的工具调用"""
+        if event_type == "before":
+            self.raise_if_cancelled()
+
+
+# 当前线程 / 协程正在跑的对话的取消标记（ConversationExecutor 会把 context 带进工作线程）
+current_cancel_token: contextvars.ContextVar[Optional[CancelToken]] = contextvars.ContextVar(
+    "current_cancel_token", default=None,
+)
+
+
+def check_cancelled() -> None:
+    """检查点：当前对话已取消就抛 ``ConversationCancelled``；不在对话里则什么都不做"""
+    token = current_cancel_token.get()
+    if token is not None:
+        token.raise_if_cancelled()
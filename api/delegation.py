@@ -0,0 +1,204 @@
+"""
+Agent 副本上的工具执行 / ask_for_help：把请求级 context 带进工具线程和子 Agent。
+
+问题：
+
+- tangyuanAI 的工具在 ``ToolRunner`` 的线程池里跑，``ask_for_help`` 再把子 Agent 的对话丢进
+  ``AgentQueue`` 的 worker 线程 —— 两次换线程都不带 ``contextvars``，请求级状态
+  （取消标记 ``current_cancel_token``、用量累加器 ``current_usage``）到了子 Agent 那里就丢了
+- 原版 ``ask_for_help`` 直接在 ``agent_list`` 里的模板实例上跑对话，并发请求会共用、
+  累积子 Agent 的 ``history``
+
+这里给每个副本装三样东西（``install_delegation``，由 ``AgentPool`` 在派生副本时调用）：
+
+1. ``ContextToolRunner``：包住模板的 ``ToolRunner``，提交工具时带上当前 context，并计工具耗时
+2. ``ask_for_help``：子 Agent 也从 ``AgentPool`` 取副本跑，直接在发起调用的工具线程里执行（context 随之带过去）
+3. ``ask_many``：一次工具调用并发向多个 Agent 求助，结果按请求顺序返回
+
+同一轮里的多个 ``ask_for_help`` 由 ``api/tool_dispatch.py`` 并发执行，``ask_many`` 自己也走同一个有界线程池。
+原版把子对话丢进 ``AgentQueue`` 的 worker（默认 2 个）再等结果：并发求助最多两个同时跑，
+嵌套求助时每一层都占住一个 worker 等下一层，扇出稍大就排队甚至卡到工具超时；
+调用链放在 worker 的 thread-local 里，到了子 Agent 的工具线程就读不到，循环检测形同虚设。
+这里调用链放在 ``current_call_chain``（contextvar，跟着工具线程 / 线程池走），循环检测和深度上限
+（``ASK_FOR_HELP_MAX_DEPTH``，默认沿用 ``AgentQueue`` 的 8）与 ``AgentQueue.submit`` 一致，拒绝时的提示也相同。
+"""
+
+from __future__ import annotations
+
+import contextvars
+import functools
+import json
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from tangyuanAI.agent_queue import get_call_chain, get_default_queue
+
+from . import tool_exec
+from .activation import get_template_activator, lazy_activation_enabled
+from .env import env_int
+from .metrics import ASK_FOR_HELP_DEPTH, TOOL_DURATION, current_conversation
+
+logger = logging.getLogger(__name__)
+
+# 当前 ask_for_help 调用链（发起方到当前 Agent 的 uuid）；顶层对话为空
+current_call_chain: contextvars.ContextVar[Tuple[str, ...]] = contextvars.ContextVar(
+    "current_call_chain", default=(),
+)
+
+ASK_MANY_SCHEMA: Dict[str, Any] = {
+    "type": "function",
+    "function": {
+        "name": "ask_many",
+        "description": "同时请求多个Agent帮助：各子任务并发执行，按请求顺序返回每个Agent的回复。互不依赖的子任务用它一次发出。",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "requests": {
+                    "type": "array",
+                    "description": "要并发发出的求助请求",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "agent_id": {"type": "string", "description": "目标Agent的UUID或名称"},
+                            "message": {"type": "string", "description": "要发送给目标Agent的内容"},
+                        },
+                        "required": ["agent_id", "message"],
+                    },
+                },
+            },
+            "required": ["requests"],
+        },
+    },
+}
+
+
+class ContextToolRunner:
+    """
+    ``ToolRunner`` 代理：``submit`` 的工具函数在提交方的 context 副本里执行，并计耗时；
+    工具声明的 ``timeout`` / ``executor``（``api/tool_exec.py``）也在这里生效
+    """
+
+    __slots__ = ("_runner",)
+
+    def __init__(self, runner: Any):
+        self._runner = runner
+
+    def submit(self, tool_func: Callable[..., Any], /, *args: Any, **kwargs: Any):
+        ctx = contextvars.copy_context()
+        tool_name = kwargs.get("tool_name") or getattr(tool_func, "__name__", "unknown")
+
+        def timed(*a: Any, **kw: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return ctx.run(tool_func, *a, **kw)
+            finally:
+                TOOL_DURATION.observe(time.perf_counter() - started, tool_name)
+
+        return tool_exec.submit(self._runner, tool_func, timed, args, kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._runner, name)
+
+
+def _resolve_agent(agent_id: str) -> Any:
+    from tangyuanAI.Agent_list import agent_list
+
+    target = agent_list.get(agent_id)
+    if target is None:
+        target = next((a for a in agent_list.values() if a.name == agent_id), None)
+    if target is None and lazy_activation_enabled():
+        target = get_template_activator().activate(agent_id)
+    return target
+
+
+def _max_depth() -> int:
+    return env_int("ASK_FOR_HELP_MAX_DEPTH", getattr(get_default_queue(), "_max_depth", 8))
+
+
+def _rejected(target_uuid: str, chain: List[str]) -> Optional[str]:
+    """循环 / 深度检查（提示与 ``AgentQueue.submit`` 相同）；放行返回 None"""
+    if target_uuid in chain:
+        return (
+            f"[agent_queue] 循环调用被拒绝：{target_uuid} 已在调用链 {chain} 中。"
+            f"请改用 attempt_completion 终止递归。"
+        )
+    max_depth = _max_depth()
+    if len(chain) >= max_depth:
+        return (
+            f"[agent_queue] 达到最大调用深度 {max_depth}（chain={chain}）。"
+            f"已拒绝入队，避免栈爆炸。"
+        )
+    return None
+
+
+def ask_for_help(agent: Any, agent_id: str, message: str) -> str:
+    """副本版 ``ask_for_help``：子 Agent 在独立副本 + 发起方 context 里跑"""
+    from .pool import get_agent_pool
+
+    target = _resolve_agent(agent_id)
+    if target is None:
+        return f"未找到 Agent：{agent_id}"
+
+    # 从 AgentQueue worker 里发起的（非 API 副本派出的子对话）仍读 thread-local
+    caller_chain = list(current_call_chain.get() or get_call_chain())
+    rejected = _rejected(target.uuid, caller_chain)
+    if rejected is not None:
+        return rejected
+    ASK_FOR_HELP_DEPTH.observe(len(caller_chain) + 1)
+    conv = current_conversation.get()
+    if conv is not None:
+        conv.count_delegation()
+
+    reset = current_call_chain.set(tuple(caller_chain) + (target.uuid,))
+    try:
+        with get_agent_pool().lease(target) as sub:
+            return str(sub.conversation(message))
+    except Exception as e:
+        logger.error("ask_for_help 失败：%s", e)
+        return f"协助请求失败：{e}"
+    finally:
+        current_call_chain.reset(reset)
+
+
+def ask_many(agent: Any, requests: List[Dict[str, str]]) -> str:
+    """并发执行多个 ``ask_for_help``，返回 ``[{"agent_id", "reply"}, ...]``（JSON，按请求顺序）"""
+    from .tool_dispatch import get_tool_dispatcher
+
+    replies: List[str] = [""] * len(requests)
+
+    def job(i: int, req: Dict[str, str]) -> Callable[[], None]:
+        def run() -> None:
+            try:
+                replies[i] = ask_for_help(agent, req["agent_id"], req["message"])
+            except Exception as e:
+                replies[i] = f"协助请求失败：{e}"
+
+        return run
+
+    get_tool_dispatcher().run([job(i, req) for i, req in enumerate(requests)])
+    return json.dumps(
+        [{"agent_id": req.get("agent_id"), "reply": reply} for req, reply in zip(requests, replies)],
+        ensure_ascii=False,
+    )
+
+
+def _dispatch_with_ask_many(agent: Any, dispatch: Callable[..., Any], name: str, arguments: dict):
+    """``ask_many`` 不是类上的 ``@builtin_tool``，原版 ``_dispatch_tool`` 找不到它，这里先接住"""
+    if name != "ask_many":
+        return dispatch(name, arguments)
+    return agent._tool_runner.submit(
+        agent.ask_many, tool_name=name, timeout=agent.tool_timeout, **(arguments or {}),
+    )
+
+
+def install_delegation(agent: Any) -> None:
+    """给 Agent 副本装上带 context 的 ToolRunner、副本版 ask_for_help 和 ask_many（只改实例属性）"""
+    runner = getattr(agent, "_tool_runner", None)
+    if runner is not None and not isinstance(runner, ContextToolRunner):
+        agent._tool_runner = ContextToolRunner(runner)
+    if callable(getattr(type(agent), "ask_for_help", None)):
+        agent.ask_for_help = functools.partial(ask_for_help, agent)
+        if not callable(getattr(type(agent), "ask_many", None)):
+            agent.ask_many = functools.partial(ask_many, agent)
+            agent._dispatch_tool = functools.partial(_dispatch_with_ask_many, agent, agent._dispatch_tool)
@@ -12,8 +12,17 @@ from typing import Any, Dict, Optional
 
 import tangyuanAI
 from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
 
+from .activation import get_template_activator, lazy_activation_enabled
+from .async_engine import aconversation_with_tool, native_async_enabled, supports_native_async
+from .cancellation import CancelToken, ConversationCancelled, current_cancel_token
+from .executor import get_executor
+from .metrics import track_conversation
 from .models import AgentInfo
+from .pool import get_agent_pool
+from .sessions import SessionHandle
+from .usage import UsageAccumulator, current_usage
 
 
 def get_agent_list() -> Dict[str, Any]:
@@ -31,8 +40,14 @@ def get_agent_or_404(name_or_uuid: str) -> Any:
     根据名称或 UUID 取 Agent 实例。
 
     Agent 注册时同时登记到两个 key（uuid 和 name），所以一次 lookup 就能命中。
+    惰性激活模式下（``AGENTS_LAZY_ACTIVATION=1``），没激活的模板在这里当场激活（见 ``api/activation.py``）。
     """
     inst = tangyuanAI.agent_list.get(name_or_uuid)
+    if inst is None and lazy_activation_enabled():
+        try:
+            inst = get_template_activator().activate(name_or_uuid)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Agent 激活失败：{e}") from e
     if inst is None:
         raise HTTPException(
             status_code=404,
@@ -42,6 +57,21 @@ def get_agent_or_404(name_or_uuid: str) -> Any:
     return inst
 
 
+async def aget_agent_or_404(name_or_uuid: str) -> Any:
+    """
+    ``get_agent_or_404`` 的 async 版（async 路由用）。
+
+    已激活的实例直接查表；需要惰性激活时（实例化 Agent，可能还要等同一模板的激活锁）放到线程池里，
+    不卡 event loop。
+    """
+    inst = tangyuanAI.agent_list.get(name_or_uuid)
+    if inst is not None:
+        return inst
+    if lazy_activation_enabled():
+        return await run_in_threadpool(get_agent_or_404, name_or_uuid)
+    return get_agent_or_404(name_or_uuid)
+
+
 def get_agent_info(inst: Any) -> AgentInfo:
     """从 Agent 实例提取元信息，返回 AgentInfo"""
     cls = type(inst)
@@ -56,16 +86,124 @@ def get_agent_info(inst: Any) -> AgentInfo:
     )
 
 
+def get_template_info(tpl: Dict[str, Any]) -> AgentInfo:
+    """从 ``agent_template_pool`` 的模板元数据提取元信息（不实例化），返回 AgentInfo"""
+    cls = tpl["cls"]
+    return AgentInfo(
+        name=tpl["name"],
+        uuid=tpl.get("uuid") or tpl["name"],
+        description=tpl.get("description"),
+        protocol=getattr(cls, "protocol", None),
+        api_provider=getattr(cls, "api_provider", None),
+        model_name=getattr(cls, "model_name", None),
+        fc_model=bool(getattr(cls, "fc_model", False)),
+        active=False,
+    )
+
+
 # ---------------------------------------------------------------------------
-# 流式对话支持：monkey-patch self.out 把事件推到 asyncio.Queue
+# 对话执行：每个请求一份 AgentPool 副本，独享 out / history
 # ---------------------------------------------------------------------------
 
+def _bind_request(clone: Any, token: CancelToken, usage: Optional[UsageAccumulator]) -> None:
+    """
+    把请求级状态放进当前线程的 context：取消标记（另挂到工具调用前钩子上）、
+    用量累加器（计量 transport 每次 LLM 调用结束时往里记）
+    """
+    clone.tool_call_hooks.append(token.tool_hook)
+    current_cancel_token.set(token)
+    current_usage.set(usage)
+
+
+def _load_session(clone: Any, session: Optional[SessionHandle]) -> int:
+    """把会话历史接在副本的 system prompt 后面；返回本轮新增消息的起点"""
+    if session is not None:
+        clone.history.extend(session.history)
+    return len(clone.history)
+
+
+def _commit_session(clone: Any, session: Optional[SessionHandle], start: int) -> None:
+    """对话正常结束后，把本轮新增的消息追加回会话"""
+    if session is not None:
+        session.commit(clone.history[start:])
+
+
+async def _acommit_session(clone: Any, session: Optional[SessionHandle], start: int) -> None:
+    """``_commit_session`` 的 async 版（原生异步引擎用）"""
+    if session is not None:
+        await session.acommit(clone.history[start:])
+
+
+async def run_agent_chat(
+    inst: Any,
+    *,
+    messages,
+    images: Optional[Any] = None,
+    tool: bool = False,
+    session: Optional[SessionHandle] = None,
+    usage: Optional[UsageAccumulator] = None,
+) -> str:
+    """
+    非流式对话：从 AgentPool 取一份副本，在 ConversationExecutor 里跑完整个
+    ``conversation_with_tool``，返回最终文本。
+
+    带 ``session`` 时副本先装上会话历史，跑完把新增消息写回（见 ``api/sessions.py``）；
+    带 ``usage`` 时本次对话（含 ask_for_help 子调用）的 token 用量累加进去。
+    等待中的协程被取消（请求被放弃）时，同步取消后台对话。
+
+    ``CHAT_ASYNC_ENGINE=1`` 且 Agent 支持时改用原生异步引擎（``api/async_engine.py``），不占线程池。
+    """
+    pool = get_agent_pool()
+    token = CancelToken()
+
+    if native_async_enabled() and supports_native_async(inst):
+        async def arunner():
+            with pool.lease(inst) as clone:
+                _bind_request(clone, token, usage)
+                start = _load_session(clone, session)
+                try:
+                    with track_conversation(clone.name):
+                        text = await aconversation_with_tool(clone, messages=messages, images=images)
+                except ConversationCancelled:
+                    return ""
+                await _acommit_session(clone, session, start)
+                return text
+
+        # 单独一个 task：请求级 context 变量只设在它自己的 context 里
+        return await asyncio.create_task(arunner())
+
+    def runner():
+        with pool.lease(inst) as clone:
+            _bind_request(clone, token, usage)
+            start = _load_session(clone, session)
+            try:
+                with track_conversation(clone.name):
+                    text = clone.conversation_with_tool(
+                        messages=messages,
+                        tool=tool,
+                        images=images,
+                    )
+            except ConversationCancelled:
+                return ""
+            _commit_session(clone, session, start)
+            return text
+
+    try:
+        return await get_executor().run(runner)
+    except asyncio.CancelledError:
+        token.cancel("request cancelled")
+        raise
+
+
 async def stream_agent_chat(
     inst: Any,
     *,
     messages,
     images: Optional[Any] = None,
     tool: bool = False,
+    cancel_token: Optional[CancelToken] = None,
+    session: Optional[SessionHandle] = None,
+    usage: Optional[UsageAccumulator] = None,
 ):
     """
     在后台线程跑 ``conversation_with_tool``，把每次 ``self.out(...)`` 的内容
@@ -79,28 +217,38 @@ async def stream_agent_chat(
 
     这里的策略：
 
+    - 从 ``AgentPool`` 取一份本请求专属的副本，副本的 ``out`` 直接就是推 queue 的 sink
+      （同时保留原 out 行为：默认 print / 自定义输出）
     - 把 ``conversation_with_tool`` 丢到 ``asyncio.to_thread`` 后台跑
-    - monkey-patch ``inst.out``：保留原行为 + 同时把 content 推到 asyncio.Queue
-    - 线程结束后推一个 sentinel ``{"event": "done", "data": {...}, ...}``
-    - async generator ``__aexit__`` 时还原 ``inst.out``，避免污染后续请求
+    - 线程结束后推一个 sentinel，并把副本还给池子
 
     注意：
 
-    - 多个并发请求会共享同一个 Agent 实例的 out；目前靠 ``asyncio.Lock`` 保证
-      patch/restore 不会乱
-    - 如果用户已经注册了自己的 hook（``register_tool_hook``），它们不受影响——
-      我们只 patch ``out``，hook 是另一条线
+    - 注册在 ``agent_list`` 里的实例只当模板，**不再被修改**；并发请求各用各的副本，
+      事件和 ``history`` 不会互相串
+    - 如果用户已经注册了自己的 hook（``register_tool_hook``），副本会继承一份
+    - ``cancel_token``：调用方（SSE 生成器）在客户端断开时 ``cancel()``，后台对话在下一个
+      ``out`` / 工具调用前停下（见 ``api/cancellation.py``）；生成器被关闭时也会自动取消
+    - ``session``：副本先装上会话历史，对话正常结束才把新增消息写回（被取消的轮次不写）
+    - ``usage``：本次对话（含 ask_for_help 子调用）的 token 用量累加器
+    - ``CHAT_ASYNC_ENGINE=1`` 且 Agent 支持时，对话作为 event loop 上的 task 跑（``api/async_engine.py``），
+      不占线程；客户端断开时直接取消该 task
     """
+    token = cancel_token or CancelToken()
     queue: asyncio.Queue = asyncio.Queue()
-    original_out = inst.out
     sentinel = object()
 
     # 必须在 main event loop 里拿 loop handle；如果在子线程（runner / out）里
     # 调 asyncio.get_event_loop() 会创建新 loop，导致 call_soon_threadsafe
     # 推到一个**没有人 await 的** queue 上 —— 测试时表现为流式端点 hang。
     main_loop = asyncio.get_running_loop()
+    pool = get_agent_pool()
+    clone = pool.acquire(inst)
+    original_out = clone.out
 
-    def patched_out(content: dict) -> None:
+    def sink(content: dict) -> None:
+        # 0) 检查点：已取消就抛 ConversationCancelled，让对话线程停下
+        token.raise_if_cancelled()
         # 1) 推 queue（线程安全）—— 用 main_loop 而非 asyncio.get_event_loop()
         try:
             main_loop.call_soon_threadsafe(queue.put_nowait, content.copy())
@@ -113,56 +261,63 @@ async def stream_agent_chat(
         except Exception:
             pass
 
-    inst.out = patched_out
-    final_text_holder: dict = {"text": ""}
+    clone.out = sink
 
     def runner():
+        _bind_request(clone, token, usage)
+        start = _load_session(clone, session)
         try:
-            text = inst.conversation_with_tool(
-                messages=messages,
-                tool=tool,
-                images=images,
-            )
-            final_text_holder["text"] = text or ""
+            with track_conversation(clone.name):
+                clone.conversation_with_tool(
+                    messages=messages,
+                    tool=tool,
+                    images=images,
+                )
+            _commit_session(clone, session, start)
+        except ConversationCancelled:
+            pass
         except Exception as e:  # pragma: no cover
-            main_loop.call_soon_threadsafe(
-                queue.put_nowait,
-                {"event": "error", "data": {"message": str(e)}},
-            )
+            _put({"event": "error", "data": {"message": str(e)}})
+        finally:
+            pool.release(clone)
+            _put(sentinel)
+
+    async def arunner():
+        _bind_request(clone, token, usage)
+        start = _load_session(clone, session)
+        try:
+            with track_conversation(clone.name):
+                await aconversation_with_tool(clone, messages=messages, images=images)
+            await _acommit_session(clone, session, start)
+        except (ConversationCancelled, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            _put({"event": "error", "data": {"message": str(e)}})
         finally:
-            main_loop.call_soon_threadsafe(queue.put_nowait, sentinel)
-            main_loop.call_soon_threadsafe(queue.put_nowait, None)  # 双重保险
+            pool.release(clone)
+            _put(sentinel)
 
-    asyncio.create_task(asyncio.to_thread(runner))
+    def _put(item) -> None:
+        try:
+            main_loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # loop 已关（客户端早已断开）
+            pass
+
+    native = native_async_enabled() and supports_native_async(inst)
+    task = asyncio.create_task(arunner() if native else asyncio.to_thread(runner))
 
     try:
         while True:
             item = await queue.get()
-            if item is sentinel or item is None:
+            if item is sentinel:
                 break
+            if token.cancelled:
+                # 取消前已经进了 queue 的事件不再下发，只等后台线程收尾
+                continue
             yield item
     finally:
-        # 还原 out
-        try:
-            inst.out = original_out
-        except Exception:
-            pass
-
-
-# ---------------------------------------------------------------------------
-# Token 计数：从最近的 usage 记录聚合
-# ---------------------------------------------------------------------------
-
-class _UsageAccumulator:
-    """聚合 LLM 调用的 token 计数（Agent 内部 self.usage 由调用方维护）"""
-
-    def __init__(self):
-        self.prompt_tokens = 0
-        self.completion_tokens = 0
-
-    def update(self, prompt: int, completion: int) -> None:
-        self.prompt_tokens += prompt or 0
-        self.completion_tokens += completion or 0
-
-    def total(self) -> int:
-        return self.prompt_tokens + self.completion_tokens
\ No newline at end of file
+        # 正常结束时 no-op；被提前关闭（客户端断开）时通知后台线程停下
+        token.cancel("stream closed")
+        if native:
+            task.cancel()
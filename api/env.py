@@ -0,0 +1,17 @@
+"""
+读环境变量配置的小工具：没设或为空时用默认值。
+"""
+
+from __future__ import annotations
+
+import os
+
+
+def env_int(name: str, default: int) -> int:
+    raw = os.getenv(name, "")
+    return int(raw) if raw else default
+
+
+def env_float(name: str, default: float) -> float:
+    raw = os.getenv(name, "")
+    return float(raw) if raw else default
@@ -0,0 +1,134 @@
+"""
+对话执行引擎：把同步阻塞的 ``conversation_with_tool`` 放到有界线程池里跑。
+
+为什么需要？
+
+``conversation_with_tool`` 是同步函数（LLM 往返 + 工具循环全在里面），
+直接在 ``async def`` 路由里调用会卡住整个 uvicorn event loop —— 同 worker 上的
+``/health``、其他 SSE 流全部跟着停。
+
+这里用一个**有界** ``ThreadPoolExecutor`` 承载所有非流式对话：
+
+- 线程数可配置（``CHAT_EXECUTOR_WORKERS``），不会因为突发请求无限开线程
+- 记录排队深度 / 运行中数量 / 排队等待时间，供 ``/health`` 和后续监控使用
+- 用 ``contextvars.copy_context()`` 把调用方的上下文带进工作线程
+
+环境变量::
+
+    CHAT_EXECUTOR_WORKERS   线程池大小（默认 min(32, CPU 数 + 4)）
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from .env import env_int
+from .models import ExecutorStats
+
+
+def _default_workers() -> int:
+    return max(1, env_int("CHAT_EXECUTOR_WORKERS", min(32, (os.cpu_count() or 1) + 4)))
+
+
+class ConversationExecutor:
+    """有界线程池 + 排队 / 等待时间统计。线程安全。"""
+
+    def __init__(self, max_workers: Optional[int] = None, name: str = "chat"):
+        self.max_workers = max_workers or _default_workers()
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix=f"ConversationExecutor-{name}",
+        )
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    async def run(self, fn: Callable[..., Any], /, *args: Any, **kwargs: Any) -> Any:
+        """在线程池里执行 ``fn(*args, **kwargs)``，await 其结果。"""
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        submitted_at = time.perf_counter()
+
+        def job():
+            self._on_start(time.perf_counter() - submitted_at)
+            ok = False
+            try:
+                result = ctx.run(fn, *args, **kwargs)
+                ok = True
+                return result
+            finally:
+                self._on_finish(ok)
+
+        with self._lock:
+            self._queued += 1
+        return await loop.run_in_executor(self._pool, job)
+
+    def _on_start(self, waited: float) -> None:
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._wait_total += waited
+            if waited > self._wait_max:
+                self._wait_max = waited
+
+    def _on_finish(self, ok: bool) -> None:
+        with self._lock:
+            self._running -= 1
+            if ok:
+                self._completed += 1
+            else:
+                self._failed += 1
+
+    def stats(self) -> ExecutorStats:
+        with self._lock:
+            started = self._completed + self._failed + self._running
+            return ExecutorStats(
+                max_workers=self.max_workers,
+                queued=self._queued,
+                running=self._running,
+                completed=self._completed,
+                failed=self._failed,
+                wait_seconds_total=self._wait_total,
+                wait_seconds_max=self._wait_max,
+                wait_seconds_avg=self._wait_total / started if started else 0.0,
+            )
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._pool.shutdown(wait=wait)
+
+
+# ---------------------------------------------------------------------------
+# 进程级单例（懒加载：测试里自建的 FastAPI app 不走 lifespan 也能用）
+# ---------------------------------------------------------------------------
+
+_default_executor: Optional[ConversationExecutor] = None
+_default_lock = threading.Lock()
+
+
+def get_executor() -> ConversationExecutor:
+    """返回进程级默认 ConversationExecutor"""
+    global _default_executor
+    if _default_executor is None:
+        with _default_lock:
+            if _default_executor is None:
+                _default_executor = ConversationExecutor()
+    return _default_executor
+
+
+def shutdown_executor(wait: bool = False) -> None:
+    """关闭默认 executor（lifespan 退出时调用；下次 get_executor 会重建）"""
+    global _default_executor
+    with _default_lock:
+        executor, _default_executor = _default_executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
@@ -0,0 +1,265 @@
+"""
+LLM 请求的 HTTP 连接池：按 provider origin 共享 keep-alive 连接，而不是每轮对话新建一个客户端。
+
+tangyuanAI 每次 LLM 调用都现构造一个 transport，transport 再 new 一个 ``HTTPClient``
+（``httpx.Client``）：每轮都要重新加载 CA 证书、建 TCP、握 TLS，用完即关。
+``ask_for_help`` 链上连续好几轮打同一个 provider，这些开销一轮不少。
+
+这里按 origin（``scheme://host:port``）各建一个进程级 ``httpx.Client``，计量 transport
+（``api/transport.py``）构造时直接拿它：
+
+- keep-alive / 最大连接数 / 空闲连接过期时间可配置；可选 HTTP/2 多路复用（需要 ``h2``）
+- ``httpx.Client`` 的连接池自带锁，多个对话线程共用同一个 client
+- 原生异步对话引擎（``api/async_engine.py``）走 ``async_client_for``：``httpx.AsyncClient`` 的连接绑定在
+  创建它的 event loop 上，所以按 ``(event loop, origin)`` 各建一个；统计与同步客户端合并在同一个 origin 下
+- 每个请求通过 httpcore 的 ``trace`` 扩展记录：是否新建连接、建连耗时、在池里等连接的时间
+  （发出请求头之前的耗时减去建连耗时），汇总到 ``/health`` 的 ``http_pool`` 和 Prometheus
+- ``LLM_RECORD_PATH`` / ``LLM_REPLAY_PATH`` 设了时，客户端的 transport 换成录制 / 回放版（``api/llm_replay.py``）
+
+环境变量::
+
+    LLM_HTTP_MAX_CONNECTIONS     每个 origin 的最大连接数（默认 100）
+    LLM_HTTP_MAX_KEEPALIVE       每个 origin 保留的空闲连接数（默认 20）
+    LLM_HTTP_KEEPALIVE_EXPIRY    空闲连接保留秒数（默认 30）
+    LLM_HTTP2                    1 时启用 HTTP/2（默认 0；没装 h2 时退回 HTTP/1.1）
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import threading
+import time
+import weakref
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+import httpx
+from tangyuanAI.http_utils import AsyncHTTPClient, HTTPClient
+
+from .env import env_float, env_int
+from .llm_replay import get_llm_replay
+from .metrics import LLM_HTTP_CONNECTIONS, LLM_HTTP_POOL_WAIT
+from .models import HttpOriginStats, HttpPoolStats
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def origin_of(url: str) -> str:
+    """``https://api.example.com/v1/chat`` → ``https://api.example.com:443``"""
+    parts = urlsplit(url)
+    scheme = (parts.scheme or "http").lower()
+    port = parts.port or _DEFAULT_PORTS.get(scheme)
+    return f"{scheme}://{(parts.hostname or '').lower()}:{port}"
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class _OriginStats:
+    __slots__ = ("requests", "new_connections", "connect_seconds", "wait_seconds_total", "wait_seconds_max")
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.connect_seconds = 0.0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+
+class HttpClientPool:
+    """``origin → HTTPClient``（共享一个带连接池的 ``httpx.Client``）；异步客户端另按 event loop 分开"""
+
+    def __init__(
+        self,
+        *,
+        max_connections: Optional[int] = None,
+        max_keepalive: Optional[int] = None,
+        keepalive_expiry: Optional[float] = None,
+        http2: Optional[bool] = None,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections or env_int("LLM_HTTP_MAX_CONNECTIONS", 100),
+            max_keepalive_connections=max_keepalive or env_int("LLM_HTTP_MAX_KEEPALIVE", 20),
+            keepalive_expiry=keepalive_expiry if keepalive_expiry is not None
+            else env_float("LLM_HTTP_KEEPALIVE_EXPIRY", 30.0),
+        )
+        if http2 is None:
+            http2 = os.getenv("LLM_HTTP2", "0").lower() in ("1", "true", "yes")
+        if http2 and not _http2_available():
+            logger.warning("LLM_HTTP2=1 但没有安装 h2，退回 HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        self._lock = threading.Lock()
+        self._clients: Dict[str, HTTPClient] = {}
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, AsyncHTTPClient]]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._stats: Dict[str, _OriginStats] = {}
+
+    def client_for(self, url: str) -> HTTPClient:
+        """该 URL 所在 origin 的共享客户端（第一次用到时创建）"""
+        origin = origin_of(url)
+        client = self._clients.get(origin)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(origin)
+            if client is None:
+                stats = self._stats.setdefault(origin, _OriginStats())
+                raw = httpx.Client(
+                    timeout=60.0,
+                    follow_redirects=True,
+                    limits=self.limits,
+                    http2=self.http2,
+                    event_hooks={"request": [self._tracer(origin, stats)]},
+                    transport=get_llm_replay().transport(self.limits, self.http2),
+                )
+                client = self._clients[origin] = HTTPClient(raw, default_timeout=60.0)
+        return client
+
+    def async_client_for(self, url: str) -> AsyncHTTPClient:
+        """当前 event loop 上、该 URL 所在 origin 的共享异步客户端（第一次用到时创建）"""
+        loop = asyncio.get_running_loop()
+        origin = origin_of(url)
+        clients = self._async_clients.get(loop)
+        client = clients.get(origin) if clients is not None else None
+        if client is not None:
+            return client
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, {})
+            client = clients.get(origin)
+            if client is None:
+                stats = self._stats.setdefault(origin, _OriginStats())
+                raw = httpx.AsyncClient(
+                    timeout=60.0,
+                    follow_redirects=True,
+                    limits=self.limits,
+                    http2=self.http2,
+                    event_hooks={"request": [self._async_tracer(origin, stats)]},
+                    transport=get_llm_replay().async_transport(self.limits, self.http2),
+                )
+                client = clients[origin] = AsyncHTTPClient(raw, default_timeout=60.0)
+        return client
+
+    def _tracer(self, origin: str, stats: _OriginStats) -> Callable[[httpx.Request], None]:
+        def on_request(request: httpx.Request) -> None:
+            request.extensions["trace"] = self._trace(origin, stats)
+
+        return on_request
+
+    def _async_tracer(self, origin: str, stats: _OriginStats) -> Callable[[httpx.Request], Awaitable[None]]:
+        # 异步接口下 httpx 的 event hook 和 httpcore 的 trace 回调都必须是协程函数
+        async def on_request(request: httpx.Request) -> None:
+            trace = self._trace(origin, stats)
+
+            async def atrace(event: str, info: dict) -> None:
+                trace(event, info)
+
+            request.extensions["trace"] = atrace
+
+        return on_request
+
+    def _trace(self, origin: str, stats: _OriginStats) -> Callable[[str, Dict[str, Any]], None]:
+        """一个请求的 httpcore trace 回调：区分新建 / 复用连接，记建连与等连接耗时"""
+        lock = self._lock
+        started = time.perf_counter()
+        state = {"connect": 0.0, "mark": 0.0, "new": False}
+
+        def trace(event: str, info: dict) -> None:
+            now = time.perf_counter()
+            if event in ("connection.connect_tcp.started", "connection.start_tls.started"):
+                state["mark"] = now
+            elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+                state["connect"] += now - state["mark"]
+                state["new"] = True
+            elif event.endswith("send_request_headers.started"):
+                wait = max(0.0, now - started - state["connect"])
+                with lock:
+                    stats.requests += 1
+                    stats.wait_seconds_total += wait
+                    stats.wait_seconds_max = max(stats.wait_seconds_max, wait)
+                    if state["new"]:
+                        stats.new_connections += 1
+                        stats.connect_seconds += state["connect"]
+                LLM_HTTP_CONNECTIONS.inc(origin, "new" if state["new"] else "reused")
+                LLM_HTTP_POOL_WAIT.observe(wait, origin)
+
+        return trace
+
+    def stats(self) -> HttpPoolStats:
+        with self._lock:
+            items = list(self._stats.items())
+            origins: List[HttpOriginStats] = []
+            for origin, s in items:
+                reused = max(0, s.requests - s.new_connections)
+                origins.append(HttpOriginStats(
+                    origin=origin,
+                    requests=s.requests,
+                    new_connections=s.new_connections,
+                    reused=reused,
+                    reuse_ratio=round(reused / s.requests, 4) if s.requests else 0.0,
+                    connect_seconds_total=round(s.connect_seconds, 6),
+                    wait_seconds_total=round(s.wait_seconds_total, 6),
+                    wait_seconds_max=round(s.wait_seconds_max, 6),
+                ))
+        return HttpPoolStats(
+            http2=self.http2,
+            max_connections=self.limits.max_connections,
+            max_keepalive=self.limits.max_keepalive_connections,
+            keepalive_expiry=self.limits.keepalive_expiry,
+            origins=origins,
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            # 异步客户端只能在自己的 loop 上关（见 ``aclose``）；这里只解除引用
+            self._async_clients.clear()
+        for client in clients:
+            try:
+                client.client.close()
+            except Exception:  # pragma: no cover
+                pass
+
+    async def aclose(self) -> None:
+        """关闭当前 event loop 上的异步客户端（lifespan 退出时在主 loop 上调用）"""
+        with self._lock:
+            clients = self._async_clients.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            try:
+                await client.client.aclose()
+            except Exception:  # pragma: no cover
+                pass
+
+
+_pool: Optional[HttpClientPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_http_pool() -> HttpClientPool:
+    """返回进程级 HttpClientPool"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = HttpClientPool()
+    return _pool
+
+
+def shutdown_http_pool() -> None:
+    """关闭所有共享连接（lifespan 退出时调用）"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
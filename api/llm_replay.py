@@ -0,0 +1,449 @@
+"""
+LLM 请求的录制 / 回放：把真实对话里发给 provider 的请求和原样的流式响应（带时间）录进一个文件，
+之后不连 provider、按原速 / 加速 / 零延迟重放，离线、可重复地压测 Agent 循环、工具执行和 API 层。
+
+录制 / 回放都在 HTTP 层：共享连接池（``api/http_pool.py``）建客户端时换上 ``RecordingTransport`` /
+``ReplayTransport``（``httpx`` 的 transport 接口），上层的计量 transport、SSE 解析、对话循环完全照常运行。
+只有走共享连接池的请求（``AgentPool`` 派生的副本）会被录制 / 回放。
+
+文件格式：每行一条 JSON（路径以 ``.gz`` 结尾时 gzip 压缩），一次请求一条::
+
+    {"fp": 请求指纹, "method": "POST", "url": 不带 query 的 URL, "model": ..., "status": 200,
+     "headers": {"content-type": ...}, "ttfb": 收到响应头的秒数,
+     "body": 响应体原文（非 UTF-8 时改存 "body_b64"）, "chunks": [[到达秒数, 结束字节偏移], ...]}
+
+- 请求指纹是 method + URL 路径 + 规范化请求体（JSON 按 key 排序）的 SHA-256；请求头（API key）和 query 不落盘
+- 回放先按指纹找，同一指纹录了多次时依次轮换；找不到时（如系统提示里带了时间）按录制顺序取同一 URL 的下一条，
+  ``LLM_REPLAY_STRICT=1`` 时改为报错（``ReplayMissError``，按 HTTP 请求失败处理）
+- ``LLM_REPLAY_SPEED``：``1`` 按原始间隔，``N`` 快 N 倍，``0`` 不等待
+
+环境变量::
+
+    LLM_RECORD_PATH     录制到这个文件（追加写）
+    LLM_REPLAY_PATH     从这个文件回放（同时设了两个时只回放）
+    LLM_REPLAY_SPEED    回放速度倍数（默认 1；0 为零延迟）
+    LLM_REPLAY_STRICT   1 时指纹对不上直接报错（默认 0）
+"""
+
+from __future__ import annotations
+
+import asyncio
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import IO, Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit
+
+import httpx
+
+from .env import env_float
+
+logger = logging.getLogger(__name__)
+
+# 录进文件的响应头（其余如 set-cookie、请求 id 不要）
+_KEPT_HEADERS = ("content-type", "content-encoding")
+
+
+class ReplayMissError(httpx.TransportError):
+    """回放文件里没有与请求对应的录制"""
+
+
+def _open(path: str, mode: str) -> IO[bytes]:
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)  # type: ignore[return-value]
+    return open(path, mode)
+
+
+def _url(request: httpx.Request) -> str:
+    parts = urlsplit(str(request.url))
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, "", ""))
+
+
+def fingerprint(method: str, url: str, body: bytes) -> str:
+    """请求指纹：method + URL 路径 + 规范化请求体"""
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode()
+    except ValueError:
+        pass
+    digest = hashlib.sha256(f"{method} {urlsplit(url).path}\n".encode())
+    digest.update(body)
+    return digest.hexdigest()[:32]
+
+
+def _model_of(body: bytes) -> Optional[str]:
+    try:
+        model = json.loads(body).get("model")
+    except (ValueError, AttributeError):
+        return None
+    return model if isinstance(model, str) else None
+
+
+class Exchange:
+    """一次录下来的请求 / 响应"""
+
+    __slots__ = ("fp", "method", "url", "model", "status", "headers", "ttfb", "body", "chunks")
+
+    def __init__(self, fp: str, method: str, url: str, model: Optional[str], status: int,
+                 headers: Dict[str, str], ttfb: float, body: bytes, chunks: List[Tuple[float, int]]):
+        self.fp = fp
+        self.method = method
+        self.url = url
+        self.model = model
+        self.status = status
+        self.headers = headers
+        self.ttfb = ttfb
+        self.body = body
+        self.chunks = chunks
+
+    def to_json(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {
+            "fp": self.fp, "method": self.method, "url": self.url, "model": self.model,
+            "status": self.status, "headers": self.headers, "ttfb": round(self.ttfb, 6),
+        }
+        try:
+            data["body"] = self.body.decode("utf-8")
+        except UnicodeDecodeError:
+            data["body_b64"] = base64.b64encode(self.body).decode("ascii")
+        data["chunks"] = [[round(t, 6), end] for t, end in self.chunks]
+        return data
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "Exchange":
+        if "body_b64" in data:
+            body = base64.b64decode(data["body_b64"])
+        else:
+            body = data.get("body", "").encode("utf-8")
+        chunks = [(float(t), int(end)) for t, end in data.get("chunks") or ()]
+        return cls(data["fp"], data.get("method", "POST"), data.get("url", ""), data.get("model"),
+                   int(data.get("status", 200)), dict(data.get("headers") or {}),
+                   float(data.get("ttfb", 0.0)), body, chunks or [(float(data.get("ttfb", 0.0)), len(body))])
+
+
+# ---------------------------------------------------------------------------
+# 录制
+# ---------------------------------------------------------------------------
+
+class Recorder:
+    """把完成的请求 / 响应逐条追加到文件"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._file: Optional[IO[bytes]] = None
+
+    def write(self, exchange: Exchange) -> None:
+        line = json.dumps(exchange.to_json(), ensure_ascii=False).encode("utf-8") + b"\n"
+        with self._lock:
+            if self._file is None:
+                self._file = _open(self.path, "ab")
+            self._file.write(line)
+            self._file.flush()
+            self.recorded += 1
+
+    def close(self) -> None:
+        with self._lock:
+            file, self._file = self._file, None
+        if file is not None:
+            file.close()
+
+
+class _Capture:
+    """边把响应体交给上层边记下每块的到达时间；流读完或关闭时写一条录制"""
+
+    def __init__(self, recorder: Recorder, request: httpx.Request, response: httpx.Response, started: float):
+        body = request.content
+        self.recorder = recorder
+        self.started = started
+        self.parts: List[bytes] = []
+        self.chunks: List[Tuple[float, int]] = []
+        self.size = 0
+        self.done = False
+        url = _url(request)
+        self.exchange = Exchange(
+            fingerprint(request.method, url, body), request.method, url, _model_of(body), response.status_code,
+            {k: response.headers[k] for k in _KEPT_HEADERS if k in response.headers},
+            time.perf_counter() - started, b"", self.chunks,
+        )
+
+    def add(self, chunk: bytes) -> None:
+        self.parts.append(chunk)
+        self.size += len(chunk)
+        self.chunks.append((time.perf_counter() - self.started, self.size))
+
+    def finish(self) -> None:
+        if self.done:
+            return
+        self.done = True
+        self.exchange.body = b"".join(self.parts)
+        self.recorder.write(self.exchange)
+
+
+class _RecordingStream(httpx.SyncByteStream):
+    def __init__(self, stream: Any, capture: _Capture):
+        self._stream = stream
+        self._capture = capture
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self._stream:
+            self._capture.add(chunk)
+            yield chunk
+
+    def close(self) -> None:
+        try:
+            self._stream.close()
+        finally:
+            self._capture.finish()
+
+
+class _AsyncRecordingStream(httpx.AsyncByteStream):
+    def __init__(self, stream: Any, capture: _Capture):
+        self._stream = stream
+        self._capture = capture
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            self._capture.add(chunk)
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            self._capture.finish()
+
+
+class RecordingTransport(httpx.BaseTransport):
+    """把请求交给真正的 transport，响应原样返回，同时录下来"""
+
+    def __init__(self, inner: httpx.BaseTransport, recorder: Recorder):
+        self._inner = inner
+        self._recorder = recorder
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        request.read()
+        response = self._inner.handle_request(request)
+        capture = _Capture(self._recorder, request, response, started)
+        return httpx.Response(
+            response.status_code, headers=response.headers,
+            stream=_RecordingStream(response.stream, capture), extensions=response.extensions,
+        )
+
+    def close(self) -> None:
+        self._inner.close()
+
+
+class AsyncRecordingTransport(httpx.AsyncBaseTransport):
+    def __init__(self, inner: httpx.AsyncBaseTransport, recorder: Recorder):
+        self._inner = inner
+        self._recorder = recorder
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        await request.aread()
+        response = await self._inner.handle_async_request(request)
+        capture = _Capture(self._recorder, request, response, started)
+        return httpx.Response(
+            response.status_code, headers=response.headers,
+            stream=_AsyncRecordingStream(response.stream, capture), extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+
+# ---------------------------------------------------------------------------
+# 回放
+# ---------------------------------------------------------------------------
+
+class Cassette:
+    """加载好的录制文件：按指纹 / 按 URL 顺序取录制，线程安全"""
+
+    def __init__(self, exchanges: List[Exchange], strict: bool = False):
+        self.exchanges = exchanges
+        self.strict = strict
+        self.replayed = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._by_fp: Dict[str, List[Exchange]] = {}
+        self._by_url: Dict[str, List[Exchange]] = {}
+        self._cursors: Dict[Tuple[str, str], int] = {}
+        for exchange in exchanges:
+            self._by_fp.setdefault(exchange.fp, []).append(exchange)
+            self._by_url.setdefault(exchange.url, []).append(exchange)
+
+    @classmethod
+    def load(cls, path: str, strict: bool = False) -> "Cassette":
+        exchanges: List[Exchange] = []
+        with _open(path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    exchanges.append(Exchange.from_json(json.loads(line)))
+        return cls(exchanges, strict)
+
+    def _next(self, kind: str, key: str, candidates: List[Exchange]) -> Exchange:
+        i = self._cursors.get((kind, key), 0)
+        self._cursors[(kind, key)] = i + 1
+        return candidates[i % len(candidates)]
+
+    def lookup(self, request: httpx.Request) -> Exchange:
+        url = _url(request)
+        fp = fingerprint(request.method, url, request.content)
+        with self._lock:
+            self.replayed += 1
+            candidates = self._by_fp.get(fp)
+            if candidates:
+                return self._next("fp", fp, candidates)
+            self.misses += 1
+            candidates = None if self.strict else self._by_url.get(url)
+            if candidates:
+                if self.misses == 1:
+                    logger.warning("回放：请求指纹没有录制（%s），按录制顺序取同一 URL 的下一条", url)
+                return self._next("url", url, candidates)
+        raise ReplayMissError(f"回放文件里没有这个请求的录制：{request.method} {url}（指纹 {fp}）", request=request)
+
+
+def _delays(exchange: Exchange, speed: float) -> Iterator[Tuple[float, bytes]]:
+    """``(相对请求开始的到达时间, 数据块)``；``speed`` 为 0 时时间全为 0"""
+    start = 0
+    for t, end in exchange.chunks:
+        yield (t / speed if speed > 0 else 0.0), exchange.body[start:end]
+        start = end
+    if start < len(exchange.body):
+        yield 0.0, exchange.body[start:]
+
+
+class _ReplayStream(httpx.SyncByteStream):
+    def __init__(self, exchange: Exchange, speed: float, started: float):
+        self._exchange = exchange
+        self._speed = speed
+        self._started = started
+
+    def __iter__(self) -> Iterator[bytes]:
+        for at, chunk in _delays(self._exchange, self._speed):
+            wait = at - (time.perf_counter() - self._started)
+            if wait > 0:
+                time.sleep(wait)
+            yield chunk
+
+
+class _AsyncReplayStream(httpx.AsyncByteStream):
+    def __init__(self, exchange: Exchange, speed: float, started: float):
+        self._exchange = exchange
+        self._speed = speed
+        self._started = started
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for at, chunk in _delays(self._exchange, self._speed):
+            wait = at - (time.perf_counter() - self._started)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            yield chunk
+
+
+class ReplayTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """不连 provider，按录制文件回放响应（同步 / 异步客户端共用）"""
+
+    def __init__(self, cassette: Cassette, speed: float = 1.0):
+        self.cassette = cassette
+        self.speed = max(0.0, speed)
+
+    def _ttfb(self, exchange: Exchange) -> float:
+        return exchange.ttfb / self.speed if self.speed > 0 else 0.0
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        request.read()
+        exchange = self.cassette.lookup(request)
+        wait = self._ttfb(exchange)
+        if wait > 0:
+            time.sleep(wait)
+        return httpx.Response(exchange.status, headers=exchange.headers,
+                              stream=_ReplayStream(exchange, self.speed, started))
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        await request.aread()
+        exchange = self.cassette.lookup(request)
+        wait = self._ttfb(exchange)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return httpx.Response(exchange.status, headers=exchange.headers,
+                              stream=_AsyncReplayStream(exchange, self.speed, started))
+
+
+# ---------------------------------------------------------------------------
+# 进程级开关（共享连接池建客户端时调用）
+# ---------------------------------------------------------------------------
+
+class LLMReplay:
+    """按环境变量决定录制还是回放；``transport`` / ``async_transport`` 返回 None 表示照常连 provider"""
+
+    def __init__(self, record_path: Optional[str] = None, replay_path: Optional[str] = None,
+                 speed: Optional[float] = None, strict: Optional[bool] = None):
+        record_path = record_path if record_path is not None else os.getenv("LLM_RECORD_PATH", "")
+        replay_path = replay_path if replay_path is not None else os.getenv("LLM_REPLAY_PATH", "")
+        if speed is None:
+            speed = env_float("LLM_REPLAY_SPEED", 1.0)
+        if strict is None:
+            strict = os.getenv("LLM_REPLAY_STRICT", "0").lower() in ("1", "true", "yes")
+        if record_path and replay_path:
+            logger.warning("同时设了 LLM_RECORD_PATH 和 LLM_REPLAY_PATH，只回放")
+            record_path = ""
+        self.path = replay_path or record_path
+        self.recorder = Recorder(record_path) if record_path else None
+        self.replayer = ReplayTransport(Cassette.load(replay_path, strict), speed) if replay_path else None
+
+    @property
+    def mode(self) -> str:
+        if self.replayer is not None:
+            return "replay"
+        return "record" if self.recorder is not None else "off"
+
+    def transport(self, limits: httpx.Limits, http2: bool) -> Optional[httpx.BaseTransport]:
+        if self.replayer is not None:
+            return self.replayer
+        if self.recorder is not None:
+            return RecordingTransport(httpx.HTTPTransport(limits=limits, http2=http2), self.recorder)
+        return None
+
+    def async_transport(self, limits: httpx.Limits, http2: bool) -> Optional[httpx.AsyncBaseTransport]:
+        if self.replayer is not None:
+            return self.replayer
+        if self.recorder is not None:
+            return AsyncRecordingTransport(httpx.AsyncHTTPTransport(limits=limits, http2=http2), self.recorder)
+        return None
+
+    def close(self) -> None:
+        if self.recorder is not None:
+            self.recorder.close()
+
+
+_replay: Optional[LLMReplay] = None
+_replay_lock = threading.Lock()
+
+
+def get_llm_replay() -> LLMReplay:
+    """返回进程级 LLMReplay（第一次调用时按环境变量加载回放文件）"""
+    global _replay
+    if _replay is None:
+        with _replay_lock:
+            if _replay is None:
+                _replay = LLMReplay()
+                if _replay.mode != "off":
+                    logger.info("LLM 请求%s：%s", "回放" if _replay.mode == "replay" else "录制", _replay.path)
+    return _replay
+
+
+def shutdown_llm_replay() -> None:
+    global _replay
+    with _replay_lock:
+        replay, _replay = _replay, None
+    if replay is not None:
+        replay.close()
@@ -0,0 +1,301 @@
+"""
+Prometheus 指标：``GET /metrics`` 的文本格式导出 + 热路径上的采集。
+
+采集点：
+
+- **TTFT**（``aicompany_chat_ttft_seconds``）：对话开始 → 发起方 Agent 的第一个文本 token
+  （计量 transport 里标记，见 ``api/transport.py``）
+- **对话耗时**（``aicompany_chat_duration_seconds``）：按结果 ok / error / cancelled 分
+- **每次对话的 LLM 调用数**（``aicompany_chat_llm_calls``）：含工具续轮和 ask_for_help 子调用
+- **工具执行耗时**（``aicompany_tool_duration_seconds``）：``ContextToolRunner`` 里计时
+- **ask_for_help 深度 / 扇出**（``aicompany_ask_for_help_depth`` / ``aicompany_ask_for_help_fanout``）
+- **LLM 连接复用 / 连接池等待**（``aicompany_llm_http_requests_total`` / ``aicompany_llm_http_pool_wait_seconds``，
+  见 ``api/http_pool.py``）
+- **SSE 帧数**（``aicompany_sse_frames_total``）、**进行中的对话**（``aicompany_chat_in_flight``）、
+  **准入排队时间**（``aicompany_chat_queue_wait_seconds``）
+
+为什么不用 prometheus_client？项目没有这个依赖，而这里需要的只是 counter / gauge / histogram
+三种类型和文本导出格式。采集路径要能一直开在生产上：
+
+- 桶边界预先定好，``observe`` 是一次 ``bisect`` + 两次整数加法
+- 无锁：每个线程写自己的分片（只有本线程写），导出时把各分片加总；
+  只在某线程第一次写某个指标时注册分片要拿一次锁
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .cancellation import ConversationCancelled
+
+Labels = Tuple[str, ...]
+
+_LE_INF = 'le="+Inf"'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    """按线程分片的指标基类：``_row(labels)`` 返回本线程的可变行"""
+
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):  # noqa: A002
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[Dict[Labels, list]] = []
+        self._shards_lock = threading.Lock()
+
+    def _new_row(self) -> list:
+        return [0]
+
+    def _row(self, labels: Labels) -> list:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+        row = shard.get(labels)
+        if row is None:
+            row = shard[labels] = self._new_row()
+        return row
+
+    def _merged(self) -> Dict[Labels, list]:
+        with self._shards_lock:
+            shards = list(self._shards)
+        merged: Dict[Labels, list] = {}
+        for shard in shards:
+            for labels, row in list(shard.items()):
+                acc = merged.get(labels)
+                if acc is None:
+                    merged[labels] = list(row)
+                else:
+                    for i, v in enumerate(row):
+                        acc[i] += v
+        return merged
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, row in sorted(self._merged().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(row[0])}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._row(labels)[0] += amount
+
+
+class Gauge(_Metric):
+    """可增可减；各线程分片相加即当前值（inc / dec 可以发生在不同线程）"""
+
+    kind = "gauge"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._row(labels)[0] += amount
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self._row(labels)[0] -= amount
+
+
+class Histogram(_Metric):
+    """预分桶直方图：行 = [各桶计数..., +Inf 桶计数, sum]"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float], labelnames: Sequence[str] = ()):  # noqa: A002
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_row(self) -> list:
+        return [0] * (len(self.buckets) + 2)
+
+    def observe(self, value: float, *labels: str) -> None:
+        row = self._row(labels)
+        row[bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        n = len(self.buckets)
+        for labels, row in sorted(self._merged().items()):
+            cumulative = 0
+            for i, bound in enumerate(self.buckets):
+                cumulative += row[i]
+                le = _format_labels(self.labelnames, labels, f'le="{_format_value(float(bound))}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            cumulative += row[n]
+            inf = _format_labels(self.labelnames, labels, _LE_INF)
+            lines.append(f"{self.name}_bucket{inf} {cumulative}")
+            plain = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{plain} {_format_value(float(row[-1]))}")
+            lines.append(f"{self.name}_count{plain} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+CHAT_TTFT = REGISTRY.register(Histogram(
+    "aicompany_chat_ttft_seconds", "对话开始到第一个文本 token 的时间",
+    (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30), ("agent",),
+))
+CHAT_DURATION = REGISTRY.register(Histogram(
+    "aicompany_chat_duration_seconds", "整个对话（含工具与子 Agent）的耗时",
+    (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300), ("agent", "outcome"),
+))
+CHAT_LLM_CALLS = REGISTRY.register(Histogram(
+    "aicompany_chat_llm_calls", "每次对话的 LLM 调用次数（含工具续轮与 ask_for_help 子调用）",
+    (1, 2, 3, 4, 6, 8, 12, 16, 24, 32), ("agent",),
+))
+CHAT_QUEUE_WAIT = REGISTRY.register(Histogram(
+    "aicompany_chat_queue_wait_seconds", "chat 请求在准入队列里的等待时间",
+    (0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30), ("agent",),
+))
+CHAT_IN_FLIGHT = REGISTRY.register(Gauge(
+    "aicompany_chat_in_flight", "正在进行的对话数", ("agent",),
+))
+TOOL_DURATION = REGISTRY.register(Histogram(
+    "aicompany_tool_duration_seconds", "工具执行耗时",
+    (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30), ("tool",),
+))
+TOOL_TIMEOUTS = REGISTRY.register(Counter(
+    "aicompany_tool_timeouts_total", "超过自己 timeout 的工具调用（按工具错误返回给模型）", ("tool", "executor"),
+))
+TOOL_SPECULATION = REGISTRY.register(Counter(
+    "aicompany_tool_speculation_total", "流式阶段投机启动的工具执行（started / used / wasted / skipped）",
+    ("tool", "result"),
+))
+TOOL_BATCH_SIZE = REGISTRY.register(Histogram(
+    "aicompany_tool_batch_size", "一轮工具调用里一起并发执行的调用数",
+    (1, 2, 3, 4, 6, 8, 12, 16),
+))
+TOOL_CACHE = REGISTRY.register(Counter(
+    "aicompany_tool_cache_total", "工具结果缓存的查找结果（hit / miss / coalesced / evicted）",
+    ("tool", "result"),
+))
+ASK_FOR_HELP_DEPTH = REGISTRY.register(Histogram(
+    "aicompany_ask_for_help_depth", "ask_for_help 子调用所处的调用链深度",
+    (1, 2, 3, 4, 5, 6, 7, 8),
+))
+ASK_FOR_HELP_FANOUT = REGISTRY.register(Histogram(
+    "aicompany_ask_for_help_fanout", "每次对话发出的 ask_for_help 次数（含嵌套）",
+    (0, 1, 2, 4, 8, 16), ("agent",),
+))
+SSE_FRAMES = REGISTRY.register(Counter(
+    "aicompany_sse_frames_total", "已发送的 SSE 帧数", ("agent", "event"),
+))
+LLM_HTTP_CONNECTIONS = REGISTRY.register(Counter(
+    "aicompany_llm_http_requests_total", "发往 LLM provider 的 HTTP 请求（按是否新建连接分）",
+    ("origin", "connection"),
+))
+LLM_HTTP_POOL_WAIT = REGISTRY.register(Histogram(
+    "aicompany_llm_http_pool_wait_seconds", "LLM 请求在连接池里等连接的时间（不含建连）",
+    (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5), ("origin",),
+))
+
+
+# ---------------------------------------------------------------------------
+# 单次对话的采集上下文
+# ---------------------------------------------------------------------------
+
+# ConversationMetrics 计数的累加：ask_many 扇出时同一对话的多个子调用在不同线程里发请求
+_count_lock = threading.Lock()
+
+
+class ConversationMetrics:
+    """一次 chat 对话的计数；嵌套的 ask_for_help 子调用在同一 context 里，记到同一份"""
+
+    __slots__ = ("agent", "started", "first_token", "llm_calls", "delegations")
+
+    def __init__(self, agent: str):
+        self.agent = agent
+        self.started = time.perf_counter()
+        self.first_token = False
+        self.llm_calls = 0
+        self.delegations = 0
+
+    def count_llm_call(self) -> None:
+        with _count_lock:
+            self.llm_calls += 1
+
+    def count_delegation(self) -> None:
+        with _count_lock:
+            self.delegations += 1
+
+    def mark_first_token(self) -> None:
+        if not self.first_token:
+            self.first_token = True
+            CHAT_TTFT.observe(time.perf_counter() - self.started, self.agent)
+
+
+current_conversation: contextvars.ContextVar[Optional[ConversationMetrics]] = contextvars.ContextVar(
+    "current_conversation", default=None,
+)
+
+
+@contextmanager
+def track_conversation(agent: str) -> Iterator[ConversationMetrics]:
+    """包住一次对话：计 in-flight、耗时、结果、LLM 调用数、ask_for_help 扇出"""
+    conv = ConversationMetrics(agent)
+    token = current_conversation.set(conv)
+    CHAT_IN_FLIGHT.inc(agent)
+    outcome = "ok"
+    try:
+        yield conv
+    except (ConversationCancelled, asyncio.CancelledError):
+        # 原生异步引擎里对话被取消是 CancelledError
+        outcome = "cancelled"
+        raise
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        CHAT_IN_FLIGHT.dec(agent)
+        current_conversation.reset(token)
+        CHAT_DURATION.observe(time.perf_counter() - conv.started, agent, outcome)
+        CHAT_LLM_CALLS.observe(conv.llm_calls, agent)
+        ASK_FOR_HELP_FANOUT.observe(conv.delegations, agent)
+
+
+def render_metrics() -> str:
+    return REGISTRY.render()
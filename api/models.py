@@ -17,11 +17,109 @@ from pydantic import BaseModel, Field
 # /health
 # ---------------------------------------------------------------------------
 
+class ExecutorStats(BaseModel):
+    """非流式对话线程池的运行状态"""
+    max_workers: int
+    queued: int = 0                          # 已提交、尚未拿到线程
+    running: int = 0
+    completed: int = 0
+    failed: int = 0
+    wait_seconds_total: float = 0.0          # 累计排队等待时间
+    wait_seconds_max: float = 0.0
+    wait_seconds_avg: float = 0.0
+
+
+class AdmissionStats(BaseModel):
+    """chat 准入控制的运行状态"""
+    max_concurrency: int
+    max_per_agent: int
+    max_queue: int
+    active: int = 0                          # 正在进行的对话
+    waiting: int = 0                         # 排队中
+    admitted: int = 0
+    rejected: int = 0                        # 队列满被 429 拒绝
+    timed_out: int = 0                       # 排队超时被 503 拒绝
+    wait_seconds_total: float = 0.0
+    wait_seconds_max: float = 0.0
+
+
+class SessionStats(BaseModel):
+    """服务端会话存储的运行状态"""
+    max_sessions: int
+    idle_ttl: float
+    max_bytes: int                           # 单会话字节上限
+    spill: bool = False                      # 是否落盘到 append-only 日志
+    sessions: int = 0                        # 内存中的会话数
+    bytes: int = 0                           # 内存中会话历史的总字节数
+    evicted: int = 0                         # 被 LRU 淘汰
+    expired: int = 0                         # 空闲超时淘汰
+    trimmed: int = 0                         # 因字节上限丢掉的消息条数
+    restored: int = 0                        # 从日志重放的次数
+
+
+class HttpOriginStats(BaseModel):
+    """一个 provider origin 的连接复用情况"""
+    origin: str
+    requests: int = 0
+    new_connections: int = 0
+    reused: int = 0
+    reuse_ratio: float = 0.0
+    connect_seconds_total: float = 0.0       # 新建连接（TCP + TLS）累计耗时
+    wait_seconds_total: float = 0.0          # 在连接池里等连接的累计时间
+    wait_seconds_max: float = 0.0
+
+
+class HttpPoolStats(BaseModel):
+    """LLM 请求共享连接池的配置与统计"""
+    http2: bool = False
+    max_connections: Optional[int] = None
+    max_keepalive: Optional[int] = None
+    keepalive_expiry: Optional[float] = None
+    origins: List[HttpOriginStats] = Field(default_factory=list)
+
+
+class ToolCacheEntryStats(BaseModel):
+    """一个工具的结果缓存命中情况"""
+    tool: str
+    entries: int = 0
+    bytes: int = 0
+    hits: int = 0
+    misses: int = 0
+    coalesced: int = 0                       # 并发的相同调用合并成一次执行（single-flight）
+    evicted: int = 0                         # 按条数 / 字节上限淘汰
+    hit_ratio: float = 0.0
+
+
+class ToolCacheStats(BaseModel):
+    """声明了 ``cache=`` 的工具的结果缓存（``api/tool_memo.py``）"""
+    max_bytes: int
+    entries: int = 0
+    bytes: int = 0
+    tools: List[ToolCacheEntryStats] = Field(default_factory=list)
+
+
+class ProviderStatus(BaseModel):
+    """一个 LLM provider（endpoint + key 指纹）的连通性探测结果"""
+    endpoint: str
+    key: Optional[str] = None                # API key 的 sha256 前 12 位
+    status: Literal["ok", "down", "unknown"] = "unknown"
+    agents: List[str] = Field(default_factory=list)
+    latency_ms: Optional[float] = None
+    age_seconds: Optional[float] = None      # 距上次探测的秒数
+    error: Optional[str] = None
+
+
 class HealthResponse(BaseModel):
     status: Literal["ok", "degraded"]
     version: str
     n_agents: int
     n_tools: int
+    executor: Optional[ExecutorStats] = None
+    admission: Optional[AdmissionStats] = None
+    sessions: Optional[SessionStats] = None
+    providers: List[ProviderStatus] = Field(default_factory=list)
+    http_pool: Optional[HttpPoolStats] = None
+    tool_cache: Optional[ToolCacheStats] = None
 
 
 # ---------------------------------------------------------------------------
@@ -37,6 +135,7 @@ class AgentInfo(BaseModel):
     api_provider: Optional[str] = None
     model_name: Optional[str] = None
     fc_model: bool = False
+    active: bool = True                       # False：惰性模式下尚未激活的模板
 
 
 class AgentListResponse(BaseModel):
@@ -77,6 +176,8 @@ class ChatRequest(BaseModel):
         images             多模态图片 URL 列表（仅最后一条 user 消息生效）
         tool               True 表示由 ask_for_help 内部递归调用，不要再加 user 消息
         extra_kwargs       透传给 conversation_with_tool 的额外参数
+        session_id         服务端会话 ID：带上后服务端保存历史，续聊只需发新的 user 消息；
+                           首次使用时，最后一条 user 之前的非 system 消息作为初始历史
     """
     messages: List[ChatMessage] = Field(..., min_length=1)
 
@@ -89,6 +190,7 @@ class ChatRequest(BaseModel):
     images: Optional[List[str]] = None
     tool: bool = False
     extra_kwargs: Optional[Dict[str, Any]] = None
+    session_id: Optional[str] = Field(default=None, min_length=1, max_length=128)
 
 
 class ChatChoice(BaseModel):
@@ -115,6 +217,67 @@ class ChatResponse(BaseModel):
     usage: ChatUsage = Field(default_factory=ChatUsage)
     agent_name: str
     agent_uuid: str
+    session_id: Optional[str] = None
+
+
+class BatchChatItem(BaseModel):
+    """批量对话里的一条输入：``messages`` 同 ChatRequest，只取最后一条 user 消息"""
+    id: Optional[str] = Field(default=None, max_length=128)   # 调用方自定义 ID，原样回传
+    messages: List[ChatMessage] = Field(..., min_length=1)
+    images: Optional[List[str]] = None
+
+
+class BatchChatRequest(BaseModel):
+    """
+    ``POST /agents/{name_or_uuid}/chat:batch`` 的请求。
+
+        items         输入列表，每条独立跑在一份 Agent 副本上
+        concurrency   同时跑的条数（默认 ``CHAT_BATCH_CONCURRENCY``，不超过单 Agent 并发上限）
+        tool          同 ChatRequest.tool，作用于每一条
+    """
+    items: List[BatchChatItem] = Field(..., min_length=1, max_length=1000)
+    concurrency: Optional[int] = Field(default=None, ge=1, le=256)
+    tool: bool = False
+
+
+class BatchChatResult(BaseModel):
+    """NDJSON 的一行：一条输入的结果，按完成顺序输出"""
+    index: int                               # 在 items 里的下标
+    id: Optional[str] = None
+    content: Optional[str] = None            # 出错时为 None
+    usage: ChatUsage = Field(default_factory=ChatUsage)
+    error: Optional[str] = None
+    status_code: int = 200                   # 出错时同单条 chat 的状态码（429 / 502 / 503 / 500）
+    elapsed_ms: float = 0.0                  # 含准入排队
+
+
+class SessionInfo(BaseModel):
+    """单个服务端会话的内容"""
+    session_id: str
+    agent_name: str
+    agent_uuid: str
+    messages: List[Dict[str, Any]]
+    total: int
+
+
+# ---------------------------------------------------------------------------
+# /usage —— 按 Agent × 模型汇总的 token 账本
+# ---------------------------------------------------------------------------
+
+class UsageLedgerEntry(BaseModel):
+    agent: str
+    model: str
+    calls: int = 0                           # LLM 调用次数
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+
+
+class UsageLedgerResponse(BaseModel):
+    entries: List[UsageLedgerEntry]
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
 
 
 # ---------------------------------------------------------------------------
@@ -127,6 +290,7 @@ class StreamChunk(BaseModel):
         "text",       # 文本增量
         "tool_call",  # 工具调用
         "tool_result",  # 工具返回
+        "usage",      # 本次对话的 token 用量（收尾前一帧）
         "done",       # 收尾
         "error",      # 错误
     ]
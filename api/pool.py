@@ -0,0 +1,165 @@
+"""
+Agent 实例池：每个请求拿一份**独立的轻量副本**，而不是共享 ``agent_list`` 里的单例。
+
+为什么？
+
+``agent_list`` 里每个 Agent 只有一个实例。以前流式端点靠 monkey-patch 单例的
+``out`` 把事件推给 SSE，结束后再还原 —— 同一个 Agent 的并发请求会：
+
+1. 互相覆盖 ``out``，事件串到别人的流里
+2. 共用一个 ``history``，对话上下文彼此污染
+
+这里的策略：
+
+- 注册的实例只当**模板**（prompt / 工具 / 钩子都已在 ``__init__`` 里建好）
+- ``acquire`` 用 ``copy.copy`` 派生一个副本：共享只读配置，独享 ``history`` /
+  ``out`` / ``current_task_id`` 等会话状态
+- 不重新跑 ``__init__``：不重建 prompt、不起连通性测试线程，派生成本是 O(属性数)
+- 派生时给副本装上计量 transport（``api/transport.py``）、带 context 的工具执行 /
+  ``ask_for_help``（``api/delegation.py``）、预编译的工具 schema（``api/tool_schemas.py``）和
+  一轮内并发的工具调用（``api/tool_dispatch.py``）；模板本身不动
+- ``release`` 后副本重置会话状态、回到空闲列表，供下个请求复用
+
+副本的 ``history`` 只带模板当前的 system prompt。prompt 由 ``api/prompts.py`` 按段缓存：
+注册表变化后，新派生 / 复用的副本自动拿到新的 system prompt，不需要逐个 ``reload()`` 模板。
+"""
+
+from __future__ import annotations
+
+import copy
+import threading
+import weakref
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from .delegation import install_delegation
+from .prompts import get_prompt_builder
+from .speculation import install_speculation
+from .tool_dispatch import install_parallel_tools
+from .tool_schemas import install_tool_cache
+from .transport import install_metering
+from .xml_calls import install_xml_calls
+
+# 每个模板最多保留多少个空闲副本
+DEFAULT_MAX_IDLE = 8
+
+
+def _system_history(template: Any) -> List[dict]:
+    """取模板 history 里的 system 消息（副本的初始 history）"""
+    history = getattr(template, "history", None) or []
+    if history and isinstance(history[0], dict) and history[0].get("role") == "system":
+        return [dict(history[0])]
+    return []
+
+
+class AgentPool:
+    """按模板派生 / 复用 Agent 副本。线程安全。"""
+
+    def __init__(self, max_idle_per_agent: int = DEFAULT_MAX_IDLE):
+        self.max_idle_per_agent = max_idle_per_agent
+        self._lock = threading.Lock()
+        # 模板被 unregister / 重新注册后，旧模板的空闲副本随之回收（副本只弱引用模板，不会反过来把它留住）
+        self._idle: "weakref.WeakKeyDictionary[Any, List[Any]]" = weakref.WeakKeyDictionary()
+        self._created = 0
+        self._reused = 0
+        self._in_use = 0
+
+    def acquire(self, template: Any, *, out: Optional[Callable[[dict], None]] = None) -> Any:
+        """
+        取一个独立副本。
+
+        Args:
+            template: ``agent_list`` 里注册的实例
+            out: 该副本专属的输出 sink；``None`` 表示沿用模板的 out
+        """
+        clone = None
+        with self._lock:
+            idle = self._idle.get(template)
+            if idle:
+                clone = idle.pop()
+                self._reused += 1
+            else:
+                self._created += 1
+            self._in_use += 1
+
+        if clone is None:
+            clone = copy.copy(template)
+            clone._pool_template = weakref.ref(template)
+            install_metering(clone)
+            install_delegation(clone)
+            install_tool_cache(clone)
+            install_parallel_tools(clone)
+            install_speculation(clone)
+            install_xml_calls(clone)
+        self._reset(clone, template)
+        if out is not None:
+            clone.out = out
+        return clone
+
+    def release(self, clone: Any) -> None:
+        """归还副本；超过空闲上限就直接丢弃"""
+        ref = getattr(clone, "_pool_template", None)
+        template = ref() if ref is not None else None
+        with self._lock:
+            self._in_use -= 1
+            if template is None:
+                return
+            idle = self._idle.setdefault(template, [])
+            if len(idle) < self.max_idle_per_agent:
+                idle.append(clone)
+
+    @contextmanager
+    def lease(self, template: Any, *, out: Optional[Callable[[dict], None]] = None) -> Iterator[Any]:
+        """``with pool.lease(inst) as clone: ...`` —— 退出时自动归还"""
+        clone = self.acquire(template, out=out)
+        try:
+            yield clone
+        finally:
+            self.release(clone)
+
+    @staticmethod
+    def _reset(clone: Any, template: Any) -> None:
+        """把副本的会话状态重置成模板当前的样子"""
+        clone.history = _system_history(template)
+        prompt = get_prompt_builder().system_prompt(template)
+        if prompt is not None:
+            clone.system_prompt = prompt
+            if clone.history:
+                clone.history[0]["content"] = prompt
+        clone.current_task_id = None
+        clone.stream_run = False
+        # 钩子列表独立一份：请求内 register_tool_hook 不影响模板
+        clone.tool_call_hooks = list(getattr(template, "tool_call_hooks", []) or [])
+        # 去掉上次请求装上的 out，回落到模板（实例属性或类方法）
+        template_out = template.__dict__.get("out")
+        if template_out is not None:
+            clone.out = template_out
+        else:
+            clone.__dict__.pop("out", None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "created": self._created,
+                "reused": self._reused,
+                "in_use": self._in_use,
+                "idle": sum(len(v) for v in self._idle.values()),
+            }
+
+
+# ---------------------------------------------------------------------------
+# 进程级单例
+# ---------------------------------------------------------------------------
+
+_default_pool: Optional[AgentPool] = None
+_default_lock = threading.Lock()
+
+
+def get_agent_pool() -> AgentPool:
+    """返回进程级默认 AgentPool"""
+    global _default_pool
+    if _default_pool is None:
+        with _default_lock:
+            if _default_pool is None:
+                _default_pool = AgentPool()
+    return _default_pool
@@ -0,0 +1,225 @@
+"""
+按段缓存的 system prompt：注册表变了只把受影响的 Agent 标脏，下一轮对话时再按需重拼。
+
+tangyuanAI 的 ``_build_system_prompt`` 每次都从头拼一遍：
+
+    prompt + 工具清单（注册工具 + 内置工具 + 调用提示）+ Skills 描述 + ", 你的uuid ..."
+
+注册工具 / 扫描 Skills / 接入 MCP 之后，要让 Agent 看到新工具只能逐个 ``reload()``，
+每次都重新做 ACL 判定、沿 MRO 反射内置工具、遍历全部 Skill —— Agent 一多就是一轮重建风暴。
+
+这里把 prompt 拆成几段，各自缓存：
+
+- **base**：``agent.prompt``，直接取（类属性，不需要缓存）
+- **builtins**：``@builtin_tool`` 的 ``(名字, 描述)``，只和 Agent 类有关，按类缓存一次
+- **tools**：该 Agent 可用的注册工具 + 内置工具 + 调用提示，按 ``(Agent 类, uuid)`` 缓存
+- **skills**：全局一份（tangyuanAI 的 Skills 描述不区分 Agent）
+
+失效靠 ``api.registry`` 的变更订阅，只标脏、不重建：
+
+- 工具注册 / 覆盖 / 注销：新旧 ``allowed_agents`` 里出现的 Agent 标脏；不限 Agent 的工具标脏全部
+- uuid → 名字映射变化：只标脏该 uuid（ACL 按名字判定）
+- Skills 表变化（含 ``skill.reload()`` 之后 ``watcher.bump("skills")``）：只作废 skills 段
+- 任何工具表变化也作废 skills 段：Skill 以工具形式桥接进注册表，SKILL.md 被改动后
+  ``SkillRegistry.reload_skill`` 只会注销 / 重新注册对应的工具，不会发 skills 事件
+
+``AgentPool`` 派生 / 复用副本时取 ``system_prompt(template)``：干净的直接用缓存，
+脏的只重拼 tools 段。``_build_system_prompt`` 被子类覆写的 Agent 不走这里，仍用模板自己的 history。
+"""
+
+from __future__ import annotations
+
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from .registry import MISSING, get_registry_watcher
+
+_TOOLS_HEADER = "\n\n你可以使用以下工具：\n"
+# 与 tangyuanAI 各 Agent 类 ``_build_system_prompt`` 里的提示原文一致
+_XML_HINT = (
+    "在使用xml格式的工具时应采用（无参数调用）<工具名></工具名>"
+    "（含参数调用）<工具名><参数1>放入你想传入的内容</参数1>...</工具名>"
+)
+_ANTHROPIC_HINT = (
+    "\n注意：本 Agent 走 Anthropic 协议，请通过 tool_use 块调用上述工具；"
+    "不要使用 XML 标签。"
+)
+
+
+def _builder_kind(cls: type) -> Optional[str]:
+    """该类的 system prompt 是哪套拼法；没覆写过的才能按段拼，否则返回 None"""
+    build = getattr(cls, "_build_system_prompt", None)
+    try:
+        from tangyuanAI.agent import _AgentCommon
+
+        if build is _AgentCommon._build_system_prompt:
+            return "common"
+    except ImportError:  # pragma: no cover
+        pass
+    try:
+        from tangyuanAI.anthropic_agent import AnthropicAgent
+
+        if build is AnthropicAgent._build_system_prompt:
+            return "anthropic"
+    except ImportError:  # pragma: no cover
+        pass
+    return None
+
+
+class _Entry:
+    """一个 Agent 的 tools 段 + 拼好的 prompt"""
+
+    __slots__ = ("acl_key", "tools", "dirty", "prompt", "skills")
+
+    def __init__(self, acl_key: str, tools: str):
+        self.acl_key = acl_key
+        self.tools = tools
+        self.dirty = False
+        self.prompt: Optional[str] = None
+        self.skills: Optional[str] = None   # 拼 prompt 时用的 skills 段（按身份比较）
+
+
+class PromptBuilder:
+    """``(Agent 类, uuid) → system prompt``，按段缓存、按注册表变更标脏"""
+
+    def __init__(self, watcher: Any = None):
+        self._watcher = watcher or get_registry_watcher()
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[type, str], _Entry] = {}
+        self._builtins: Dict[type, Tuple[Tuple[str, str], ...]] = {}
+        self._skills: Optional[str] = None
+        self._watcher.subscribe(self._on_change)
+
+    # ---- 对外 ----
+
+    def system_prompt(self, agent: Any) -> Optional[str]:
+        """该 Agent 当前应有的 system prompt；不支持按段拼的类返回 None"""
+        kind = _builder_kind(type(agent))
+        if kind is None:
+            return None
+        # 读一次版本号：注册表被整体替换时由 watcher 重新接管，并通知这里全部标脏
+        self._watcher.version
+        key = (type(agent), agent.uuid)
+        entry = self._entries.get(key)
+        if entry is None or entry.dirty:
+            entry = self._build_entry(agent, kind)
+            with self._lock:
+                self._entries[key] = entry
+        skills = self._skills_segment()
+        if entry.prompt is None or entry.skills is not skills:
+            entry.prompt = (agent.prompt or "") + entry.tools + skills + ", 你的uuid " + str(agent.uuid)
+            entry.skills = skills
+        return entry.prompt
+
+    def is_dirty(self, agent: Any) -> bool:
+        """该 Agent 的 tools 段是否等着重拼（没缓存过也算）"""
+        entry = self._entries.get((type(agent), agent.uuid))
+        return entry is None or entry.dirty
+
+    def invalidate(self, agent: Any) -> None:
+        """强制该 Agent 下一轮重拼 tools 段和 skills 段（``POST /agents/{id}/reload`` 用）"""
+        entry = self._entries.get((type(agent), agent.uuid))
+        if entry is not None:
+            entry.dirty = True
+        self._builtins.pop(type(agent), None)
+        self._skills = None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._builtins.clear()
+            self._skills = None
+
+    # ---- 分段 ----
+
+    def _builtin_lines(self, agent: Any) -> Tuple[Tuple[str, str], ...]:
+        cls = type(agent)
+        lines = self._builtins.get(cls)
+        if lines is None:
+            from tangyuanAI.agent_tool import tool_registry
+
+            lines = tuple(
+                (s["function"]["name"], s["function"]["description"])
+                for s in tool_registry.collect_builtin_tools(agent)
+            )
+            self._builtins[cls] = lines
+        return lines
+
+    def _build_entry(self, agent: Any, kind: str) -> _Entry:
+        from tangyuanAI.agent_tool import tool_registry
+
+        tools_info = tool_registry.get_all_tools_info(agent.uuid)
+        builtins = [(n, d) for n, d in self._builtin_lines(agent) if n not in tools_info]
+        text = ""
+        if tools_info or builtins:
+            parts = [_TOOLS_HEADER]
+            parts.extend(f"- {name}: {info['description']}\n" for name, info in tools_info.items())
+            parts.extend(f"- {name}: {desc}\n" for name, desc in builtins)
+            if kind == "anthropic":
+                parts.append(_ANTHROPIC_HINT)
+            elif not agent.fc_model:
+                parts.append(_XML_HINT)
+            text = "".join(parts)
+        acl_key = tool_registry._uuid_to_name.get(agent.uuid, agent.uuid)
+        return _Entry(acl_key, text)
+
+    def _skills_segment(self) -> str:
+        skills = self._skills
+        if skills is None:
+            try:
+                from tangyuanAI.skill import skill_registry
+            except ImportError:  # pragma: no cover - skill 依赖可选
+                skills = ""
+            else:
+                skills = skill_registry.get_skills_prompt_text()
+            self._skills = skills
+        return skills
+
+    # ---- 失效 ----
+
+    def _on_change(self, table: str, key: Any, old: Any, new: Any) -> None:
+        if table == "skills":
+            self._skills = None
+            return
+        if table == "tools" or key is None:
+            # Skill 的增删改都表现为工具表变化（见模块说明）；skills 段是全局一份，重拼很便宜
+            self._skills = None
+        entries = list(self._entries.items())
+        if key is None:
+            for _, entry in entries:
+                entry.dirty = True
+            return
+        if table == "agents":
+            for (_, uuid), entry in entries:
+                if uuid == key:
+                    entry.dirty = True
+            return
+        if table != "tools":
+            return
+        affected = set()
+        for info in (old, new):
+            if info is MISSING:
+                continue
+            allowed = info.get("allowed_agents") if isinstance(info, dict) else None
+            if allowed is None:
+                for _, entry in entries:
+                    entry.dirty = True
+                return
+            affected.update(allowed)
+        for _, entry in entries:
+            if entry.acl_key in affected:
+                entry.dirty = True
+
+
+_builder: Optional[PromptBuilder] = None
+_builder_lock = threading.Lock()
+
+
+def get_prompt_builder() -> PromptBuilder:
+    """返回进程级 PromptBuilder"""
+    global _builder
+    if _builder is None:
+        with _builder_lock:
+            if _builder is None:
+                _builder = PromptBuilder()
+    return _builder
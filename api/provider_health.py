@@ -0,0 +1,256 @@
+"""
+LLM provider 连通性：按 ``(endpoint, key 指纹)`` 去重探测，结果带 TTL 缓存，供 ``/health`` 直接读。
+
+tangyuanAI 的每个 Agent 在 ``__init__`` 里起一个线程 ping 自己的 ``api_provider``：
+十个 Agent 连同一个 endpoint 就是十个线程、十次探测请求，``POST /agents`` 运行时注册也一样。
+结果只打日志，``/health`` 拿不到。
+
+这里改成一个共享的服务：
+
+- Agent **订阅**（``subscribe``）而不是自己探测：同一 ``(endpoint, key 指纹)`` 的 Agent 共用一条记录
+- 每个 key 同时最多一个探测线程（single-flight）；结果缓存 ``PROVIDER_HEALTH_TTL`` 秒，过期后
+  下一次订阅 / 读取时在后台重新探测
+- key 指纹是 API key 的 sha256 前 12 位（不落明文）
+- ``/health`` 只读缓存，不等探测：有 provider 探测失败时 ``status`` 为 ``degraded``
+- 探测请求走共享连接池（``api/http_pool.py``），不单独建客户端
+
+订阅点：启动时加载完 ``AGENTS_CONFIG`` 后的全部 Agent、``POST /agents`` 运行时注册的 Agent、
+惰性模式下刚激活的模板（``api/activation.py``）。
+
+API 启动时（``install``）把 tangyuanAI 的 ``enable_connectivity`` 类开关关掉，Agent 实例化不再
+各起线程；``PROVIDER_HEALTH_SHARED=0`` 可恢复原行为。类上自己设了 ``enable_connectivity = True``
+的 Agent 实例化时照样自己探测，不在这里订阅（否则会探测两次）。旧版 ``Agent_Base_`` / ``anthropic_agent``
+不看这个开关，仍自己探测，也不在这里订阅。
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import threading
+import time
+import weakref
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .env import env_float
+from .models import ProviderStatus
+
+logger = logging.getLogger(__name__)
+
+ProviderKey = Tuple[str, str]
+
+
+def shared_probing_enabled() -> bool:
+    """是否由共享服务代替 Agent 各自探测（``PROVIDER_HEALTH_SHARED``，默认开）"""
+    return os.getenv("PROVIDER_HEALTH_SHARED", "1").lower() not in ("0", "false", "no")
+
+
+# install() 关掉前 tangyuanAI 的全局默认值；Agent 类自己设过 enable_connectivity 的以类为准
+_default_enabled = True
+
+
+def _probe_enabled(agent: Any) -> bool:
+    """
+    该 Agent 要不要由共享服务探测。实例化时已经自己探测过的（``enable_connectivity`` 为真，
+    比如类上显式设了 True）不再重复；类上显式关掉的不探测；其余看 ``install()`` 之前的全局默认值
+    """
+    if getattr(agent, "enable_connectivity", False):
+        return False
+    for klass in type(agent).__mro__:
+        if "enable_connectivity" in klass.__dict__:
+            if klass.__module__ == "tangyuanAI.agent":
+                return _default_enabled
+            return False
+    return _default_enabled
+
+
+def key_fingerprint(api_key: Optional[str]) -> str:
+    if not api_key:
+        return ""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+class _Provider:
+    """一个 ``(endpoint, key 指纹)`` 的探测状态"""
+
+    __slots__ = ("endpoint", "fingerprint", "agents", "probe_agent", "ok", "checked_at",
+                 "latency_ms", "error", "probing")
+
+    def __init__(self, endpoint: str, fingerprint: str, agent: Any):
+        self.endpoint = endpoint
+        self.fingerprint = fingerprint
+        self.agents: Dict[str, None] = {}     # 订阅的 Agent 名（保序去重）
+        self.probe_agent = agent              # 用它的 headers / ping payload 发探测
+        self.ok: Optional[bool] = None
+        self.checked_at: Optional[float] = None
+        self.latency_ms: Optional[float] = None
+        self.error: Optional[str] = None
+        self.probing = False
+
+
+class ProviderHealth:
+    """按 provider 去重的连通性探测 + TTL 缓存"""
+
+    def __init__(self, ttl: Optional[float] = None, timeout: float = 10.0):
+        self.ttl = env_float("PROVIDER_HEALTH_TTL", 60.0) if ttl is None else ttl
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._providers: Dict[ProviderKey, _Provider] = {}
+        self._subscribed: "weakref.WeakKeyDictionary[Any, ProviderKey]" = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def key_for(agent: Any) -> Optional[ProviderKey]:
+        """
+        Agent 对应的 provider key；不支持 ``_ping_endpoint`` 的旧版 Agent、
+        类上设了 ``enable_connectivity``（关掉，或打开后自己探测）的 Agent 返回 None
+        """
+        ping_endpoint = getattr(agent, "_ping_endpoint", None)
+        if ping_endpoint is None or not getattr(agent, "api_provider", None):
+            return None
+        if not _probe_enabled(agent):
+            return None
+        try:
+            endpoint = ping_endpoint()
+        except Exception:
+            return None
+        return endpoint, key_fingerprint(getattr(agent, "api_key", None))
+
+    def subscribe(self, agent: Any) -> Optional[ProviderKey]:
+        """登记 Agent；它的 provider 没有新鲜结果时在后台探测一次"""
+        if not shared_probing_enabled():
+            return None  # Agent 各自探测，这里不重复
+        key = self._subscribed.get(agent)
+        if key is None:
+            key = self.key_for(agent)
+            if key is None:
+                return None
+            with self._lock:
+                provider = self._providers.get(key)
+                if provider is None:
+                    provider = self._providers[key] = _Provider(key[0], key[1], agent)
+                provider.agents[agent.name] = None
+                self._subscribed[agent] = key
+        self._refresh(key)
+        return key
+
+    def sync(self, agents: Iterable[Any]) -> None:
+        """订阅一批 Agent（重复的实例只算一次）；过期的 provider 在后台重新探测"""
+        seen = set()
+        for agent in agents:
+            if id(agent) not in seen:
+                seen.add(id(agent))
+                self.subscribe(agent)
+
+    def _refresh(self, key: ProviderKey) -> None:
+        with self._lock:
+            provider = self._providers.get(key)
+            if provider is None or provider.probing:
+                return
+            if provider.checked_at is not None and time.monotonic() - provider.checked_at < self.ttl:
+                return
+            provider.probing = True
+        threading.Thread(target=self.probe, args=(key,), daemon=True).start()
+
+    def probe(self, key: ProviderKey) -> Optional[bool]:
+        """同步探测一次（后台线程入口；测试里也可以直接调）"""
+        provider = self._providers.get(key)
+        if provider is None:
+            return None
+        ok, error = False, None
+        started = time.perf_counter()
+        try:
+            ok, error = self._ping(provider.probe_agent)
+        except Exception as e:  # pragma: no cover - _ping 已兜底
+            error = str(e)
+        latency = (time.perf_counter() - started) * 1000
+        with self._lock:
+            provider.ok = ok
+            provider.error = error
+            provider.latency_ms = round(latency, 1)
+            provider.checked_at = time.monotonic()
+            provider.probing = False
+        if ok:
+            logger.info("provider 连接正常：%s（%d 个 Agent）", provider.endpoint, len(provider.agents))
+        else:
+            logger.error("provider 连接测试未通过：%s：%s", provider.endpoint, error)
+        return ok
+
+    def _ping(self, agent: Any) -> Tuple[bool, Optional[str]]:
+        # 走共享连接池（api/http_pool.py）：复用到该 origin 的连接，录制 / 重放也同样生效
+        from .http_pool import get_http_pool
+
+        endpoint = agent._ping_endpoint()
+        try:
+            rsp = get_http_pool().client_for(endpoint).post(
+                endpoint,
+                headers=agent.headers,
+                json=agent._ping_payload(),
+                timeout=self.timeout,
+                max_retries=0,
+            )
+        except Exception as e:
+            return False, str(e)
+        if 200 <= rsp.status_code < 300:
+            return True, None
+        return False, f"status={rsp.status_code}"
+
+    def _status(self, provider: _Provider) -> ProviderStatus:
+        age = None
+        if provider.checked_at is not None:
+            age = round(time.monotonic() - provider.checked_at, 1)
+        return ProviderStatus(
+            endpoint=provider.endpoint,
+            key=provider.fingerprint or None,
+            status="unknown" if provider.ok is None else ("ok" if provider.ok else "down"),
+            agents=list(provider.agents),
+            latency_ms=provider.latency_ms,
+            age_seconds=age,
+            error=provider.error,
+        )
+
+    def statuses(self) -> List[ProviderStatus]:
+        """当前缓存的探测结果（不等探测）；过期的 provider 顺带在后台重新探测"""
+        with self._lock:
+            providers = list(self._providers.items())
+        for key, _ in providers:
+            self._refresh(key)
+        return [self._status(p) for _, p in providers]
+
+
+_health: Optional[ProviderHealth] = None
+_health_lock = threading.Lock()
+
+
+def get_provider_health() -> ProviderHealth:
+    """返回进程级 ProviderHealth"""
+    global _health
+    if _health is None:
+        with _health_lock:
+            if _health is None:
+                _health = ProviderHealth()
+    return _health
+
+
+def install() -> Optional[bool]:
+    """
+    关掉 tangyuanAI Agent 实例化时的自带探测（改由本服务订阅）；返回原开关值，``uninstall`` 时还原。
+    ``PROVIDER_HEALTH_SHARED=0`` 时不动，返回 None。
+    """
+    global _default_enabled
+    if not shared_probing_enabled():
+        return None
+    from tangyuanAI.agent import _AgentCommon
+
+    previous = _AgentCommon.enable_connectivity
+    _default_enabled = previous
+    _AgentCommon.enable_connectivity = False
+    return previous
+
+
+def uninstall(previous: Optional[bool]) -> None:
+    if previous is None:
+        return
+    from tangyuanAI.agent import _AgentCommon
+
+    _AgentCommon.enable_connectivity = previous
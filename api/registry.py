@@ -0,0 +1,288 @@
+"""
+工具 / Skill 注册表的版本号：注册表有写入就 +1，供缓存判断是否失效。
+
+tangyuanAI 的 ``tool_registry`` / ``skill_registry`` 没有版本号，也没有变更通知。
+这里不改 tangyuanAI，而是把它们内部的几个 dict 换成会回调的 dict 子类：
+
+- ``tool_registry._tools``         工具名 → 工具信息（注册 / 覆盖 / 注销工具，含 Skill / MCP 桥接）
+- ``tool_registry._uuid_to_name``  uuid → Agent 名（影响 ACL 判定）
+- ``skill_registry._skills``       Skill 名 → Skill
+
+读路径（``in`` / ``get`` / ``items``）仍是 dict 自己的 C 实现，零额外开销；写路径多一次回调。
+读版本号是 O(1)：只检查这几个 dict 有没有被整体替换（测试 fixture 的 save / restore 会这么做），
+被替换就重新包一层并 +1。
+
+``RegistryWatcher.subscribe`` 可以拿到每次写入的 ``(表名, key, 旧值, 新值)``，增量维护派生索引。
+
+**ACL 倒排索引**（``AclIndex``）就是这样一个派生索引。原版 ``check_permission`` 每次先把 uuid 翻译成
+名字，再扫该工具的 ``allowed_agents`` 列表；列出某个 Agent 的可用工具要把所有工具过一遍
+（工具数 × Agent 数，每次判定还打两条日志）。倒排索引维护：
+
+- ``Agent 名 / uuid → 工具集合`` + ``不限 Agent 的工具集合``，注册 / 覆盖 / 注销时增量更新
+- 工具首次注册的序号：按序号排序，输出顺序与原版遍历 ``_tools`` 的顺序一致
+
+watcher 创建时把 ``tool_registry`` 的 ``check_permission`` / ``get_all_tools_schema`` /
+``get_all_tools_info`` 换成查索引的版本（实例属性，语义不变）：判定 O(1)，列出 O(k)。
+"""
+
+from __future__ import annotations
+
+import itertools
+import threading
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+# 回调：(表名, key, 旧值, 新值)；不存在的一侧为 MISSING
+Listener = Callable[[str, Any, Any, Any], None]
+
+MISSING = object()
+
+
+class _ObservedDict(dict):
+    """写操作后回调 ``on_change(key, old, new)`` 的 dict"""
+
+    __slots__ = ("_on_change",)
+
+    def __init__(self, data: Any = (), on_change: Optional[Callable[[Any, Any, Any], None]] = None):
+        super().__init__(data)
+        self._on_change = on_change or (lambda key, old, new: None)
+
+    def __reduce__(self):
+        # copy / pickle 出来的是普通 dict，不带回调
+        return dict, (dict(self),)
+
+    def __setitem__(self, key, value):
+        old = dict.get(self, key, MISSING)
+        super().__setitem__(key, value)
+        self._on_change(key, old, value)
+
+    def __delitem__(self, key):
+        old = dict.__getitem__(self, key)
+        super().__delitem__(key)
+        self._on_change(key, old, MISSING)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        old = super().pop(key)
+        self._on_change(key, old, MISSING)
+        return old
+
+    def popitem(self):
+        key, old = super().popitem()
+        self._on_change(key, old, MISSING)
+        return key, old
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return dict.__getitem__(self, key)
+        self[key] = default
+        return default
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+
+class AclIndex:
+    """
+    ``tool_registry`` 的 ACL 倒排索引。
+
+    写（注册表回调，持 watcher 的锁）时整体替换 frozenset，读方不加锁也不会看到半更新的集合。
+    """
+
+    def __init__(self, registry: Any, sync: Callable[[], Any]):
+        self._registry = registry
+        self._sync = sync                                  # 注册表被整体替换时重新接管（watcher.version）
+        self._source: Any = None
+        self._seq = itertools.count()
+        self._order: Dict[str, int] = {}                  # 工具名 → 首次注册序号
+        self._by_agent: Dict[str, FrozenSet[str]] = {}    # allowed_agents 里的条目 → 工具集合
+        self._global: FrozenSet[str] = frozenset()        # allowed_agents 为 None 的工具
+        self.rebuild()
+
+    # ---- 维护 ----
+
+    def rebuild(self) -> None:
+        self._source = self._registry._tools
+        self._order = {}
+        self._by_agent = {}
+        self._global = frozenset()
+        for name, info in list(self._source.items()):
+            self._add(name, info)
+
+    def on_change(self, table: str, key: Any, old: Any, new: Any) -> None:
+        if table != "tools":
+            return
+        if key is None:
+            self.rebuild()
+            return
+        if old is not MISSING:
+            self._remove(key, old)
+        if new is not MISSING:
+            self._add(key, new)
+        else:
+            self._order.pop(key, None)
+
+    def _add(self, name: str, info: Any) -> None:
+        if name not in self._order:
+            self._order[name] = next(self._seq)
+        allowed = info.get("allowed_agents") if isinstance(info, dict) else None
+        if allowed is None:
+            self._global = self._global | {name}
+            return
+        for agent in allowed:
+            self._by_agent[agent] = self._by_agent.get(agent, frozenset()) | {name}
+
+    def _remove(self, name: str, info: Any) -> None:
+        allowed = info.get("allowed_agents") if isinstance(info, dict) else None
+        if allowed is None:
+            self._global = self._global - {name}
+            return
+        for agent in allowed:
+            tools = self._by_agent.get(agent, frozenset()) - {name}
+            if tools:
+                self._by_agent[agent] = tools
+            else:
+                self._by_agent.pop(agent, None)
+
+    # ---- 查询 ----
+
+    def _agent_key(self, agent_id: str) -> str:
+        # 与原版一致：uuid 先翻译成名字，再去 allowed_agents 里找
+        return self._registry._uuid_to_name.get(agent_id, agent_id)
+
+    def _check_source(self) -> None:
+        if self._registry._tools is not self._source:
+            self._sync()
+
+    def check_permission(self, agent_id: str, tool_name: str) -> bool:
+        self._check_source()
+        if tool_name not in self._registry._tools:
+            return False
+        return tool_name in self._global or tool_name in self._by_agent.get(self._agent_key(agent_id), ())
+
+    def tool_names(self, agent_id: str) -> List[str]:
+        """该 Agent 可用的工具名，按注册顺序"""
+        self._check_source()
+        tools = self._global | self._by_agent.get(self._agent_key(agent_id), frozenset())
+        order = self._order
+        return sorted((t for t in tools if t in order), key=order.__getitem__)
+
+    def get_all_tools_schema(self, agent_uuid: str) -> list:
+        registered = self._registry._tools
+        return [registered[t].get("schema") for t in self.tool_names(agent_uuid) if t in registered]
+
+    def get_all_tools_info(self, agent_uuid: str) -> dict:
+        registered = self._registry._tools
+        return {
+            t: {
+                "description": registered[t]["description"],
+                "parameters": registered[t].get("parameters", {}),
+            }
+            for t in self.tool_names(agent_uuid)
+            if t in registered
+        }
+
+    def install(self) -> None:
+        """把 registry 的 ACL 查询换成查索引（实例属性）"""
+        self._registry.check_permission = self.check_permission
+        self._registry.get_all_tools_schema = self.get_all_tools_schema
+        self._registry.get_all_tools_info = self.get_all_tools_info
+
+
+class RegistryWatcher:
+    """tangyuanAI 工具 / Skill 注册表的版本号 + 变更订阅 + ACL 倒排索引"""
+
+    def __init__(self, tool_registry: Any = None, skill_registry: Any = None):
+        if tool_registry is None:
+            from tangyuanAI.agent_tool import tool_registry
+        if skill_registry is None:
+            try:
+                from tangyuanAI.skill import skill_registry
+            except ImportError:  # pragma: no cover - skill 依赖可选
+                skill_registry = None
+        self._targets: List[Tuple[str, Any, str]] = [
+            ("tools", tool_registry, "_tools"),
+            ("agents", tool_registry, "_uuid_to_name"),
+        ]
+        if skill_registry is not None:
+            self._targets.append(("skills", skill_registry, "_skills"))
+        self.tool_registry = tool_registry
+        self._lock = threading.RLock()
+        self._version = 0
+        self._listeners: List[Listener] = []
+        self._install()
+
+        self.acl = AclIndex(tool_registry, lambda: self.version)
+        self.subscribe(self.acl.on_change)
+        self.acl.install()
+
+    @property
+    def version(self) -> int:
+        """当前版本号（单调递增）"""
+        for _, owner, attr in self._targets:
+            if type(getattr(owner, attr, None)) is not _ObservedDict:
+                self._install()
+                break
+        return self._version
+
+    def subscribe(self, listener: Listener) -> None:
+        """
+        订阅之后的每一次写入。整张表被替换时回调 ``(表名, None, MISSING, MISSING)``，
+        订阅方应按新表整体重建。
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def bump(self, table: Optional[str] = None) -> None:
+        """
+        手动 +1（注册表条目没换、但内容原地改了时用，比如 ``skill.reload()``）。
+        给了表名就按"整张表被替换"通知订阅方。
+        """
+        with self._lock:
+            self._version += 1
+            if table is not None:
+                for listener in self._listeners:
+                    listener(table, None, MISSING, MISSING)
+
+    def _install(self) -> None:
+        with self._lock:
+            for table, owner, attr in self._targets:
+                current = getattr(owner, attr, None)
+                if type(current) is _ObservedDict or not isinstance(current, dict):
+                    continue
+                setattr(owner, attr, _ObservedDict(current, self._notifier(table)))
+                self._version += 1
+                for listener in self._listeners:
+                    listener(table, None, MISSING, MISSING)
+
+    def _notifier(self, table: str) -> Callable[[Any, Any, Any], None]:
+        def on_change(key: Any, old: Any, new: Any) -> None:
+            with self._lock:
+                self._version += 1
+                for listener in self._listeners:
+                    listener(table, key, old, new)
+        return on_change
+
+
+_watcher: Optional[RegistryWatcher] = None
+_watcher_lock = threading.Lock()
+
+
+def get_registry_watcher() -> RegistryWatcher:
+    """返回进程级 RegistryWatcher（第一次调用时接管 tangyuanAI 的注册表）"""
+    global _watcher
+    if _watcher is None:
+        with _watcher_lock:
+            if _watcher is None:
+                _watcher = RegistryWatcher()
+    return _watcher
+
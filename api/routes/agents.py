@@ -2,107 +2,123 @@
 GET /agents —— 列出所有已注册的 Agent
 GET /agents/{name_or_uuid} —— 取单个 Agent 的元信息
 POST /agents/{name_or_uuid}/chat —— 与 Agent 对话（流式 SSE / 非流式）
+POST /agents/{name_or_uuid}/chat:batch —— 批量对话，结果按完成顺序以 NDJSON 流式返回
 POST /agents/{name_or_uuid}/reload —— 重新加载 Agent
+GET / DELETE /agents/{name_or_uuid}/sessions/{session_id} —— 查看 / 删除服务端会话
 POST /agents —— 运行时注册 Agent
 GET /agents/{name_or_uuid}/tools —— 列出该 Agent 可用的工具
 """
 
 from __future__ import annotations
 
-import json
+import asyncio
+import time
 import uuid as _uuid
-from typing import Any, List, Optional
+from contextlib import aclosing
+from typing import List, Optional
 
 import tangyuanAI
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from fastapi.responses import StreamingResponse
 
+from ..admission import get_admission
+from ..cancellation import CancelToken
 from ..deps import (
+    aget_agent_or_404,
     get_agent_info,
     get_agent_list,
-    get_agent_or_404,
+    run_agent_chat,
     stream_agent_chat,
 )
+from ..env import env_int
+from ..metrics import CHAT_QUEUE_WAIT, SSE_FRAMES
+from ..streaming import GuardedStreamingResponse, SSEEncoder, coalesce, normalize_chunk
+from ..usage import UsageAccumulator
 from ..models import (
     AgentAvailableToolsResponse,
     AgentInfo,
     AgentListResponse,
     AgentRegistrationRequest,
     AgentRegistrationResponse,
+    BatchChatItem,
+    BatchChatRequest,
+    BatchChatResult,
     ChatChoice,
     ChatMessage,
     ChatRequest,
     ChatResponse,
-    ChatUsage,
+    SessionInfo,
 )
+from ..prompts import get_prompt_builder
+from ..provider_health import get_provider_health
+from ..sessions import get_session_store
+from ..snapshots import get_agent_snapshot
+from ..tool_schemas import get_tool_schema_cache
 
 router = APIRouter(prefix="/agents", tags=["agents"])
 
 
+def _last_user_index(messages: List[ChatMessage]) -> Optional[int]:
+    """最后一条 role=user 消息的下标；没有则 None"""
+    return next(
+        (i for i in range(len(messages) - 1, -1, -1) if messages[i].role == "user"),
+        None,
+    )
+
+
 @router.get("", response_model=AgentListResponse)
-async def list_agents(agent_list=Depends(get_agent_list)) -> AgentListResponse:
+async def list_agents(request: Request, agent_list=Depends(get_agent_list)) -> Response:
     """
-    列出所有已注册的 Agent。
+    列出所有已注册的 Agent（按 uuid 去重）。
 
-    Agent 注册时同时登记到 uuid 和 name 两个 key，所以同一个实例会出现两次。
-    这里按 uuid 去重后返回。
+    响应体来自预先算好的快照（``api/snapshots.py``），注册表变了才重建；
+    带 ``ETag`` / ``X-Registry-Version``，``If-None-Match`` 命中时返 304。
     """
-    seen = set()
-    items: List[AgentInfo] = []
-    for key, inst in agent_list.items():
-        uuid = getattr(inst, "uuid", None)
-        if uuid and uuid not in seen:
-            seen.add(uuid)
-            items.append(get_agent_info(inst))
-
-    return AgentListResponse(agents=items, total=len(items))
+    return get_agent_snapshot().respond(agent_list, request)
 
 
 @router.get("/{name_or_uuid}", response_model=AgentInfo)
 async def get_agent(name_or_uuid: str) -> AgentInfo:
-    inst = get_agent_or_404(name_or_uuid)
+    inst = await aget_agent_or_404(name_or_uuid)
     return get_agent_info(inst)
 
 
 @router.get("/{name_or_uuid}/tools", response_model=AgentAvailableToolsResponse)
 async def list_agent_tools(name_or_uuid: str) -> AgentAvailableToolsResponse:
-    """列出该 Agent 可调用的工具（注册的工具 + @builtin_tool 自动收集的）"""
-    inst = get_agent_or_404(name_or_uuid)
-
-    # 1) 注册的工具
-    try:
-        tools_info = tangyuanAI.tool_registry.get_all_tools_info(inst.uuid) or {}
-        tool_names = sorted(tools_info.keys())
-    except Exception:
-        tool_names = []
+    """
+    列出该 Agent 可调用的工具（注册的工具 + @builtin_tool 自动收集的）。
 
-    # 2) 内置工具（@builtin_tool 自动收集）
-    builtin_names: List[str] = []
-    try:
-        for s in tangyuanAI.tool_registry.collect_builtin_tools(inst):
-            n = s.get("function", {}).get("name")
-            if n:
-                builtin_names.append(n)
-    except Exception:
-        pass
-
-    all_names = sorted(set(tool_names) | set(builtin_names))
+    直接取预编译的工具列表（``api/tool_schemas.py``），注册表没变就不重新收集。
+    """
+    inst = await aget_agent_or_404(name_or_uuid)
+    compiled = get_tool_schema_cache().get(inst)
+    tool_names = list(compiled.registered_names)
+    builtin_names = list(compiled.builtin_names)
     return AgentAvailableToolsResponse(
         agent_name=inst.name,
         tool_names=tool_names,
         builtin_tool_names=builtin_names,
-        total=len(all_names),
+        total=len(set(tool_names) | set(builtin_names)),
     )
 
 
 @router.post("/{name_or_uuid}/chat", response_model=None)
-async def chat_with_agent(name_or_uuid: str, req: ChatRequest):
+async def chat_with_agent(name_or_uuid: str, req: ChatRequest, response: Response):
     """
     与 Agent 对话。
 
     - ``stream=false``（默认）：返 ``ChatResponse``（OpenAI 风格）
     - ``stream=true``：返 ``text/event-stream``，每帧一个 JSON dict
       （来自 Agent.out 的 content，event 字段分类为 text / tool_call / tool_result / done / error）
+
+    两条路径都先过准入控制（``api/admission.py``）：超出并发上限的请求排队，
+    队列满返 429、排队超时返 503（均带 ``Retry-After``）；排队耗时见响应头 ``X-Queue-Wait-Ms``。
+
+    带 ``session_id`` 时历史保存在服务端（``api/sessions.py``），续聊只需发新的 user 消息；
+    会话 ID 通过响应体 ``session_id`` / 流式响应头 ``X-Session-Id`` 回传。
+
+    token 用量（provider 报告，含 ask_for_help 子调用）：非流式在 ``usage`` 字段，
+    流式在 ``done`` 之前的一帧 ``usage`` 事件。
     """
     if not req.messages:
         raise HTTPException(
@@ -110,77 +126,106 @@ async def chat_with_agent(name_or_uuid: str, req: ChatRequest):
             detail="messages 至少要有一条",
         )
 
-    inst = get_agent_or_404(name_or_uuid)
+    inst = await aget_agent_or_404(name_or_uuid)
 
     # 解析最后一条 user 消息
-    last_user = next(
-        (m for m in reversed(req.messages) if m.role == "user"),
-        None,
-    )
-    if last_user is None:
+    last_idx = _last_user_index(req.messages)
+    if last_idx is None:
         raise HTTPException(
             status_code=400,
             detail="messages 中至少要有一条 role=user 的消息",
         )
+    last_user = req.messages[last_idx]
+
+    admission = get_admission()
+    waited = await admission.acquire(inst.uuid)
+    CHAT_QUEUE_WAIT.observe(waited, inst.name)
+    admitted_at = time.perf_counter()
+    extra_headers = {"X-Queue-Wait-Ms": f"{waited * 1000:.1f}"}
+
+    # 准入之后才取会话：被 429 / 503 拒掉的请求不新建、不续期会话，也不会把别的会话挤出 LRU
+    session = None
+    if req.session_id is not None:
+        # 新会话：最后一条 user 之前的对话作为初始历史
+        seed = [
+            {"role": m.role, "content": m.content}
+            for m in req.messages[:last_idx]
+            if m.role in ("user", "assistant")
+        ]
+        try:
+            session = await get_session_store().aopen(inst.uuid, req.session_id, seed=seed)
+        except BaseException:
+            admission.release(inst.uuid, held=time.perf_counter() - admitted_at)
+            raise
+        extra_headers["X-Session-Id"] = session.session_id
+    usage = UsageAccumulator()
 
     if req.stream:
-        # ---- 流式 SSE ----
+        # ---- 流式 SSE：名额一直占到流结束；客户端断开即取消后台对话 ----
+        cancel_token = CancelToken()
+        closed = False
+
+        def close() -> None:
+            # 生成器的 finally 和响应收尾都会调，只归还一次
+            nonlocal closed
+            if closed:
+                return
+            closed = True
+            cancel_token.cancel("client disconnected")
+            admission.release(inst.uuid, held=time.perf_counter() - admitted_at)
+
         async def event_source():
-            async for chunk in stream_agent_chat(
+            encoder = SSEEncoder(inst.name, inst.uuid)
+            chunks = stream_agent_chat(
                 inst,
                 messages=last_user.content,
                 images=req.images,
                 tool=req.tool,
-            ):
-                event = chunk.get("event")
-                data = chunk.get("data", {})
-                # 兼容 Agent.out 的旧 content dict 格式（不是 {"event":..., "data":...}）
-                # 旧格式：{"message": "xxx"} / {"tool_name": "xxx"} / {"task": True} / {"tool_result":...}
-                if "event" not in chunk:
-                    if "message" in chunk:
-                        event = "text"
-                        data = {"delta": chunk.get("message", "")}
-                    elif "tool_name" in chunk and "tool_result" not in chunk:
-                        event = "tool_call"
-                        data = {"name": chunk["tool_name"], "input": chunk.get("tool_parameter", {})}
-                    elif "tool_result" in chunk:
-                        event = "tool_result"
-                        data = {"name": chunk.get("tool_name"), "result": chunk["tool_result"]}
-                    elif chunk.get("task"):
-                        event = "done"
-                        data = {"finish_reason": "stop"}
-                    else:
-                        event = "text"
-                        data = chunk
-                payload = {
-                    "event": event,
-                    "data": data,
-                    "agent_name": inst.name,
-                    "agent_uuid": inst.uuid,
-                }
-                yield f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
-
-            # 收尾：done
-            yield "data: " + json.dumps({
-                "event": "done",
-                "data": {"finish_reason": "stop"},
-                "agent_name": inst.name,
-                "agent_uuid": inst.uuid,
-            }, ensure_ascii=False) + "\n\n"
-
-        return StreamingResponse(event_source(), media_type="text/event-stream")
-
-    # ---- 非流式 ----
+                cancel_token=cancel_token,
+                session=session,
+                usage=usage,
+            )
+            try:
+                # 连续的文本增量按 SSE_COALESCE_MS / SSE_COALESCE_BYTES 窗口合成一帧
+                async with aclosing(coalesce(normalize_chunk(c) async for c in chunks)) as events:
+                    async for event, data in events:
+                        SSE_FRAMES.inc(inst.name, event)
+                        yield encoder.frame(event, data)
+
+                # 收尾：usage + done
+                SSE_FRAMES.inc(inst.name, "usage")
+                yield encoder.event("usage", usage.to_usage().model_dump())
+                SSE_FRAMES.inc(inst.name, "done")
+                yield encoder.done()
+            finally:
+                # 正常结束时取消是 no-op；客户端断开时生成器被关闭，走到这里
+                close()
+
+        # 生成器没来得及启动（发响应头时客户端已断开）时由响应收尾归还名额
+        return GuardedStreamingResponse(
+            event_source(),
+            on_close=close,
+            media_type="text/event-stream",
+            headers=extra_headers,
+        )
+
+    # ---- 非流式：独立副本 + 有界线程池，不阻塞 event loop ----
+    response.headers.update(extra_headers)
     try:
-        text = inst.conversation_with_tool(
+        text = await run_agent_chat(
+            inst,
             messages=last_user.content,
             tool=req.tool,
             images=req.images,
+            session=session,
+            usage=usage,
         )
     except tangyuanAI.errors.APIError as e:
         raise HTTPException(status_code=502, detail=f"LLM 调用失败：{e}") from e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
+    finally:
+        admission.release(inst.uuid, held=time.perf_counter() - admitted_at)
 
     return ChatResponse(
         choices=[
@@ -190,22 +235,126 @@ async def chat_with_agent(name_or_uuid: str, req: ChatRequest):
                 finish_reason="stop",
             ),
         ],
-        usage=ChatUsage(),
+        usage=usage.to_usage(),
         agent_name=inst.name,
         agent_uuid=inst.uuid,
+        session_id=req.session_id,
+    )
+
+
+@router.post("/{name_or_uuid}/chat:batch", response_model=None)
+async def batch_chat_with_agent(name_or_uuid: str, req: BatchChatRequest) -> StreamingResponse:
+    """
+    批量对话：同一个 Agent 跑一批输入，每条一份独立副本（互不共享 history）。
+
+    - 同时最多跑 ``concurrency`` 条（默认 ``CHAT_BATCH_CONCURRENCY``，不超过单 Agent 并发上限），
+      每条照常过准入控制，和普通 chat 请求公平排队
+    - 返回 ``application/x-ndjson``，每行一个 ``BatchChatResult``，**按完成顺序**输出
+      （用 ``index`` / ``id`` 对回输入）；单条失败只体现在该行的 ``error`` / ``status_code``
+    - 每行带该条的 token 用量；客户端断开时取消还没跑完的条目
+    """
+    inst = await aget_agent_or_404(name_or_uuid)
+
+    prompts: List[str] = []
+    for i, item in enumerate(req.items):
+        idx = _last_user_index(item.messages)
+        if idx is None:
+            raise HTTPException(
+                status_code=400,
+                detail=f"items[{i}].messages 中至少要有一条 role=user 的消息",
+            )
+        prompts.append(item.messages[idx].content)
+
+    admission = get_admission()
+    default = env_int("CHAT_BATCH_CONCURRENCY", 8)
+    limit = max(1, min(req.concurrency or default, admission.max_per_agent))
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run_one(index: int, item: BatchChatItem, prompt: str) -> BatchChatResult:
+        started = time.perf_counter()
+        usage = UsageAccumulator()
+        result = BatchChatResult(index=index, id=item.id)
+        async with semaphore:
+            try:
+                async with admission.admit(inst.uuid) as waited:
+                    CHAT_QUEUE_WAIT.observe(waited, inst.name)
+                    text = await run_agent_chat(
+                        inst,
+                        messages=prompt,
+                        tool=req.tool,
+                        images=item.images,
+                        usage=usage,
+                    )
+                result.content = text or ""
+            except HTTPException as e:
+                result.error, result.status_code = str(e.detail), e.status_code
+            except tangyuanAI.errors.APIError as e:
+                result.error, result.status_code = f"LLM 调用失败：{e}", 502
+            except Exception as e:
+                result.error, result.status_code = str(e), 500
+        result.usage = usage.to_usage()
+        result.elapsed_ms = (time.perf_counter() - started) * 1000
+        return result
+
+    async def results():
+        tasks = [
+            asyncio.create_task(run_one(i, item, prompt))
+            for i, (item, prompt) in enumerate(zip(req.items, prompts))
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                yield result.model_dump_json() + "\n"
+        finally:
+            # 正常结束时都已完成；客户端断开时取消剩下的（run_agent_chat 会停掉后台对话）
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        results(),
+        media_type="application/x-ndjson",
+        headers={"X-Batch-Concurrency": str(limit)},
     )
 
 
+@router.get("/{name_or_uuid}/sessions/{session_id}", response_model=SessionInfo)
+async def get_session(name_or_uuid: str, session_id: str) -> SessionInfo:
+    """查看服务端会话当前保存的历史（已按字节上限裁剪）"""
+    inst = await aget_agent_or_404(name_or_uuid)
+    history = (await get_session_store().aopen(inst.uuid, session_id)).history
+    if not history:
+        raise HTTPException(status_code=404, detail=f"会话不存在：{session_id!r}")
+    return SessionInfo(
+        session_id=session_id,
+        agent_name=inst.name,
+        agent_uuid=inst.uuid,
+        messages=history,
+        total=len(history),
+    )
+
+
+@router.delete("/{name_or_uuid}/sessions/{session_id}")
+async def delete_session(name_or_uuid: str, session_id: str) -> dict:
+    """删除服务端会话（内存 + 落盘日志）"""
+    inst = await aget_agent_or_404(name_or_uuid)
+    if not await get_session_store().adelete(inst.uuid, session_id):
+        raise HTTPException(status_code=404, detail=f"会话不存在：{session_id!r}")
+    return {"status": "ok", "session_id": session_id}
+
+
 @router.post("/{name_or_uuid}/reload")
 async def reload_agent(name_or_uuid: str) -> dict:
     """
     调用 Agent 的 reload()，强制重建 system prompt + 工具列表。
     """
-    inst = get_agent_or_404(name_or_uuid)
+    inst = await aget_agent_or_404(name_or_uuid)
     try:
         inst.reload()
     except Exception as e:  # pragma: no cover
         raise HTTPException(status_code=500, detail=str(e)) from e
+    finally:
+        get_agent_snapshot().invalidate()
+        get_prompt_builder().invalidate(inst)
     return {"status": "ok", "agent": inst.name}
 
 
@@ -250,6 +399,11 @@ async def register_agent_runtime(req: AgentRegistrationRequest) -> AgentRegistra
 
         # 用 tangyuanAI.register_agent 装饰
         decorated = tangyuanAI.register_agent(uid, req.name, req.description)(new_cls)
+        get_agent_snapshot().invalidate()
+        inst = tangyuanAI.agent_list.get(uid)
+        if inst is not None:
+            # 连通性由共享服务探测：同一 provider 已有新鲜结果时不再发请求
+            get_provider_health().subscribe(inst)
         return AgentRegistrationResponse(
             name=req.name,
             uuid=uid,
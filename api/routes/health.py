@@ -1,5 +1,6 @@
 """
-GET /health —— 健康检查 + 当前已注册的 Agent / 工具数量
+GET /health —— 健康检查 + 当前已注册的 Agent / 工具数量 + 对话线程池 / 准入控制 / 会话存储状态
++ LLM 连接池复用情况 + 工具结果缓存命中情况 + 各 LLM provider 的连通性（``api/provider_health.py`` 的缓存结果，不在请求里探测）
 """
 
 from __future__ import annotations
@@ -7,8 +8,14 @@ from __future__ import annotations
 import tangyuanAI
 from fastapi import APIRouter, Depends
 
+from ..admission import get_admission
 from ..deps import get_tool_registry
+from ..executor import get_executor
+from ..http_pool import get_http_pool
 from ..models import HealthResponse
+from ..provider_health import get_provider_health
+from ..sessions import get_session_store
+from ..tool_memo import get_tool_memo
 
 router = APIRouter(tags=["meta"])
 
@@ -21,9 +28,18 @@ async def health(tool_registry=Depends(get_tool_registry)) -> HealthResponse:
     except Exception:
         n_tools = 0
 
+    providers = get_provider_health().statuses()
+    degraded = any(p.status == "down" for p in providers)
+
     return HealthResponse(
-        status="ok",
+        status="degraded" if degraded else "ok",
         version=tangyuanAI.__version__,
         n_agents=len(tangyuanAI.agent_list),
         n_tools=n_tools,
+        executor=get_executor().stats(),
+        admission=get_admission().stats(),
+        sessions=get_session_store().stats(),
+        providers=providers,
+        http_pool=get_http_pool().stats(),
+        tool_cache=get_tool_memo().stats(),
     )
\ No newline at end of file
@@ -0,0 +1,19 @@
+"""
+GET /metrics —— Prometheus 文本格式（0.0.4）的延迟直方图与计数器（见 ``api/metrics.py``）
+"""
+
+from __future__ import annotations
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from ..metrics import render_metrics
+
+router = APIRouter(tags=["meta"])
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    return PlainTextResponse(render_metrics(), media_type=CONTENT_TYPE)
@@ -24,6 +24,7 @@ from ..models import (
     SkillRegisterRequest,
     SkillScanRequest,
 )
+from ..registry import get_registry_watcher
 
 router = APIRouter(prefix="/skills", tags=["skills"])
 
@@ -101,6 +102,8 @@ async def reload_skill(name: str) -> dict:
     if skill is None:
         raise HTTPException(status_code=404, detail=f"Skill 不存在：{name!r}")
     skill.reload()
+    # Skill 对象原地改了内容，注册表本身没有写入：手动通知 prompt 的 skills 段作废
+    get_registry_watcher().bump("skills")
     return {"status": "ok", "name": name}
 
 
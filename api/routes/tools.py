@@ -6,45 +6,30 @@ POST /tools —— 运行时注册工具（通过 module:function 路径）
 from __future__ import annotations
 
 import importlib
-from typing import Any, List
+from typing import Any
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 
 from ..deps import get_tool_registry
 from ..models import (
-    ToolInfo,
     ToolListResponse,
     ToolRegistrationRequest,
     ToolRegistrationResponse,
 )
+from ..snapshots import get_tool_snapshot
 
 router = APIRouter(prefix="/tools", tags=["tools"])
 
 
 @router.get("", response_model=ToolListResponse)
-async def list_tools(registry: Any = Depends(get_tool_registry)) -> ToolListResponse:
+async def list_tools(request: Request, registry: Any = Depends(get_tool_registry)) -> Response:
     """
-    列出全部工具。``description`` 来自工具注册时提供的元数据；
-    ``allowed_agents`` 暂时为 None（ACL 信息需要 tool_registry 暴露更多接口）。
-    """
-    raw = registry.list_tools() or []
-    info = {}
-    try:
-        info = registry.get_all_tools_info() or {}
-    except Exception:
-        pass
+    列出全部工具（``description`` / ``allowed_agents`` 来自注册时的元数据）。
 
-    items: List[ToolInfo] = []
-    for name in raw:
-        meta = info.get(name, {})
-        items.append(
-            ToolInfo(
-                name=name,
-                description=meta.get("description", "") if isinstance(meta, dict) else "",
-                allowed_agents=None,  # 留给后续版本
-            )
-        )
-    return ToolListResponse(tools=items, total=len(items))
+    响应体来自预先算好的快照（``api/snapshots.py``），注册表变了才重建；
+    带 ``ETag`` / ``X-Registry-Version``，``If-None-Match`` 命中时返 304。
+    """
+    return get_tool_snapshot().respond(registry, request)
 
 
 @router.post("", response_model=ToolRegistrationResponse)
@@ -90,6 +75,7 @@ async def register_tool_runtime(req: ToolRegistrationRequest, registry: Any = De
         )(func)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"register_tool 失败：{e}") from e
+    get_tool_snapshot().invalidate()
 
     return ToolRegistrationResponse(
         name=req.name,
@@ -0,0 +1,17 @@
+"""
+GET /usage —— 按 Agent × 模型汇总的 token 用量账本（provider 报告的用量，进程启动以来累计）
+"""
+
+from __future__ import annotations
+
+from fastapi import APIRouter
+
+from ..models import UsageLedgerResponse
+from ..usage import get_usage_ledger
+
+router = APIRouter(tags=["meta"])
+
+
+@router.get("/usage", response_model=UsageLedgerResponse)
+async def usage_ledger() -> UsageLedgerResponse:
+    return get_usage_ledger().snapshot()
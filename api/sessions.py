@@ -0,0 +1,345 @@
+"""
+服务端会话：``session_id`` → 对话历史，LRU + 空闲 TTL + 单会话字节上限，可选落盘。
+
+为什么需要？
+
+每个 chat 请求跑在独立的 Agent 副本上（``api/pool.py``），副本结束即重置，
+服务端不保留上下文；客户端想多轮对话只能每次把整段历史发回来，而路由又只转发
+最后一条 user 消息。这里补上会话：
+
+- 请求带 ``session_id``：副本先装上该会话的历史再跑，跑完把本轮新增的消息追加回去
+- 新会话（store 里没有）：请求 ``messages`` 里最后一条 user 之前的非 system 消息作为初始历史
+- 续聊只需发新的 user 消息
+
+内存有界：
+
+1. **LRU**（``CHAT_SESSION_MAX``）：会话数超限时淘汰最久未用的
+2. **空闲 TTL**（``CHAT_SESSION_TTL``）：超过 TTL 未用的会话在下次访问 store 时清掉
+3. **单会话字节上限**（``CHAT_SESSION_MAX_BYTES``）：按 JSON 编码字节数计，超限从最早的
+   消息开始丢，并保证保留下来的历史从一条 user 消息开头（不留孤立的 assistant / tool 消息）
+
+可选落盘（``CHAT_SESSION_SPILL_DIR``）：每条新增消息追加一行到该会话的 append-only
+JSONL 日志；会话被 LRU / TTL 淘汰出内存后，下次访问从日志重放（同样只取字节上限内的尾部）。
+日志超过字节上限的 4 倍时原子重写为当前尾部，磁盘占用也有界。文件 I/O 只持该会话的日志锁，
+不占 store 锁；async 路由用 ``aopen`` / ``adelete`` / ``acommit``，落盘时放到线程池里跑。
+
+同一会话的并发请求各自基于开始时的历史运行，结束后按完成顺序追加。
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from .env import env_float, env_int
+from .models import SessionStats
+
+# 日志超过字节上限的多少倍时压缩
+_COMPACT_FACTOR = 4
+# 日志锁分条数
+_LOG_LOCK_STRIPES = 64
+
+
+def _encode(message: Dict[str, Any]) -> str:
+    return json.dumps(message, ensure_ascii=False, default=str)
+
+
+class _Session:
+    __slots__ = ("messages", "sizes", "nbytes", "last_used", "log_bytes")
+
+    def __init__(self):
+        self.messages: List[Dict[str, Any]] = []
+        self.sizes: List[int] = []
+        self.nbytes = 0
+        self.last_used = time.monotonic()
+        self.log_bytes = 0
+
+
+class SessionHandle:
+    """
+    一次请求对某个会话的视图：``history`` 是开始时的历史快照，
+    ``commit(new_messages)`` 把本轮新增消息追加回 store。
+    """
+
+    __slots__ = ("store", "key", "session_id", "history")
+
+    def __init__(self, store: "SessionStore", key: Tuple[str, str], history: List[Dict[str, Any]]):
+        self.store = store
+        self.key = key
+        self.session_id = key[1]
+        self.history = history
+
+    def commit(self, new_messages: List[Dict[str, Any]]) -> None:
+        self.store.append(self.key, new_messages)
+
+    async def acommit(self, new_messages: List[Dict[str, Any]]) -> None:
+        """``commit`` 的 async 版（原生异步引擎用）：开启落盘时写日志放到线程池里"""
+        if not self.store.spill_dir:
+            self.commit(new_messages)
+            return
+        await run_in_threadpool(self.commit, new_messages)
+
+
+class SessionStore:
+    """按 ``(agent_uuid, session_id)`` 保存对话历史。线程安全。"""
+
+    def __init__(
+        self,
+        max_sessions: Optional[int] = None,
+        idle_ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        spill_dir: Optional[str] = None,
+    ):
+        self.max_sessions = max_sessions if max_sessions is not None else env_int("CHAT_SESSION_MAX", 1024)
+        self.idle_ttl = idle_ttl if idle_ttl is not None else env_float("CHAT_SESSION_TTL", 1800.0)
+        self.max_bytes = max_bytes if max_bytes is not None else env_int("CHAT_SESSION_MAX_BYTES", 256 * 1024)
+        if spill_dir is None:
+            spill_dir = os.getenv("CHAT_SESSION_SPILL_DIR", "")
+        self.spill_dir = spill_dir or None
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[Tuple[str, str], _Session]" = OrderedDict()
+        self._evicted = 0
+        self._expired = 0
+        self._trimmed = 0
+        self._restored = 0
+        # 日志锁：同一会话的落盘按顺序进行，文件 I/O 不占 store 锁
+        self._log_locks = [threading.RLock() for _ in range(_LOG_LOCK_STRIPES)]
+
+    # ---- 公共 API ----
+
+    def open(
+        self,
+        agent_uuid: str,
+        session_id: str,
+        seed: Optional[List[Dict[str, Any]]] = None,
+    ) -> SessionHandle:
+        """
+        取会话（必要时从日志重放 / 新建）。开启落盘时可能要读文件，async 路由请用 ``aopen``。
+
+        Args:
+            seed: 会话不存在时用作初始历史；已存在则忽略
+        """
+        key = (agent_uuid, session_id)
+        with self._lock:
+            self._expire()
+            sess = self._sessions.get(key)
+            if sess is not None:
+                self._sessions.move_to_end(key)
+                sess.last_used = time.monotonic()
+                return SessionHandle(self, key, list(sess.messages))
+
+        # 内存里没有：先试着从日志重放，再退回 seed。持该会话的日志锁，读文件时不挡其它会话
+        with self._log_lock(key):
+            restored = self._restore(key)
+            if restored is None:
+                if seed:
+                    self.append(key, seed)
+            with self._lock:
+                if restored is not None:
+                    self._sessions.setdefault(key, restored)
+                    self._evict()
+                sess = self._sessions.get(key)
+                return SessionHandle(self, key, list(sess.messages) if sess else [])
+
+    async def aopen(
+        self,
+        agent_uuid: str,
+        session_id: str,
+        seed: Optional[List[Dict[str, Any]]] = None,
+    ) -> SessionHandle:
+        """``open`` 的 async 版：开启落盘时放到线程池里跑，不在 event loop 上读日志"""
+        if not self.spill_dir:
+            return self.open(agent_uuid, session_id, seed)
+        return await run_in_threadpool(self.open, agent_uuid, session_id, seed)
+
+    def append(self, key: Tuple[str, str], messages: List[Dict[str, Any]]) -> None:
+        """追加消息（超过字节上限从头部裁剪）；开启落盘时同步写日志（只持该会话的日志锁）"""
+        if not messages:
+            return
+        lines = [_encode(m) for m in messages]
+        if not self.spill_dir:
+            with self._lock:
+                self._append(key, messages, lines)
+            return
+        # 日志锁在 store 锁之外：同一会话的追加按顺序落盘，文件 I/O 期间其它会话照常读写
+        with self._log_lock(key):
+            with self._lock:
+                missing = key not in self._sessions
+            # 请求进行中会话被淘汰出内存：先从日志重放，否则会从空历史接着追加，压缩时还会把旧消息写丢
+            restored = self._restore(key) if missing else None
+            with self._lock:
+                if restored is not None:
+                    self._sessions.setdefault(key, restored)
+                sess = self._append(key, messages, lines)
+            self._write_log(key, sess, lines)
+
+    def delete(self, agent_uuid: str, session_id: str) -> bool:
+        """删除会话（内存 + 日志）；返回是否存在过"""
+        key = (agent_uuid, session_id)
+        with self._lock:
+            existed = self._sessions.pop(key, None) is not None
+        if self.spill_dir:
+            with self._log_lock(key):
+                try:
+                    os.remove(self._log_path(key))
+                    existed = True
+                except FileNotFoundError:
+                    pass
+        return existed
+
+    async def adelete(self, agent_uuid: str, session_id: str) -> bool:
+        """``delete`` 的 async 版：开启落盘时放到线程池里删日志"""
+        if not self.spill_dir:
+            return self.delete(agent_uuid, session_id)
+        return await run_in_threadpool(self.delete, agent_uuid, session_id)
+
+    def stats(self) -> SessionStats:
+        with self._lock:
+            return SessionStats(
+                max_sessions=self.max_sessions,
+                idle_ttl=self.idle_ttl,
+                max_bytes=self.max_bytes,
+                spill=bool(self.spill_dir),
+                sessions=len(self._sessions),
+                bytes=sum(s.nbytes for s in self._sessions.values()),
+                evicted=self._evicted,
+                expired=self._expired,
+                trimmed=self._trimmed,
+                restored=self._restored,
+            )
+
+    # ---- 内部（调用方持锁） ----
+
+    def _append(self, key: Tuple[str, str], messages: List[Dict[str, Any]], lines: List[str]) -> _Session:
+        sess = self._sessions.get(key)
+        if sess is None:
+            sess = self._sessions[key] = _Session()
+        self._sessions.move_to_end(key)
+        sess.last_used = time.monotonic()
+        for m, line in zip(messages, lines):
+            size = len(line.encode("utf-8"))
+            sess.messages.append(m)
+            sess.sizes.append(size)
+            sess.nbytes += size
+        self._trim(sess)
+        self._evict()
+        return sess
+
+    def _expire(self) -> None:
+        """OrderedDict 按最近使用排序，从头部清掉过期的"""
+        if self.idle_ttl <= 0:
+            return
+        cutoff = time.monotonic() - self.idle_ttl
+        while self._sessions:
+            key, sess = next(iter(self._sessions.items()))
+            if sess.last_used > cutoff:
+                break
+            del self._sessions[key]
+            self._expired += 1
+
+    def _evict(self) -> None:
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self._evicted += 1
+
+    def _trim(self, sess: _Session) -> None:
+        """超过字节上限：从最早的消息开始丢，直到够小且以 user 消息开头"""
+        if sess.nbytes <= self.max_bytes:
+            return
+        drop = 0
+        nbytes = sess.nbytes
+        n = len(sess.messages)
+        while drop < n and (
+            nbytes > self.max_bytes
+            or sess.messages[drop].get("role") != "user"
+        ):
+            nbytes -= sess.sizes[drop]
+            drop += 1
+        del sess.messages[:drop]
+        del sess.sizes[:drop]
+        sess.nbytes = nbytes
+        self._trimmed += drop
+
+    # ---- 落盘（调用方持该会话的日志锁，不持 store 锁） ----
+
+    def _log_lock(self, key: Tuple[str, str]) -> "threading.RLock":
+        """按会话分条的日志锁：固定条数，不随会话数增长"""
+        return self._log_locks[hash(key) % len(self._log_locks)]
+
+    def _log_path(self, key: Tuple[str, str]) -> str:
+        digest = hashlib.sha1("\0".join(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.spill_dir, f"{digest}.jsonl")
+
+    def _write_log(self, key: Tuple[str, str], sess: _Session, lines: List[str]) -> None:
+        path = self._log_path(key)
+        data = "".join(line + "\n" for line in lines).encode("utf-8")
+        if sess.log_bytes + len(data) > _COMPACT_FACTOR * self.max_bytes:
+            # 压缩：原子重写为当前（已裁剪的）历史；同一会话的追加都在日志锁里，快照期间不会再变
+            with self._lock:
+                messages = list(sess.messages)
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                for m in messages:
+                    f.write((_encode(m) + "\n").encode("utf-8"))
+                sess.log_bytes = f.tell()
+            os.replace(tmp, path)
+            return
+        with open(path, "ab") as f:
+            f.write(data)
+        sess.log_bytes += len(data)
+
+    def _restore(self, key: Tuple[str, str]) -> Optional[_Session]:
+        """从 append-only 日志重放会话（只保留字节上限内的尾部）"""
+        if not self.spill_dir:
+            return None
+        try:
+            with open(self._log_path(key), "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return None
+        sess = _Session()
+        sess.log_bytes = len(raw)
+        for line in raw.decode("utf-8").splitlines():
+            if not line:
+                continue
+            try:
+                m = json.loads(line)
+            except ValueError:
+                # 进程崩溃时可能留下半行
+                continue
+            size = len(line.encode("utf-8"))
+            sess.messages.append(m)
+            sess.sizes.append(size)
+            sess.nbytes += size
+        with self._lock:
+            self._trim(sess)
+            self._restored += 1
+        return sess
+
+
+# ---------------------------------------------------------------------------
+# 进程级单例
+# ---------------------------------------------------------------------------
+
+_default_store: Optional[SessionStore] = None
+_default_lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    """返回进程级默认 SessionStore"""
+    global _default_store
+    if _default_store is None:
+        with _default_lock:
+            if _default_store is None:
+                _default_store = SessionStore()
+    return _default_store
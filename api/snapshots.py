@@ -0,0 +1,215 @@
+"""
+注册表快照：``GET /agents`` / ``GET /tools`` 的响应体预先算好，注册表变了才重建；配合 ETag / 304。
+
+为什么需要？
+
+面板、sidecar 会不停轮询这两个端点。以前每次都要遍历双 key 的 ``agent_list`` 按 uuid 去重、
+逐个 ``getattr`` 拼 ``AgentInfo``，再由 FastAPI 校验、序列化一遍 —— 注册表几乎从不变，
+这些都是重复劳动。
+
+这里每个注册表一份 ``RegistrySnapshot``：
+
+- **版本号**：单调递增，注册表每变一次 +1（响应头 ``X-Registry-Version``）
+- **不可变快照**：响应体 JSON 字节 + ETag（响应体的 sha1，多 worker 间也一致），只在变化时重建
+- **变化检测（工具表）**：指纹取 ``api.registry`` 的 ``RegistryWatcher.version``，O(1)；传进来的不是被接管的
+  那份注册表时（测试里的 dependency override）退回到比较 ``tool_registry.list_tools()``
+- **变化检测（Agent 表）**：``agent_list`` / ``agent_template_pool`` 是 tangyuanAI 的模块全局 dict，
+  很多地方 ``from tangyuanAI.Agent_list import agent_list`` 拿着原对象直接写，不能换成会回调的 dict。
+  指纹取两张表的大小（增删条目立刻发现）+ 每 ``REGISTRY_SNAPSHOT_RESCAN`` 秒全量取一次的条目元组：
+  两次扫描之间比较的是同一个元组对象，按身份短路，O(1)；同一个 key 换了实例这类大小不变的改动最多晚
+  一个扫描周期。快照持有旧条目的引用，实例 id 不会被复用
+- 惰性激活模式下，未激活的模板（``agent_template_pool``）也在快照里
+- API 自己改注册表的路径（注册 / reload / 惰性激活）额外 ``invalidate()``，不等下次比较
+
+请求带 ``If-None-Match`` 且命中当前 ETag 时直接回 ``304``，不带响应体。
+"""
+
+from __future__ import annotations
+
+import hashlib
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from fastapi import Request, Response
+from pydantic import BaseModel
+
+from .env import env_float
+
+
+class Snapshot:
+    """某个版本的注册表快照（不可变）"""
+
+    __slots__ = ("version", "etag", "body")
+
+    def __init__(self, version: int, body: bytes):
+        self.version = version
+        self.body = body
+        self.etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        """``If-None-Match`` 是否命中（支持多个 ETag、弱校验 ``W/`` 前缀和 ``*``）"""
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*" or tag.removeprefix("W/") == self.etag:
+                return True
+        return False
+
+
+class RegistrySnapshot:
+    """
+    一份注册表的版本化快照。
+
+    Args:
+        fingerprint: ``source -> 可比较的值``，相等即视为注册表没变
+        build: ``fingerprint -> BaseModel``，只在变化时调用
+    """
+
+    def __init__(self, fingerprint: Callable[[Any], Any], build: Callable[[Any], BaseModel]):
+        self._fingerprint = fingerprint
+        self._build = build
+        self._lock = threading.Lock()
+        self._key: Any = None
+        self._version = 0
+        self._snapshot: Optional[Snapshot] = None
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def get(self, source: Any) -> Snapshot:
+        """取当前快照；注册表变了（或被 invalidate）就重建并 +1 版本"""
+        key = self._fingerprint(source)
+        snap = self._snapshot
+        if snap is not None and key == self._key:
+            return snap
+        with self._lock:
+            if self._snapshot is None or key != self._key:
+                self._version += 1
+                body = self._build(key).model_dump_json().encode("utf-8")
+                self._snapshot = Snapshot(self._version, body)
+                self._key = key
+            return self._snapshot
+
+    def invalidate(self) -> None:
+        """强制下次 ``get`` 重建（注册表条目没换、但内容可能变了时用）"""
+        with self._lock:
+            self._snapshot = None
+
+    def respond(self, source: Any, request: Request) -> Response:
+        """按 ``If-None-Match`` 返回 304 或快照响应体"""
+        snap = self.get(source)
+        headers = {"ETag": snap.etag, "X-Registry-Version": str(snap.version)}
+        if snap.matches(request.headers.get("if-none-match")):
+            return Response(status_code=304, headers=headers)
+        return Response(content=snap.body, media_type="application/json", headers=headers)
+
+
+# ---------------------------------------------------------------------------
+# 进程级单例：Agent / 工具注册表
+# ---------------------------------------------------------------------------
+
+def _build_agents(agent_list: Any, pending: Any = ()) -> BaseModel:
+    from .deps import get_agent_info, get_template_info
+    from .models import AgentListResponse
+
+    # Agent 注册时同时登记到 uuid 和 name 两个 key，按 uuid 去重
+    seen = set()
+    items = []
+    for inst in agent_list.values():
+        uuid = getattr(inst, "uuid", None)
+        if uuid and uuid not in seen:
+            seen.add(uuid)
+            items.append(get_agent_info(inst))
+    # 惰性激活模式下还没激活的模板：只用模板元数据，不实例化
+    for _, tpl in pending:
+        info = get_template_info(tpl)
+        if info.uuid not in seen:
+            seen.add(info.uuid)
+            items.append(info)
+    return AgentListResponse(agents=items, total=len(items))
+
+
+def _build_tools(tools: Any) -> BaseModel:
+    from .models import ToolInfo, ToolListResponse
+
+    items = []
+    for name, meta in tools.items():
+        meta = meta if isinstance(meta, dict) else {}
+        allowed = meta.get("allowed_agents")
+        items.append(
+            ToolInfo(
+                name=name,
+                description=meta.get("description") or "",
+                allowed_agents=list(allowed) if allowed is not None else None,
+            )
+        )
+    return ToolListResponse(tools=items, total=len(items))
+
+
+def _pending_templates() -> tuple:
+    from .activation import get_template_activator, lazy_activation_enabled
+
+    return get_template_activator().pending() if lazy_activation_enabled() else ()
+
+
+class _AgentsFingerprint:
+    """``agent_list`` 的指纹：两张表的大小 + 定期全量扫描一次的条目元组（见模块说明）"""
+
+    def __init__(self, rescan: Optional[float] = None):
+        self.rescan = env_float("REGISTRY_SNAPSHOT_RESCAN", 5.0) if rescan is None else rescan
+        self._source: Any = None
+        self._scan: tuple = ()
+        self._scanned_at = 0.0
+
+    def __call__(self, agent_list: Any) -> tuple:
+        from .activation import get_template_activator, lazy_activation_enabled
+
+        _, pool = get_template_activator()._tables()
+        lazy = lazy_activation_enabled()
+        now = time.monotonic()
+        if agent_list is not self._source or now - self._scanned_at >= self.rescan:
+            self._scan = (tuple(agent_list.items()), _pending_templates())
+            self._source, self._scanned_at = agent_list, now
+        return agent_list, len(agent_list), len(pool) if lazy else 0, self._scan
+
+
+def _agents_build(key: tuple) -> BaseModel:
+    # 到这里才取条目（只在变化时走一次）
+    return _build_agents(dict(key[0]), _pending_templates())
+
+
+def _tools_fingerprint(registry: Any) -> tuple:
+    from .registry import get_registry_watcher
+
+    watcher = get_registry_watcher()
+    version = watcher.version
+    if registry is watcher.tool_registry:
+        return id(registry), version
+    return id(registry), registry.list_tools() or {}
+
+
+def _tools_build(key: tuple) -> BaseModel:
+    if isinstance(key[1], int):
+        from .registry import get_registry_watcher
+
+        return _build_tools(get_registry_watcher().tool_registry.list_tools() or {})
+    return _build_tools(key[1])
+
+
+# 指纹带上注册表对象本身的 id：测试里替换注册表（dependency override）时也会重建
+_agents = RegistrySnapshot(_AgentsFingerprint(), _agents_build)
+_tools = RegistrySnapshot(_tools_fingerprint, _tools_build)
+
+
+def get_agent_snapshot() -> RegistrySnapshot:
+    """返回 Agent 注册表的快照（``GET /agents``）"""
+    return _agents
+
+
+def get_tool_snapshot() -> RegistrySnapshot:
+    """返回工具注册表的快照（``GET /tools``）"""
+    return _tools
+
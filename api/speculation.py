@@ -0,0 +1,159 @@
+"""
+流式工具调用的投机执行：一个工具调用在流里收完整就开始执行，不等整条回复结束。
+
+tangyuanAI 要等流读到 ``[DONE]``（Anthropic 是 ``message_stop``）才进入工具执行：模型一条回复里先给出
+一个查询、再写几百个 token 的第二个调用时，第一个查询白白等着。这里：
+
+- 计量 transport（``api/transport.py``）发现一个调用的参数已经收完（OpenAI：出现了下一个 ``index``
+  或 ``finish_reason``；Anthropic：``content_block_stop``）就交给 ``ToolSpeculator.start``
+- ``start`` 在共享的工具线程池（``api/tool_dispatch.py``）里执行它，与正常路径一样经过结果缓存和执行策略；
+  线程池没有空闲名额时不等，留给正常路径执行
+- 流结束后照常准备调用（``before`` 钩子 → ``pack`` → 参数校验 → 幂等缓存查找），调用 id / 工具名 / 校验后的参数
+  都对得上时直接等投机执行的结果，对不上（或命中幂等缓存）时照常执行，投机结果丢弃
+
+投机执行只对声明过 ``speculative`` 的工具生效，而且工具还得显式声明 ``parallel_safe=True`` 或 ``cache=``
+（默认值不算），且不是 ``async def``::
+
+    @tangyuanAI.tool_registry.register_tool(name="search", speculative=True, parallel_safe=True)
+
+    class MyAgent(tangyuanAI.Agent):
+        @builtin_tool(description="查目录")
+        @tool_cache(ttl=30)
+        def lookup(self, path: str) -> str: ...
+        lookup.speculative = True
+
+``start`` 和投机执行开始前各检查一次取消（``check_cancelled``），对话取消后不再启动新的投机执行。
+
+仍然存在的限制：
+
+- ``before`` 钩子（含权限、审计之类的否决逻辑）在流结束后才跑，投机执行不经过它们；钩子抛错时投机结果被丢弃，
+  但工具已经执行过了 —— 所以只接受声明了可重复、无副作用的工具（``parallel_safe=True`` / ``cache``）
+- ``pack`` 和 ``current_task_id`` 也在流结束后才设置，工具执行时读不到本次调用的 task id
+- 参数在流结束后被 ``before`` 钩子改写时，参数对不上，投机结果丢弃、工具再执行一次
+``TOOL_SPECULATION=0`` 全局关闭。``install_speculation`` 由 ``AgentPool`` 在派生副本时调用，只改副本实例属性；
+工具执行没有被并发版接管的 Agent（子类覆写过）不装。
+"""
+
+from __future__ import annotations
+
+import inspect
+import logging
+import os
+import threading
+from concurrent.futures import Future
+from typing import Any, Dict, Optional, Set, Tuple
+
+from .cancellation import check_cancelled
+from .metrics import TOOL_SPECULATION
+from .tool_dispatch import builtin_tool_names, declared_parallel_safe, get_tool_dispatcher, is_parallel_safe
+from .tool_memo import ToolMemo, get_tool_memo
+
+logger = logging.getLogger(__name__)
+
+
+def speculation_enabled() -> bool:
+    return os.getenv("TOOL_SPECULATION", "1").lower() not in ("0", "false", "no")
+
+
+def is_speculative(agent: Any, name: str, builtins: Optional[frozenset] = None) -> bool:
+    """
+    该工具是否声明了 ``speculative`` 且满足投机执行的条件：显式声明 ``parallel_safe=True`` 或 ``cache``、
+    不是 ``async def``、有权限
+    """
+    if builtins is None:
+        builtins = builtin_tool_names(agent)
+    if name in builtins:
+        func = getattr(agent, name, None)
+        if not getattr(func, "speculative", False):
+            return False
+    else:
+        from tangyuanAI.agent_tool import tool_registry
+
+        info = tool_registry.get_tool_info(name) or {}
+        if not info.get("speculative") or not tool_registry.check_permission(agent.uuid, name):
+            return False
+        func = info.get("function")
+    if inspect.iscoroutinefunction(func) or not is_parallel_safe(agent, name, builtins):
+        return False
+    return (declared_parallel_safe(agent, name, builtins) is True
+            or ToolMemo.spec_for(agent, name, builtins) is not None)
+
+
+class ToolSpeculator:
+    """一个 Agent 副本的投机执行：每次 LLM 请求开始时 ``reset``，流里 ``start``，流结束后准备调用时 ``take``"""
+
+    def __init__(self, agent: Any):
+        self.agent = agent
+        self._lock = threading.Lock()
+        self._started: Dict[str, Tuple[str, Dict[str, Any], Future]] = {}
+        self._seen: Set[str] = set()
+
+    def reset(self) -> None:
+        """新的一次 LLM 请求：上一轮没被认领的投机执行记为 wasted"""
+        with self._lock:
+            leftovers, self._started, self._seen = self._started, {}, set()
+        for name, _, _ in leftovers.values():
+            TOOL_SPECULATION.inc(name, "wasted")
+
+    def start(self, tool_call: Any) -> None:
+        """一个调用的参数已经收完整：满足条件且线程池有空闲名额时开始执行（同一个调用 id 只处理一次）"""
+        from tangyuanAI.agent_tool import _validate_tool_args_for
+
+        check_cancelled()
+        call_id, name = tool_call.id, tool_call.name
+        with self._lock:
+            if not call_id or call_id in self._seen:
+                return
+            self._seen.add(call_id)
+        agent = self.agent
+        builtins = builtin_tool_names(agent)
+        if not is_speculative(agent, name, builtins):
+            return
+        try:
+            args = _validate_tool_args_for(agent, name, dict(tool_call.arguments))
+        except Exception:  # noqa: BLE001 - 校验失败留给正常路径报错
+            return
+
+        memo = get_tool_memo()
+
+        def job():
+            # 排队期间对话可能已经取消（线程池带着调用方的 context，取得到取消标记）
+            check_cancelled()
+            return memo.run(agent, name, args, builtins, lambda: agent._dispatch_tool(name, args))
+
+        future = get_tool_dispatcher().try_submit(job)
+        if future is None:
+            TOOL_SPECULATION.inc(name, "skipped")
+            return
+        with self._lock:
+            self._started[call_id] = (name, args, future)
+        TOOL_SPECULATION.inc(name, "started")
+        logger.debug("投机执行工具 %s（%s）", name, call_id)
+
+    def take(self, call_id: str, name: str, args: Any) -> Optional[Future]:
+        """认领投机执行：调用 id、工具名、校验后的参数都一致时返回它的 Future，否则返回 None"""
+        with self._lock:
+            entry = self._started.pop(call_id, None)
+        if entry is None:
+            return None
+        started_name, started_args, future = entry
+        if started_name != name or started_args != args:
+            TOOL_SPECULATION.inc(started_name, "wasted")
+            return None
+        TOOL_SPECULATION.inc(name, "used")
+        return future
+
+
+def install_speculation(agent: Any) -> None:
+    """给已经换上并发版工具执行的 Agent 副本装上投机执行（只改实例属性）"""
+    if not speculation_enabled():
+        return
+    if "_execute_tool_calls" not in vars(agent) and "_finish_anthropic_round" not in vars(agent):
+        return
+    from .transport import is_metered_transport
+
+    speculator = agent._tool_speculator = ToolSpeculator(agent)
+    # Anthropic 的 transport 由 _build_anthropic_request 构造，直接读 agent._tool_speculator
+    if is_metered_transport(getattr(agent, "_transport_cls", None)):
+        transport_kwargs = agent._transport_kwargs
+        agent._transport_kwargs = lambda: {**transport_kwargs(), "speculator": speculator}
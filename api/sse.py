@@ -0,0 +1,311 @@
+"""
+LLM provider 流式响应（SSE）的字节级解析：计量 transport（``api/transport.py``）读流用它，不再逐行解码成 str。
+
+tangyuanAI 的 ``_iter_openai_sse`` / ``_iter_anthropic_sse`` 对 ``iter_lines()`` 的每一行先解码成 str、
+再 ``json.loads``；Anthropic 的 ``message_start`` 为了取输入 token 还要在这边再解析一遍。一条回复几百个 chunk、
+很多对话并发时，这部分在 worker CPU 里占比不小。这里：
+
+- ``SSEFramer``：按收到的字节块增量切行，只认 ``event:`` / ``data:`` 两种字段，全程是 bytes；
+  注释行（``: keep-alive``）和 ``ping`` 事件直接丢掉，不做 JSON 解析
+- ``data`` 的负载直接交给 JSON 解码：装了 ``orjson`` 用它（直接吃 bytes），没装用标准库 ``json``
+- ``OpenAIStream`` / ``AnthropicStream``：与 tangyuanAI 的 ``_process_openai_sse_line`` /
+  ``_process_anthropic_sse_line`` 相同的状态机，只是输入换成解码好的 dict，产出的 ``LLMEvent`` 完全一致；
+  Anthropic 的 ``message_start`` usage 顺带记下，合进最终 usage
+
+Responses 协议仍走 tangyuanAI 的逐行解析。
+
+微基准（重放录下来的原始 SSE 流，对比逐行解析，输出每秒处理的 chunk 数；不给文件时用合成的流）::
+
+    python -m api.sse [recorded.sse | session.jsonl.gz ...] [--repeat N]
+
+``*.jsonl`` / ``*.jsonl.gz`` 按 ``api/llm_replay.py`` 的录制文件读，取其中的流式响应体。
+"""
+
+from __future__ import annotations
+
+import json
+import time
+import uuid
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from tangyuanAI.llm_transport import (
+    LLMEvent,
+    ToolCall,
+    UsageInfo,
+    _AnthropicSSEState,
+    _OpenAISSEState,
+    _parse_json_args,
+    _parse_usage_anthropic,
+    _parse_usage_safe,
+)
+
+try:
+    import orjson
+
+    loads: Callable[[Any], Any] = orjson.loads
+    JSON_BACKEND = "orjson"
+    _DECODE_ERRORS: Tuple[type, ...] = (orjson.JSONDecodeError, UnicodeDecodeError)
+except ImportError:  # pragma: no cover - orjson 可选
+    loads = json.loads
+    JSON_BACKEND = "json"
+    _DECODE_ERRORS = (ValueError,)
+
+Frame = Tuple[Optional[bytes], bytes]   # (event 名, data 负载)
+
+_PING = b"ping"   # Anthropic 的心跳：event: ping
+
+
+class SSEFramer:
+    """按字节块增量切出 SSE 的 ``(event, data)`` 帧；跨块的半行留到下一块"""
+
+    __slots__ = ("_buf", "_event")
+
+    def __init__(self):
+        self._buf = b""
+        self._event: Optional[bytes] = None
+
+    def feed(self, chunk: bytes) -> List[Frame]:
+        buf = self._buf + chunk if self._buf else chunk
+        frames: List[Frame] = []
+        start = 0
+        while True:
+            end = buf.find(b"\n", start)
+            if end < 0:
+                break
+            self._line(buf[start:end], frames)
+            start = end + 1
+        self._buf = buf[start:]
+        return frames
+
+    def close(self) -> List[Frame]:
+        """流结束：最后一行没有换行符时也处理掉"""
+        frames: List[Frame] = []
+        if self._buf:
+            self._line(self._buf, frames)
+            self._buf = b""
+        return frames
+
+    def _line(self, line: bytes, frames: List[Frame]) -> None:
+        if line.endswith(b"\r"):
+            line = line[:-1]
+        if not line:
+            self._event = None              # 空行：一个事件结束
+        elif line.startswith(b"data:"):
+            payload = line[6:] if line.startswith(b"data: ") else line[5:]
+            if self._event != _PING:
+                frames.append((self._event, payload))
+        elif line.startswith(b"event:"):
+            self._event = line[6:].strip()
+        # 其余（":" 开头的注释 / 心跳、id:、retry:）不关心
+
+
+def iter_frames(chunks: Iterable[bytes]) -> Iterator[Frame]:
+    framer = SSEFramer()
+    for chunk in chunks:
+        yield from framer.feed(chunk)
+    yield from framer.close()
+
+
+async def aiter_frames(chunks: AsyncIterable[bytes]) -> AsyncIterator[Frame]:
+    framer = SSEFramer()
+    async for chunk in chunks:
+        for frame in framer.feed(chunk):
+            yield frame
+    for frame in framer.close():
+        yield frame
+
+
+class OpenAIStream(_OpenAISSEState):
+    """OpenAI Chat Completions SSE 的状态机（语义同 tangyuanAI 的 ``_process_openai_sse_line``）"""
+
+    def feed(self, payload: bytes) -> List[LLMEvent]:
+        if payload == b"[DONE]":
+            out = [
+                LLMEvent(type="tool_call", tool_call=ToolCall(
+                    id=slot["id"] or str(uuid.uuid4()),
+                    name=slot["name"],
+                    arguments=_parse_json_args(slot["arguments"]),
+                ))
+                for slot in self.current_calls.values()
+            ]
+            out.append(LLMEvent(type="done", stop_reason=self.finish_reason, usage=self.usage, raw=None))
+            return out
+        try:
+            chunk = loads(payload)
+        except _DECODE_ERRORS:
+            return []
+        if not isinstance(chunk, dict):
+            return []
+        out: List[LLMEvent] = []
+        for choice in chunk.get("choices") or ():
+            delta = choice.get("delta") or {}
+            self.finish_reason = choice.get("finish_reason") or self.finish_reason
+            content = delta.get("content")
+            if content:
+                out.append(LLMEvent(type="text", text=content))
+            for tc in delta.get("tool_calls") or ():
+                fn = tc.get("function") or {}
+                slot = self.current_calls.setdefault(tc.get("index", 0), {
+                    "id": tc.get("id", ""),
+                    "name": fn.get("name", ""),
+                    "arguments": "",
+                })
+                if tc.get("id"):
+                    slot["id"] = tc["id"]
+                if fn.get("name"):
+                    slot["name"] = fn["name"]
+                if fn.get("arguments"):
+                    slot["arguments"] += fn["arguments"]
+        if chunk.get("usage"):
+            self.usage = _parse_usage_safe(chunk)
+        return out
+
+
+class AnthropicStream(_AnthropicSSEState):
+    """Anthropic Messages SSE 的状态机（语义同 tangyuanAI 的 ``_process_anthropic_sse_line``）"""
+
+    def __init__(self, parse_usage: Callable[[Dict[str, Any]], Optional[UsageInfo]] = _parse_usage_anthropic):
+        super().__init__(parse_usage)
+        self.start_usage: Dict[str, Any] = {}     # message_start 里的输入侧 usage
+
+    def feed(self, event: Optional[bytes], payload: bytes) -> List[LLMEvent]:
+        try:
+            evt = loads(payload)
+        except _DECODE_ERRORS:
+            return []
+        if not isinstance(evt, dict):
+            return []
+        etype = evt.get("type") or (event.decode() if event else None)
+        out: List[LLMEvent] = []
+        if etype == "content_block_delta":
+            if self.current is None:
+                return out
+            delta = evt.get("delta") or {}
+            if delta.get("type") == "text_delta":
+                chunk = delta.get("text", "")
+                self.current["text"] = self.current.get("text", "") + chunk
+                out.append(LLMEvent(type="text", text=chunk))
+            elif delta.get("type") == "input_json_delta":
+                self.json_buf += delta.get("partial_json", "")
+        elif etype == "content_block_start":
+            cb = evt.get("content_block") or {}
+            self.current = {
+                "type": cb.get("type", "text"),
+                "id": cb.get("id"),
+                "name": cb.get("name"),
+                "text": cb.get("text", "") or "",
+                "input": {},
+            }
+            self.json_buf = ""
+        elif etype == "content_block_stop":
+            if self.current is not None and self.current.get("type") == "tool_use":
+                self.current["input"] = _parse_json_args(self.json_buf)
+                out.append(LLMEvent(type="tool_call", tool_call=ToolCall(
+                    id=self.current.get("id") or str(uuid.uuid4()),
+                    name=self.current.get("name", ""),
+                    arguments=self.current.get("input", {}),
+                )))
+            self.current = None
+            self.json_buf = ""
+        elif etype == "message_start":
+            usage = (evt.get("message") or {}).get("usage")
+            if isinstance(usage, dict):
+                self.start_usage = usage
+        elif etype == "message_delta":
+            delta = evt.get("delta") or {}
+            if "stop_reason" in delta:
+                self.finish_reason = delta["stop_reason"]
+            if "usage" in evt:
+                self.usage = self.parse_usage(evt)
+        elif etype == "message_stop":
+            self.stopped = True
+            out.append(LLMEvent(type="done", stop_reason=self.finish_reason, usage=self.usage, raw=None))
+        return out
+
+
+# ---------------------------------------------------------------------------
+# 微基准
+# ---------------------------------------------------------------------------
+
+def _synthetic_stream(chunks: int = 400) -> bytes:
+    parts = []
+    for i in range(chunks):
+        frame = {
+            "id": "chatcmpl-bench", "object": "chat.completion.chunk", "model": "bench",
+            "choices": [{"index": 0, "delta": {"content": f"第{i}段"}, "finish_reason": None}],
+        }
+        parts.append(b"data: " + json.dumps(frame, ensure_ascii=False).encode() + b"\n\n")
+        if i % 50 == 0:
+            parts.append(b": keep-alive\n\n")
+    parts.append(b"data: [DONE]\n\n")
+    return b"".join(parts)
+
+
+def _split(raw: bytes, size: int = 1024) -> List[bytes]:
+    return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+
+def benchmark(streams: List[bytes], repeat: int = 50) -> Dict[str, float]:
+    """重放原始 SSE 流（按 1 KiB 切块模拟网络读），返回两种解析方式每秒处理的数据帧数"""
+    from tangyuanAI.llm_transport import _process_anthropic_sse_line, _process_openai_sse_line
+
+    def is_anthropic(raw: bytes) -> bool:
+        return b"message_start" in raw[:512]
+
+    def bytes_path(raw: bytes) -> int:
+        frames = 0
+        if is_anthropic(raw):
+            anthropic = AnthropicStream()
+            for event, payload in iter_frames(_split(raw)):
+                frames += 1
+                anthropic.feed(event, payload)
+        else:
+            openai = OpenAIStream()
+            for _, payload in iter_frames(_split(raw)):
+                frames += 1
+                openai.feed(payload)
+        return frames
+
+    def lines_path(raw: bytes) -> int:
+        anthropic = is_anthropic(raw)
+        state: Any = _AnthropicSSEState(_parse_usage_anthropic) if anthropic else _OpenAISSEState()
+        process = _process_anthropic_sse_line if anthropic else _process_openai_sse_line
+        frames = 0
+        for line in raw.decode("utf-8").splitlines():
+            if line.startswith("data: "):
+                frames += 1
+            process(line, state)
+        return frames
+
+    results: Dict[str, float] = {}
+    for label, run in (("bytes", bytes_path), ("lines", lines_path)):
+        started = time.perf_counter()
+        frames = sum(run(raw) for _ in range(repeat) for raw in streams)
+        results[label] = frames / (time.perf_counter() - started)
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="重放 SSE 流，对比字节级与逐行解析的吞吐")
+    parser.add_argument("files", nargs="*", help="原始 SSE 响应体或录制文件（*.jsonl[.gz]）；不给时用合成的 OpenAI 流")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args(argv)
+    streams = []
+    for path in args.files:
+        if ".jsonl" in path:
+            from .llm_replay import Cassette
+
+            streams.extend(e.body for e in Cassette.load(path).exchanges if b"data:" in e.body)
+            continue
+        with open(path, "rb") as f:
+            streams.append(f.read())
+    results = benchmark(streams or [_synthetic_stream()], args.repeat)
+    print(f"JSON 后端：{JSON_BACKEND}")
+    for label, rate in results.items():
+        print(f"{label:>6}: {rate:,.0f} chunks/s")
+
+
+if __name__ == "__main__":
+    main()
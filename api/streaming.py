@@ -0,0 +1,223 @@
+"""
+SSE 输出：事件归一化 + 文本增量合并 + 预编码信封。
+
+为什么需要？
+
+provider 按 token（mock 里甚至按字符）流式返回时，Agent 每个 chunk 都会 ``out`` 一次，
+以前 SSE 端点对每个 chunk 做一次完整的 ``json.dumps``（含重复的 ``agent_name`` /
+``agent_uuid``）+ 一次 socket 写 —— 一段 1KB 的回复就是上千帧。
+
+这里两件事：
+
+1. **增量合并**（``coalesce``）：连续的 ``text`` 增量先攒着，满 ``SSE_COALESCE_BYTES``
+   字节或距第一段超过 ``SSE_COALESCE_MS`` 毫秒就合成一帧发出；遇到非文本事件
+   （tool_call / tool_result / error ...）先把攒着的文本发掉，保证顺序不变
+2. **预编码信封**（``SSEEncoder``）：每个流只把 ``agent_name`` / ``agent_uuid`` 编码一次，
+   文本帧只序列化 delta 字符串本身
+
+帧格式与以前完全一致（``json.dumps`` 默认分隔符、``ensure_ascii=False``），客户端无感；
+只是一帧里的 ``delta`` 可能是多个字符。``SSE_COALESCE_MS=0`` 关闭合并，退回逐 chunk 发送。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Tuple
+
+from fastapi.responses import StreamingResponse
+
+from .env import env_float, env_int
+
+# 默认窗口：20ms / 256 字节，先到先发
+DEFAULT_COALESCE_MS = 20.0
+DEFAULT_COALESCE_BYTES = 256
+
+Event = Tuple[str, Any]
+
+
+def normalize_chunk(chunk: Dict[str, Any]) -> Event:
+    """
+    把 ``Agent.out`` 的 content dict 归一化成 ``(event, data)``。
+
+    兼容旧格式（不是 ``{"event":..., "data":...}``）：
+    ``{"message": "xxx"}`` / ``{"tool_name": "xxx"}`` / ``{"task": True}`` / ``{"tool_result": ...}``
+    """
+    if "event" in chunk:
+        return chunk.get("event"), chunk.get("data", {})
+    if "message" in chunk:
+        return "text", {"delta": chunk.get("message", "")}
+    if "tool_name" in chunk and "tool_result" not in chunk:
+        return "tool_call", {"name": chunk["tool_name"], "input": chunk.get("tool_parameter", {})}
+    if "tool_result" in chunk:
+        return "tool_result", {"name": chunk.get("tool_name"), "result": chunk["tool_result"]}
+    if chunk.get("task"):
+        return "done", {"finish_reason": "stop"}
+    return "text", chunk
+
+
+def _text_delta(event: Any, data: Any) -> Optional[str]:
+    """是纯文本增量（``{"delta": str}``）就返回 delta，否则 None（不参与合并）"""
+    if event == "text" and isinstance(data, dict) and len(data) == 1:
+        delta = data.get("delta")
+        if isinstance(delta, str):
+            return delta
+    return None
+
+
+class SSEEncoder:
+    """
+    单个流的帧编码器：``agent_name`` / ``agent_uuid`` 信封只编码一次。
+
+    产出的帧与 ``json.dumps({"event", "data", "agent_name", "agent_uuid"})`` 逐字节相同。
+    """
+
+    __slots__ = ("_suffix", "_text_prefix", "_done")
+
+    def __init__(self, agent_name: str, agent_uuid: str):
+        self._suffix = (
+            ', "agent_name": ' + json.dumps(agent_name, ensure_ascii=False)
+            + ', "agent_uuid": ' + json.dumps(agent_uuid, ensure_ascii=False)
+            + "}\n\n"
+        )
+        self._text_prefix = 'data: {"event": "text", "data": {"delta": '
+        self._done = self.event("done", {"finish_reason": "stop"})
+
+    def frame(self, event: Any, data: Any) -> str:
+        """按事件类型选编码路径：纯文本增量走快路径"""
+        delta = _text_delta(event, data)
+        if delta is not None:
+            return self.text(delta)
+        return self.event(event, data)
+
+    def text(self, delta: str) -> str:
+        """文本帧：只序列化 delta"""
+        return self._text_prefix + json.dumps(delta, ensure_ascii=False) + "}" + self._suffix
+
+    def event(self, event: Any, data: Any) -> str:
+        """任意事件帧"""
+        return (
+            'data: {"event": ' + json.dumps(event, ensure_ascii=False)
+            + ', "data": ' + json.dumps(data, ensure_ascii=False)
+            + self._suffix
+        )
+
+    def done(self) -> str:
+        return self._done
+
+
+async def coalesce(
+    events: AsyncIterator[Event],
+    *,
+    window_ms: Optional[float] = None,
+    max_bytes: Optional[int] = None,
+) -> AsyncIterator[Event]:
+    """
+    合并连续的文本增量。
+
+    Args:
+        events: ``(event, data)`` 异步迭代器
+        window_ms: 第一段增量进缓冲后最多等多久就发（默认 ``SSE_COALESCE_MS``，20）；
+            ``<= 0`` 关闭合并
+        max_bytes: 缓冲达到多少 UTF-8 字节立刻发（默认 ``SSE_COALESCE_BYTES``，256）
+
+    上游由后台 pump 任务读进本地 queue，这样等待下一个事件时可以带超时；
+    本生成器被关闭（客户端断开）时 pump 随之取消，上游生成器被关闭。
+    """
+    if window_ms is None:
+        window_ms = env_float("SSE_COALESCE_MS", DEFAULT_COALESCE_MS)
+    if max_bytes is None:
+        max_bytes = env_int("SSE_COALESCE_BYTES", DEFAULT_COALESCE_BYTES)
+
+    if window_ms <= 0:
+        async for item in events:
+            yield item
+        return
+
+    window = window_ms / 1000.0
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    end = object()
+
+    async def pump() -> None:
+        try:
+            async for item in events:
+                queue.put_nowait(item)
+        except Exception as e:
+            queue.put_nowait(e)
+        finally:
+            queue.put_nowait(end)
+
+    pump_task = asyncio.create_task(pump())
+
+    buf: list = []
+    buf_bytes = 0
+    deadline = 0.0
+    try:
+        while True:
+            if buf:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    item = None
+                else:
+                    try:
+                        item = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        item = None
+                if item is None:
+                    # 窗口到期
+                    yield "text", {"delta": "".join(buf)}
+                    buf, buf_bytes = [], 0
+                    continue
+            else:
+                item = await queue.get()
+
+            if item is end or isinstance(item, Exception):
+                if buf:
+                    yield "text", {"delta": "".join(buf)}
+                if item is not end:
+                    raise item
+                return
+
+            event, data = item
+            delta = _text_delta(event, data)
+            if delta is not None:
+                if not buf:
+                    deadline = loop.time() + window
+                buf.append(delta)
+                buf_bytes += len(delta.encode("utf-8"))
+                if buf_bytes >= max_bytes:
+                    yield "text", {"delta": "".join(buf)}
+                    buf, buf_bytes = [], 0
+                continue
+
+            # 非文本事件：先把攒着的文本发掉，保证顺序
+            if buf:
+                yield "text", {"delta": "".join(buf)}
+                buf, buf_bytes = [], 0
+            yield event, data
+    finally:
+        if not pump_task.done():
+            pump_task.cancel()
+            try:
+                await pump_task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+
+class GuardedStreamingResponse(StreamingResponse):
+    """
+    响应结束时必定调用一次 ``on_close``。body 生成器里的 ``finally`` 只有生成器启动过才会执行：
+    发响应头时客户端已经断开（``send`` 抛错）、或断开检测先取消了任务组时，生成器根本没启动，
+    靠它归还的资源（准入名额）就永远不还了。``on_close`` 需要是幂等的（生成器的 ``finally`` 也会调）。
+    """
+
+    def __init__(self, content: Any, *, on_close: Callable[[], None], **kwargs: Any):
+        super().__init__(content, **kwargs)
+        self._on_close = on_close
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._on_close()
@@ -0,0 +1,502 @@
+"""
+一轮里的多个工具调用并发执行：模型一次返回多个 ``tool_calls``（OpenAI）/ ``tool_use``（Anthropic）时，
+不再一个跑完再跑下一个。
+
+tangyuanAI 的 ``_execute_tool_calls`` / ``_finish_anthropic_round`` 逐个执行：三个各要 1 秒的查询
+要等 3 秒才发下一次 LLM 请求。这里把每个调用拆成三段：
+
+1. **准备**（调用方线程，按原顺序）：解析参数 → ``before`` 钩子 → ``pack`` 工具调用事件 → 参数校验 → 幂等缓存查找
+2. **执行**（并发）：``_dispatch_tool``。同步路径在有界线程池里跑（``TOOL_PARALLELISM``，池满时由调用方线程自己跑，
+   嵌套的 ``ask_for_help`` 不会因为抢不到线程死锁）；原生异步引擎（``api/async_engine.py``）用 ``asyncio.gather``
+3. **收尾**（调用方线程，按原顺序）：输出校验 → 写幂等缓存 → ``after`` / ``error`` 钩子 → ``pack`` 工具结果 → 回填 history
+
+钩子和事件仍然每个调用各一次，``task_id`` 与调用一一对应；写回 history 的顺序与模型给出的顺序一致。
+与原版的差别只在时序：同一轮所有调用的 ``before`` 钩子都在第一个工具开始执行前触发。
+
+不能并发的工具注册时声明 ``parallel_safe=False``（``install`` 之后 ``tool_registry.register_tool`` 多接受这个参数，
+以及结果缓存的 ``cache=``、执行策略的 ``timeout=`` / ``executor=``、投机执行的 ``speculative=``，
+见 ``api/tool_memo.py`` / ``api/tool_exec.py`` / ``api/speculation.py``）；
+内建工具在方法上设 ``parallel_safe = False`` 属性。这类调用单独执行：排在它前面的调用全部完成后才开始，
+它完成后才开始后面的调用。
+
+``install_parallel_tools`` 由 ``AgentPool`` 在派生副本时调用，只改副本实例属性；对话循环 / 工具执行被子类覆写过的
+Agent 不接管。``TOOL_PARALLELISM=1`` 时退回逐个执行。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+
+from .env import env_int
+from .metrics import TOOL_BATCH_SIZE
+from .tool_exec import check_policy
+from .tool_memo import cache_spec, get_tool_memo
+
+logger = logging.getLogger(__name__)
+
+
+# ---------------------------------------------------------------------------
+# register_tool 的扩展参数：parallel_safe / cache / timeout / executor / speculative
+# ---------------------------------------------------------------------------
+
+def _wrap_register_tool(original: Callable[..., Any]) -> Callable[..., Any]:
+    @functools.wraps(original)
+    def register_tool(
+        *args: Any,
+        parallel_safe: Optional[bool] = None,
+        cache: Any = None,
+        timeout: Optional[float] = None,
+        executor: str = "thread",
+        speculative: bool = False,
+        **kwargs: Any,
+    ) -> Callable[[Any], Any]:
+        spec = cache_spec(cache)
+        check_policy(None, timeout, executor)
+        dec = original(*args, **kwargs)
+
+        def decorator(func: Any) -> Any:
+            check_policy(func, timeout, executor)
+            wrapper = dec(func)
+            from tangyuanAI.agent_tool import tool_registry
+
+            name = kwargs.get("name") or (args[2] if len(args) > 2 else None) or func.__name__
+            info = tool_registry.get_tool_info(name)
+            if info is not None:
+                info["parallel_safe"] = parallel_safe
+                info["cache"] = spec
+                info["timeout"] = float(timeout) if timeout is not None else None
+                info["executor"] = executor
+                info["speculative"] = speculative
+            return wrapper
+
+        return decorator
+
+    register_tool._api_options = True  # type: ignore[attr-defined]
+    return register_tool
+
+
+def install(tool_registry: Any = None) -> None:
+    """
+    让 ``tool_registry.register_tool`` 接受 ``parallel_safe``、``cache``（``api/tool_memo.py``）、
+    ``timeout`` / ``executor``（``api/tool_exec.py``）和 ``speculative``（``api/speculation.py``）；
+    只改注册表实例属性，重复调用无副作用
+    """
+    if tool_registry is None:
+        from tangyuanAI.agent_tool import tool_registry
+    if getattr(tool_registry.register_tool, "_api_options", False):
+        return
+    tool_registry.register_tool = _wrap_register_tool(tool_registry.register_tool)
+
+
+def builtin_tool_names(agent: Any) -> frozenset:
+    """Agent 的内建工具名（优先用 ``api/tool_schemas.py`` 缓存的结果）"""
+    names = getattr(agent._collect_tools_schema(), "builtin_names", None)
+    if names is None:
+        from tangyuanAI.agent_tool import tool_registry
+
+        names = {s["function"]["name"] for s in tool_registry.collect_builtin_tools(agent)}
+    return frozenset(names)
+
+
+def is_parallel_safe(agent: Any, name: str, builtins: Optional[frozenset] = None) -> bool:
+    """该工具能否和同一轮的其他调用并发执行；没声明过（``None``）算可以"""
+    return declared_parallel_safe(agent, name, builtins) is not False
+
+
+def declared_parallel_safe(agent: Any, name: str, builtins: Optional[frozenset] = None) -> Optional[bool]:
+    """工具自己声明的 ``parallel_safe``；没声明过返回 None"""
+    if builtins is None:
+        builtins = builtin_tool_names(agent)
+    if name in builtins:
+        return getattr(getattr(agent, name, None), "parallel_safe", None)
+    from tangyuanAI.agent_tool import tool_registry
+
+    info = tool_registry.get_tool_info(name) or {}
+    return info.get("parallel_safe")
+
+
+# ---------------------------------------------------------------------------
+# 单个调用的准备 / 收尾（与 tangyuanAI 原版语义一致）
+# ---------------------------------------------------------------------------
+
+class ToolCall:
+    """一轮里的一个工具调用：准备阶段填参数，执行阶段填结果，收尾阶段生成回填消息"""
+
+    __slots__ = ("id", "name", "args", "task_id", "meta", "ttl", "cache_key", "cached",
+                 "raw", "async_id", "error", "prepared", "speculated")
+
+    def __init__(self, tool_id: str, name: str):
+        self.id = tool_id
+        self.name = name
+        self.args: Any = None
+        self.task_id: Optional[str] = None
+        self.meta: Dict[str, Any] = {}
+        self.ttl = 0
+        self.cache_key: Optional[str] = None
+        self.cached: Any = None
+        self.raw: Any = None
+        self.async_id: Optional[str] = None
+        self.error: Optional[BaseException] = None
+        self.prepared = False
+        self.speculated: Optional[Future] = None    # 流式阶段已经投机启动的执行（api/speculation.py）
+
+    @property
+    def pending(self) -> bool:
+        """准备成功、没命中缓存，需要真正执行"""
+        return self.prepared and self.cached is None and self.error is None
+
+
+def _take_speculated(agent: Any, call: ToolCall) -> Optional[Future]:
+    speculator = getattr(agent, "_tool_speculator", None)
+    return speculator.take(call.id, call.name, call.args) if speculator is not None else None
+
+
+def prepare_fc_call(agent: Any, tool_call: dict, idem_store: Any) -> ToolCall:
+    """OpenAI FC：解析参数 → before 钩子 → pack → 参数校验 → 幂等缓存查找"""
+    from tangyuanAI.agent_tool import _validate_tool_args_for, tool_registry
+    from tangyuanAI.tool_reliability import IdempotencyStore
+
+    call = ToolCall(tool_call["id"], tool_call["function"]["name"])
+    try:
+        call.args = json.loads(tool_call["function"]["arguments"])
+        agent.current_task_id = call.task_id = agent._generate_task_id()
+        agent._execute_hooks("before", call.name, call.args)
+        logger.debug("调用工具 %s，参数: %s", call.name, call.args)
+        agent.pack(tool_name=call.name, tool_parameter=call.args)
+        call.args = _validate_tool_args_for(agent, call.name, call.args)
+
+        call.meta = tool_registry.get_tool_info(call.name) or {}
+        call.ttl = call.meta.get("idempotency_ttl", 3600)
+        if call.ttl and call.ttl > 0:
+            call.cache_key = IdempotencyStore.compute_key(
+                agent_uuid=agent.uuid or agent.name or "",
+                tool_call_id=call.id or "",
+                tool_name=call.name,
+                args=call.args,
+            )
+            call.cached = idem_store.get(call.cache_key)
+            if call.cached is not None:
+                logger.debug("tool %s 命中 idempotency cache", call.name)
+        call.prepared = True
+        if call.cached is None:
+            call.speculated = _take_speculated(agent, call)
+    except Exception as e:
+        call.error = e
+    return call
+
+
+def finish_fc_call(agent: Any, call: ToolCall, idem_store: Any) -> dict:
+    """OpenAI FC：输出校验 → 写幂等缓存 → after / error 钩子 → pack 结果；返回要回填的 tool 消息"""
+    from tangyuanAI.tool_reliability import VerifiableToolResult, validate_output
+
+    if call.error is not None and not isinstance(call.error, Exception):
+        raise call.error  # 取消等非 Exception 照原样往外抛
+    agent.current_task_id = call.task_id
+    try:
+        if call.error is not None:
+            raise call.error
+        if call.cached is not None:
+            result = call.cached.to_dict()
+        elif call.async_id is not None:
+            result = {
+                "ok": True,
+                "value": f"[tool {call.name} still running in background as task_id={call.async_id}]",
+                "schema_validated": False,
+                "retry_count": 0,
+            }
+        else:
+            schema = call.meta.get("output_schema")
+            ok, err_msg, validated_value = validate_output(call.raw, schema)
+            result = {
+                "ok": ok,
+                "value": validated_value if ok else None,
+                "error": err_msg,
+                "raw": call.raw,
+                "schema_validated": schema is not None,
+                "retry_count": 0,
+            }
+            if call.cache_key is not None:
+                idem_store.set(
+                    call.cache_key,
+                    VerifiableToolResult(
+                        ok=result["ok"],
+                        value=result["value"],
+                        error=result["error"],
+                        raw=result["raw"],
+                        schema_validated=result["schema_validated"],
+                        retry_count=result["retry_count"],
+                    ),
+                    ttl=call.ttl,
+                )
+        agent._execute_hooks("after", call.name, call.args, result)
+        agent.pack(tool_result=result, tool_name=call.name)
+        return {"tool_call_id": call.id, "name": call.name, "content": result}
+    except Exception as e:
+        error_msg = f"执行工具 {call.name} 时出错: {str(e)}"
+        logger.error(error_msg)
+        if call.args is not None:
+            agent._execute_hooks("error", call.name, call.args, error_msg)
+        return {"tool_call_id": call.id, "name": call.name, "content": error_msg}
+
+
+def prepare_tool_use(agent: Any, tu: dict) -> ToolCall:
+    """Anthropic：before 钩子 → pack"""
+    call = ToolCall(tu["id"], tu["name"])
+    call.args = tu["input"]
+    agent.current_task_id = call.task_id = agent._generate_task_id()
+    agent._execute_hooks("before", call.name, call.args)
+    agent.pack(tool_model=True, tool_name=call.name, tool_parameter=call.args)
+    call.prepared = True
+    call.speculated = _take_speculated(agent, call)
+    return call
+
+
+def finish_tool_use(agent: Any, call: ToolCall) -> dict:
+    """Anthropic：after / error 钩子 → pack 结果；返回 tool_result block"""
+    if call.error is not None and not isinstance(call.error, Exception):
+        raise call.error
+    agent.current_task_id = call.task_id
+    if call.error is not None:
+        result = f"工具执行失败：{call.error}"
+        agent._execute_hooks("error", call.name, call.args, result)
+    else:
+        result = call.raw
+        agent._execute_hooks("after", call.name, call.args, result)
+        agent.pack(tool_result=result, tool_name=call.name)
+
+    if call.async_id is not None:
+        result = f"[tool {call.name} still running in background as task_id={call.async_id}]"
+
+    return {
+        "type": "tool_result",
+        "tool_use_id": call.id,
+        "content": result if isinstance(result, str) else json.dumps(result, ensure_ascii=False),
+    }
+
+
+def batches(agent: Any, calls: List[ToolCall]) -> Iterator[List[ToolCall]]:
+    """
+    把需要执行的调用按顺序分批：相邻的 parallel_safe 调用一批并发，
+    ``parallel_safe=False`` 的调用自成一批（前面的批次跑完才开始）
+    """
+    builtins = builtin_tool_names(agent)
+    group: List[ToolCall] = []
+    for call in calls:
+        if not call.pending:
+            continue
+        if is_parallel_safe(agent, call.name, builtins):
+            group.append(call)
+            continue
+        if group:
+            yield group
+            group = []
+        yield [call]
+    if group:
+        yield group
+
+
+# ---------------------------------------------------------------------------
+# 同步路径：有界线程池
+# ---------------------------------------------------------------------------
+
+class ToolDispatcher:
+    """进程级的工具并发执行线程池；没有空闲线程时由调用方线程自己执行"""
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max(1, max_workers or env_int("TOOL_PARALLELISM", 8))
+        self._slots = threading.BoundedSemaphore(self.max_workers)
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers, thread_name_prefix="ToolDispatch",
+                    )
+        return self._executor
+
+    def _run_slot(self, ctx: contextvars.Context, job: Callable[[], Any]) -> Any:
+        try:
+            return ctx.run(job)
+        finally:
+            self._slots.release()
+
+    def try_submit(self, job: Callable[[], Any]) -> Optional[Future]:
+        """有空闲名额时把 job 放进线程池（带调用方的 context 副本）并返回 Future；没有名额返回 None，不等"""
+        if self.max_workers <= 1 or not self._slots.acquire(blocking=False):
+            return None
+        return self._pool().submit(self._run_slot, contextvars.copy_context(), job)
+
+    def run(self, jobs: List[Callable[[], None]]) -> None:
+        """
+        并发执行一批 job，全部完成后返回。job 自己把结果 / 异常写回，不往外抛。
+
+        第一个 job 总在调用方线程上跑；其余抢到线程池名额的在池里跑（带调用方的 context 副本），
+        抢不到的也由调用方线程依次执行。
+        """
+        if len(jobs) <= 1 or self.max_workers <= 1:
+            for job in jobs:
+                job()
+            return
+        futures = []
+        inline = [jobs[0]]
+        for job in jobs[1:]:
+            if self._slots.acquire(blocking=False):
+                futures.append(self._pool().submit(self._run_slot, contextvars.copy_context(), job))
+            else:
+                inline.append(job)
+        for job in inline:
+            job()
+        wait(futures)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+_dispatcher: Optional[ToolDispatcher] = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_tool_dispatcher() -> ToolDispatcher:
+    """返回进程级 ToolDispatcher"""
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = ToolDispatcher()
+    return _dispatcher
+
+
+def shutdown_tool_dispatcher() -> None:
+    global _dispatcher
+    with _dispatcher_lock:
+        dispatcher, _dispatcher = _dispatcher, None
+    if dispatcher is not None:
+        dispatcher.shutdown()
+
+
+def _dispatch_job(agent: Any, call: ToolCall, builtins: frozenset) -> Callable[[], None]:
+    def job() -> None:
+        try:
+            if call.speculated is not None:
+                call.raw, call.async_id = call.speculated.result()
+                return
+            call.raw, call.async_id = get_tool_memo().run(
+                agent, call.name, call.args, builtins,
+                lambda: agent._dispatch_tool(call.name, call.args),
+            )
+        except BaseException as e:  # noqa: BLE001 - 收尾阶段按原版语义处理
+            call.error = e
+
+    return job
+
+
+def run_calls(agent: Any, calls: List[ToolCall]) -> None:
+    """按批次执行准备好的调用（声明了 ``cache=`` 的工具先查结果缓存）"""
+    dispatcher = get_tool_dispatcher()
+    builtins = builtin_tool_names(agent)
+    for group in batches(agent, calls):
+        TOOL_BATCH_SIZE.observe(len(group))
+        dispatcher.run([_dispatch_job(agent, call, builtins) for call in group])
+
+
+async def arun_calls(
+    agent: Any,
+    calls: List[ToolCall],
+    dispatch: Callable[[str, Any], Awaitable[Any]],
+) -> None:
+    """原生异步引擎版 ``run_calls``：同一批用 ``asyncio.gather``，最多 ``TOOL_PARALLELISM`` 个同时执行"""
+    limit = asyncio.Semaphore(get_tool_dispatcher().max_workers)
+    builtins = builtin_tool_names(agent)
+    memo = get_tool_memo()
+
+    async def one(call: ToolCall) -> None:
+        async with limit:
+            try:
+                if call.speculated is not None:
+                    call.raw, call.async_id = await asyncio.wrap_future(call.speculated)
+                    return
+                call.raw, call.async_id = await memo.arun(
+                    agent, call.name, call.args, builtins, lambda: dispatch(call.name, call.args),
+                )
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:  # noqa: BLE001
+                call.error = e
+
+    for group in batches(agent, calls):
+        TOOL_BATCH_SIZE.observe(len(group))
+        await asyncio.gather(*(one(call) for call in group))
+
+
+# ---------------------------------------------------------------------------
+# 装到副本上的对话循环片段
+# ---------------------------------------------------------------------------
+
+def execute_tool_calls(agent: Any, work_history: List[dict], tool_calls_list: List[dict]) -> None:
+    """副本版 ``_execute_tool_calls``：一轮的工具调用并发执行，钩子 / 事件 / 回填顺序不变"""
+    from tangyuanAI.tool_reliability import get_default_idempotency_store
+
+    work_history.append({"role": "assistant", "content": None, "tool_calls": tool_calls_list})
+    idem_store = get_default_idempotency_store()
+    calls = [prepare_fc_call(agent, tc, idem_store) for tc in tool_calls_list]
+    run_calls(agent, calls)
+    for result in [finish_fc_call(agent, call, idem_store) for call in calls]:
+        work_history.append({
+            "role": "tool",
+            "tool_call_id": result["tool_call_id"],
+            "name": result["name"],
+            "content": result["content"],
+        })
+
+
+def finish_anthropic_round(
+    agent: Any, work_history, assistant_blocks, tool_uses, full_text,
+    *, tooluse: bool = True, addhistory: bool = True,
+):
+    """副本版 ``_finish_anthropic_round``：tool_use 并发执行，其余同原版"""
+    if agent.stream and not any(b.get("type") == "text" for b in assistant_blocks) and full_text:
+        assistant_blocks.append({"type": "text", "text": full_text})
+
+    if addhistory:
+        work_history.append({"role": "assistant", "content": assistant_blocks})
+    if not tool_uses:
+        return "".join(b.get("text", "") for b in assistant_blocks if b.get("type") == "text")
+
+    calls = [prepare_tool_use(agent, tu) for tu in tool_uses]
+    run_calls(agent, calls)
+    tool_results = [finish_tool_use(agent, call) for call in calls]
+    if addhistory:
+        work_history.append({"role": "user", "content": tool_results})
+    if tooluse:
+        return agent.conversation()
+    return "".join(
+        b.get("text", "") for b in assistant_blocks if b.get("type") == "text"
+    )
+
+
+def install_parallel_tools(agent: Any) -> None:
+    """给 Agent 副本换上并发版工具执行（只改实例属性；子类覆写过的不动）"""
+    try:
+        from tangyuanAI.agent import _AgentCommon, _AnthropicBase
+    except ImportError:  # pragma: no cover
+        return
+    cls = type(agent)
+    if isinstance(agent, _AnthropicBase):
+        if (cls._finish_anthropic_round is _AnthropicBase._finish_anthropic_round
+                and cls._execute_anthropic_tool_use is _AnthropicBase._execute_anthropic_tool_use):
+            agent._finish_anthropic_round = functools.partial(finish_anthropic_round, agent)
+    elif isinstance(agent, _AgentCommon) and cls._execute_tool_calls is _AgentCommon._execute_tool_calls:
+        agent._execute_tool_calls = functools.partial(execute_tool_calls, agent)
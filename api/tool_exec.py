@@ -0,0 +1,302 @@
+"""
+工具的执行策略：每个工具可以单独设超时，CPU 密集的工具放进共享的进程池跑。
+
+tangyuanAI 的工具在 ``ToolRunner`` 的线程里执行，超时（Agent 的 ``tool_timeout``，默认 60 秒）后转后台、
+给模型回一个 "still running" 占位。两个问题：
+
+- CPU 密集的工具（解析、``opencv-python`` 图像处理）一直握着 GIL，同一个 worker 里其他对话的 SSE 都跟着卡
+- 超时只能按 Agent 整体设；挂死的工具占着线程，模型拿到的也不是错误，而是一个永远等不到的 task_id
+
+声明方式（``api/tool_dispatch.py`` 的 ``install`` 之后）::
+
+    @tangyuanAI.tool_registry.register_tool(name="search", timeout=5)            # 5 秒没完成按工具错误返回
+    @tangyuanAI.tool_registry.register_tool(name="ocr", executor="process", timeout=30)
+    def ocr(path: str) -> str: ...
+
+    class MyAgent(tangyuanAI.Agent):
+        @builtin_tool(description="查目录")
+        @tool_timeout(3)
+        def lookup(self, path: str) -> str: ...
+
+- ``timeout``：超时抛 ``ToolTimeoutError``，按普通工具错误回给模型（走 ``error`` 钩子），对话循环照常继续；
+  线程里的工具停不下来，会在后台跑完（结果丢弃）
+- ``executor="process"``：在进程级共享的进程池里执行（``TOOL_PROCESS_WORKERS``，默认 ``min(4, CPU 数)``），
+  进程常驻复用；lifespan 启动时发现有这类工具就先把进程拉起来。工具函数必须能在子进程里按
+  ``模块.名字`` import 到（模块级函数，不能是闭包 / lambda / ``async def``），参数和返回值要能 pickle。
+  进程里的工具超时时不设 ``timeout`` 也按 Agent 的 ``tool_timeout`` 算，一律按错误返回；卡住的进程占满整个池子时
+  整池回收重建。worker 进程崩溃（如 C 扩展段错误）只让当次调用失败，下次调用自动重建进程池
+- 内建工具是绑定在 Agent 副本上的方法，只支持 ``timeout``（``@tool_timeout``），不支持进程池
+
+策略在 ``ContextToolRunner``（``api/delegation.py``）里生效：同步路径、原生异步引擎、并发工具执行都经过它。
+"""
+
+from __future__ import annotations
+
+import importlib
+import importlib.util
+import inspect
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from .env import env_int
+from .metrics import TOOL_DURATION, TOOL_TIMEOUTS
+
+logger = logging.getLogger(__name__)
+
+EXECUTORS = ("thread", "process")
+
+
+class ToolTimeoutError(TimeoutError):
+    """工具在自己的 ``timeout`` 内没完成"""
+
+    def __init__(self, tool_name: str, timeout: float):
+        super().__init__(f"工具 {tool_name} 执行超过 {timeout:g} 秒，已放弃等待")
+        self.tool_name = tool_name
+        self.timeout = timeout
+
+
+def check_policy(func: Any, timeout: Optional[float], executor: str) -> None:
+    """注册时校验 ``timeout`` / ``executor``（``func`` 为 None 时不查函数本身）；不合法抛 ValueError"""
+    if timeout is not None and timeout <= 0:
+        raise ValueError("timeout 必须 > 0")
+    if executor not in EXECUTORS:
+        raise ValueError(f"executor 应为 {' / '.join(EXECUTORS)}，得到 {executor!r}")
+    if executor == "process" and func is not None:
+        function_ref(func)
+
+
+def tool_timeout(seconds: float) -> Callable[[Any], Any]:
+    """给 ``@builtin_tool`` 方法设执行超时（与 ``@builtin_tool`` 叠加，顺序不限）"""
+    check_policy(None, seconds, "thread")
+
+    def decorator(func: Any) -> Any:
+        func.__tool_timeout__ = float(seconds)
+        return func
+
+    return decorator
+
+
+def policy_for(tool_name: str, tool_func: Any) -> Tuple[Optional[float], str]:
+    """``ToolRunner.submit`` 收到的工具函数 → ``(timeout, executor)``；没声明时是 ``(None, "thread")``"""
+    if inspect.ismethod(tool_func):
+        return getattr(tool_func, "__tool_timeout__", None), "thread"
+    from tangyuanAI.agent_tool import tool_registry
+
+    info = tool_registry.get_tool_info(tool_name) or {}
+    if info.get("function") is not tool_func:
+        return None, "thread"
+    return info.get("timeout"), info.get("executor", "thread")
+
+
+# ---------------------------------------------------------------------------
+# 进程池
+# ---------------------------------------------------------------------------
+
+def function_ref(func: Any) -> Tuple[str, str, Optional[str]]:
+    """
+    子进程里重新 import 工具函数用的 ``(模块, 限定名, 模块文件)``；
+    模块文件用于按路径加载的模块（如 ``AGENTS_CONFIG``），子进程里按模块名 import 不到
+    """
+    module = getattr(func, "__module__", None)
+    qualname = getattr(func, "__qualname__", "")
+    if inspect.iscoroutinefunction(func):
+        raise ValueError(f"async def 工具不能放进进程池：{qualname}")
+    if not module or not qualname or "<locals>" in qualname or "<lambda>" in qualname:
+        raise ValueError(f"进程池里的工具必须是模块级函数，才能在子进程里 import：{func!r}")
+    return module, qualname, getattr(sys.modules.get(module), "__file__", None)
+
+
+def _init_worker() -> None:
+    # 子进程 import 工具所在模块时会重新执行其中的 register_tool(..., executor="process")
+    from .tool_dispatch import install
+
+    install()
+
+
+def _import(module: str, path: Optional[str]) -> Any:
+    if module == "__main__" and "__mp_main__" in sys.modules:
+        return sys.modules["__mp_main__"]
+    if module in sys.modules:
+        return sys.modules[module]
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        if not path:
+            raise
+    spec = importlib.util.spec_from_file_location(module, path)
+    if spec is None or spec.loader is None:
+        raise ImportError(f"无法加载工具模块 {module}（{path}）")
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[module] = mod
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def _call_ref(ref: Tuple[str, str, Optional[str]], kwargs: Dict[str, Any]) -> Any:
+    module, qualname, path = ref
+    target = _import(module, path)
+    for part in qualname.split("."):
+        target = getattr(target, part)
+    return target(**kwargs)
+
+
+def _terminate(executor: ProcessPoolExecutor) -> None:
+    terminate = getattr(executor, "terminate_workers", None)  # Python 3.14+
+    if terminate is not None:
+        terminate()
+        return
+    processes = list((getattr(executor, "_processes", None) or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+
+
+class ProcessToolPool:
+    """进程级的工具进程池：进程常驻复用，卡死 / 崩溃后整池重建"""
+
+    def __init__(self, max_workers: Optional[int] = None, start_method: Optional[str] = None):
+        self.max_workers = max(1, max_workers or env_int("TOOL_PROCESS_WORKERS", min(4, os.cpu_count() or 1)))
+        # 服务进程里有很多线程，fork 出来的子进程可能继承到被锁住的锁，默认用 spawn
+        self.start_method = start_method or os.getenv("TOOL_PROCESS_START_METHOD", "spawn")
+        self.recycled = 0
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._stuck: Set[Future] = set()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        executor = self._executor
+        if executor is not None:
+            return executor
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context(self.start_method),
+                    initializer=_init_worker,
+                )
+                self._stuck = set()
+            return self._executor
+
+    def warm(self) -> None:
+        """把所有 worker 进程拉起来（spawn 要重新 import，第一次调用不用再等）"""
+        pool = self._pool()
+        for future in [pool.submit(os.getpid) for _ in range(self.max_workers)]:
+            future.result()
+
+    def call(self, tool_name: str, func: Any, kwargs: Dict[str, Any], timeout: float) -> Any:
+        """在进程池里执行 ``func(**kwargs)``，最多等 ``timeout`` 秒；超时抛 ``ToolTimeoutError``"""
+        ref = function_ref(func)
+        pool = self._pool()
+        try:
+            future = pool.submit(_call_ref, ref, kwargs)
+            return future.result(timeout=timeout)
+        except FutTimeout:
+            if not future.cancel():
+                self._mark_stuck(pool, future)
+            raise ToolTimeoutError(tool_name, timeout) from None
+        except BrokenProcessPool:
+            self._discard(pool, "worker 进程异常退出")
+            raise
+
+    def _mark_stuck(self, pool: ProcessPoolExecutor, future: Future) -> None:
+        with self._lock:
+            if pool is not self._executor:
+                return
+            stuck = self._stuck
+            stuck.add(future)
+            future.add_done_callback(stuck.discard)
+            if len([f for f in stuck if not f.done()]) < self.max_workers:
+                return
+        self._discard(pool, "所有 worker 都卡在超时的工具上")
+
+    def _discard(self, pool: ProcessPoolExecutor, reason: str) -> None:
+        with self._lock:
+            if pool is not self._executor:
+                return
+            self._executor = None
+            self.recycled += 1
+        logger.warning("工具进程池重建：%s", reason)
+        _terminate(pool)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            _terminate(executor)
+
+
+_process_pool: Optional[ProcessToolPool] = None
+_process_pool_lock = threading.Lock()
+
+
+def get_process_pool() -> ProcessToolPool:
+    """返回进程级 ProcessToolPool"""
+    global _process_pool
+    if _process_pool is None:
+        with _process_pool_lock:
+            if _process_pool is None:
+                _process_pool = ProcessToolPool()
+    return _process_pool
+
+
+def warm_process_pool() -> None:
+    """注册表里有 ``executor="process"`` 的工具时预先拉起进程池（lifespan 启动时调用）"""
+    from tangyuanAI.agent_tool import tool_registry
+
+    if any(info.get("executor") == "process" for info in list(tool_registry._tools.values())):
+        get_process_pool().warm()
+
+
+def shutdown_process_pool() -> None:
+    global _process_pool
+    with _process_pool_lock:
+        pool, _process_pool = _process_pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+# ---------------------------------------------------------------------------
+# ToolRunner.submit 的策略版
+# ---------------------------------------------------------------------------
+
+def submit(
+    runner: Any,
+    tool_func: Callable[..., Any],
+    timed: Callable[..., Any],
+    args: Tuple[Any, ...],
+    kwargs: Dict[str, Any],
+) -> Tuple[Any, Optional[str]]:
+    """
+    按工具的执行策略提交：``timed`` 是包好 context / 计时的 ``tool_func``，线程里跑它；
+    进程池直接发 ``tool_func`` 的引用，在调用方线程上等结果。返回值同 ``ToolRunner.submit``。
+    """
+    tool_name = kwargs.get("tool_name") or getattr(tool_func, "__name__", "unknown")
+    timeout, executor = policy_for(tool_name, tool_func)
+    if executor == "process":
+        params = {k: v for k, v in kwargs.items() if k not in ("tool_name", "timeout")}
+        if timeout is None:
+            timeout = kwargs.get("timeout") or runner.default_timeout
+        started = time.perf_counter()
+        try:
+            return get_process_pool().call(tool_name, tool_func, params, timeout), None
+        except ToolTimeoutError:
+            TOOL_TIMEOUTS.inc(tool_name, executor)
+            raise
+        finally:
+            TOOL_DURATION.observe(time.perf_counter() - started, tool_name)
+    if timeout is None:
+        return runner.submit(timed, *args, **kwargs)
+    result, async_id = runner.submit(timed, *args, **{**kwargs, "timeout": timeout})
+    if async_id is not None:
+        TOOL_TIMEOUTS.inc(tool_name, executor)
+        raise ToolTimeoutError(tool_name, timeout)
+    return result, None
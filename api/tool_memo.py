@@ -0,0 +1,339 @@
+"""
+幂等工具的结果缓存：声明了 ``cache=`` 的工具，相同参数的调用在 TTL 内直接复用上次的结果。
+
+``docs/PROJECT.md`` 要求工具"幂等且无状态"，但每次调用仍然真的执行一遍函数 / MCP 往返：
+同一个查询在一个对话的多轮里、在并发的多个对话之间反复跑。tangyuanAI 自带的 idempotency cache
+按 ``tool_call_id`` 记，只对同一个调用的重放有效，换一次调用就不命中。
+
+声明方式（``api/tool_dispatch.py`` 的 ``install`` 之后）::
+
+    @tangyuanAI.tool_registry.register_tool(name="weather", cache=60)             # TTL 60 秒
+    @tangyuanAI.tool_registry.register_tool(name="fx", cache={"ttl": 300, "max_entries": 64,
+                                                              "key": lambda args: args["pair"].upper()})
+
+    class MyAgent(tangyuanAI.Agent):
+        @builtin_tool(description="查目录")
+        @tool_cache(ttl=30)
+        def lookup(self, path: str) -> str: ...
+
+``cache=True`` 用默认值（TTL 300 秒、每个工具 256 条）；``key`` 从参数 dict 算缓存 key，默认是参数的规范化 JSON。
+
+- 注册工具的结果跨 Agent 共享（先过 ACL，无权限的调用不查缓存）；内建工具的 key 带上 Agent 类和 uuid
+- LRU：每个工具最多 ``max_entries`` 条，全部工具合计最多 ``TOOL_MEMO_MAX_BYTES`` 字节（按结果序列化后的大小估算），
+  超出从最久没用的开始淘汰
+- single-flight：相同 key 的并发调用只执行一次，其余等它的结果（异常也一起拿到）；转后台的超时调用和异常不进缓存
+- 命中返回结果的深拷贝，调用方改了也不影响缓存；工具被覆盖注册 / 注销时它的缓存随之清空
+- 每个工具的 hit / miss / coalesced / evicted 计数：``GET /health`` 的 ``tool_cache`` 和 Prometheus
+"""
+
+from __future__ import annotations
+
+import asyncio
+import copy
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from .env import env_int
+from .metrics import TOOL_CACHE
+from .models import ToolCacheEntryStats, ToolCacheStats
+
+DispatchResult = Tuple[Any, Optional[str]]
+CacheKey = Tuple[str, Optional[Tuple[str, str]], Hashable]
+
+_IMMUTABLE = (str, bytes, int, float, bool, type(None))
+
+
+class CacheSpec:
+    """一个工具的缓存配置"""
+
+    __slots__ = ("ttl", "max_entries", "key")
+
+    def __init__(
+        self,
+        ttl: float = 300.0,
+        max_entries: int = 256,
+        key: Optional[Callable[[Dict[str, Any]], Hashable]] = None,
+    ):
+        if ttl <= 0 or max_entries < 1:
+            raise ValueError("cache 的 ttl 必须 > 0，max_entries 必须 >= 1")
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self.key = key
+
+
+def cache_spec(value: Any) -> Optional[CacheSpec]:
+    """``cache=`` 参数 → ``CacheSpec``：None / False 不缓存，True 用默认值，数字是 TTL，dict 是关键字参数"""
+    if value is None or value is False:
+        return None
+    if value is True:
+        return CacheSpec()
+    if isinstance(value, CacheSpec):
+        return value
+    if isinstance(value, (int, float)):
+        return CacheSpec(ttl=value)
+    if isinstance(value, dict):
+        return CacheSpec(**value)
+    raise TypeError(f"cache 应为 bool / 秒数 / dict / CacheSpec，得到 {value!r}")
+
+
+def tool_cache(
+    ttl: float = 300.0,
+    max_entries: int = 256,
+    key: Optional[Callable[[Dict[str, Any]], Hashable]] = None,
+) -> Callable[[Any], Any]:
+    """给 ``@builtin_tool`` 方法声明结果缓存（与 ``@builtin_tool`` 叠加，顺序不限）"""
+    spec = CacheSpec(ttl=ttl, max_entries=max_entries, key=key)
+
+    def decorator(func: Any) -> Any:
+        func.__tool_cache__ = spec
+        return func
+
+    return decorator
+
+
+def _sizeof(value: Any) -> int:
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    try:
+        return len(json.dumps(value, ensure_ascii=False, default=str))
+    except (TypeError, ValueError):
+        return sys.getsizeof(value)
+
+
+def _copy(value: Any) -> Any:
+    if isinstance(value, _IMMUTABLE):
+        return value
+    try:
+        return copy.deepcopy(value)
+    except Exception:
+        return value
+
+
+class _Entry:
+    __slots__ = ("value", "expires", "size")
+
+    def __init__(self, value: Any, expires: float, size: int):
+        self.value = value
+        self.expires = expires
+        self.size = size
+
+
+class _ToolStats:
+    __slots__ = ("entries", "bytes", "hits", "misses", "coalesced", "evicted")
+
+    def __init__(self):
+        self.entries = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evicted = 0
+
+
+class ToolMemo:
+    """进程级工具结果缓存（LRU + TTL + single-flight）。线程安全，同步 / 异步调用方共用。"""
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes or env_int("TOOL_MEMO_MAX_BYTES", 32 * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._lru: "OrderedDict[CacheKey, _Entry]" = OrderedDict()
+        self._per_tool: Dict[str, "OrderedDict[CacheKey, None]"] = {}
+        self._inflight: Dict[CacheKey, Future] = {}
+        self._stats: Dict[str, _ToolStats] = {}
+        self._bytes = 0
+
+    # ---- 配置 ----
+
+    @staticmethod
+    def spec_for(agent: Any, name: str, builtins: frozenset) -> Optional[CacheSpec]:
+        """该调用要不要走缓存；注册工具先过 ACL"""
+        if name in builtins:
+            return getattr(getattr(agent, name, None), "__tool_cache__", None)
+        from tangyuanAI.agent_tool import tool_registry
+
+        info = tool_registry.get_tool_info(name)
+        if not info or info.get("cache") is None:
+            return None
+        if not tool_registry.check_permission(agent.uuid, name):
+            return None
+        return info["cache"]
+
+    @staticmethod
+    def key_for(agent: Any, name: str, spec: CacheSpec, args: Any, builtin: bool) -> CacheKey:
+        if spec.key is not None:
+            arg_key = spec.key(dict(args or {}))
+        else:
+            arg_key = json.dumps(args or {}, sort_keys=True, ensure_ascii=False, default=str)
+        scope = (type(agent).__qualname__, agent.uuid or agent.name or "") if builtin else None
+        return name, scope, arg_key
+
+    # ---- 查找 / 写入 ----
+
+    def _begin(self, key: CacheKey) -> Tuple[str, Any]:
+        """返回 ``("hit", 结果)`` / ``("wait", Future)`` / ``("own", Future)``"""
+        name = key[0]
+        now = time.monotonic()
+        with self._lock:
+            stats = self._stats.setdefault(name, _ToolStats())
+            entry = self._lru.get(key)
+            if entry is not None:
+                if entry.expires > now:
+                    self._lru.move_to_end(key)
+                    self._per_tool[name].move_to_end(key)
+                    stats.hits += 1
+                    TOOL_CACHE.inc(name, "hit")
+                    return "hit", entry.value
+                self._drop(key)
+            fut = self._inflight.get(key)
+            if fut is not None:
+                stats.coalesced += 1
+                TOOL_CACHE.inc(name, "coalesced")
+                return "wait", fut
+            fut = self._inflight[key] = Future()
+            stats.misses += 1
+            TOOL_CACHE.inc(name, "miss")
+            return "own", fut
+
+    def _end(self, key: CacheKey, spec: CacheSpec, fut: Future, result: Optional[DispatchResult],
+             error: Optional[BaseException]) -> None:
+        with self._lock:
+            self._inflight.pop(key, None)
+            if error is None and result is not None and result[1] is None:
+                self._store(key, spec, result[0])
+        if error is not None and not isinstance(error, Exception):
+            # 执行方被取消：等着的调用方照常拿到一个工具错误，而不是把取消传染过去
+            error = RuntimeError(f"合并执行的 {key[0]} 调用被取消")
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(result)
+
+    def _store(self, key: CacheKey, spec: CacheSpec, value: Any) -> None:
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        name = key[0]
+        if key in self._lru:
+            self._drop(key)
+        self._lru[key] = _Entry(_copy(value), time.monotonic() + spec.ttl, size)
+        self._per_tool.setdefault(name, OrderedDict())[key] = None
+        stats = self._stats[name]
+        stats.entries += 1
+        stats.bytes += size
+        self._bytes += size
+        per_tool = self._per_tool[name]
+        while len(per_tool) > spec.max_entries:
+            self._evict(next(iter(per_tool)))
+        while self._bytes > self.max_bytes and self._lru:
+            self._evict(next(iter(self._lru)))
+
+    def _drop(self, key: CacheKey) -> None:
+        entry = self._lru.pop(key)
+        name = key[0]
+        self._per_tool[name].pop(key, None)
+        stats = self._stats[name]
+        stats.entries -= 1
+        stats.bytes -= entry.size
+        self._bytes -= entry.size
+
+    def _evict(self, key: CacheKey) -> None:
+        self._drop(key)
+        self._stats[key[0]].evicted += 1
+        TOOL_CACHE.inc(key[0], "evicted")
+
+    # ---- 调用入口 ----
+
+    def run(self, agent: Any, name: str, args: Any, builtins: frozenset,
+            dispatch: Callable[[], DispatchResult]) -> DispatchResult:
+        """同步调用方：命中直接返回，没命中执行 ``dispatch`` 并写入缓存"""
+        spec = self.spec_for(agent, name, builtins)
+        if spec is None:
+            return dispatch()
+        key = self.key_for(agent, name, spec, args, name in builtins)
+        state, obj = self._begin(key)
+        if state == "hit":
+            return _copy(obj), None
+        if state == "wait":
+            value, async_id = obj.result()
+            return _copy(value), async_id
+        try:
+            result = dispatch()
+        except BaseException as e:
+            self._end(key, spec, obj, None, e)
+            raise
+        self._end(key, spec, obj, result, None)
+        return result
+
+    async def arun(self, agent: Any, name: str, args: Any, builtins: frozenset,
+                   dispatch: Callable[[], Awaitable[DispatchResult]]) -> DispatchResult:
+        """异步调用方版 ``run``；与同步调用方的相同调用也互相合并"""
+        spec = self.spec_for(agent, name, builtins)
+        if spec is None:
+            return await dispatch()
+        key = self.key_for(agent, name, spec, args, name in builtins)
+        state, obj = self._begin(key)
+        if state == "hit":
+            return _copy(obj), None
+        if state == "wait":
+            value, async_id = await asyncio.shield(asyncio.wrap_future(obj))
+            return _copy(value), async_id
+        try:
+            result = await dispatch()
+        except BaseException as e:
+            self._end(key, spec, obj, None, e)
+            raise
+        self._end(key, spec, obj, result, None)
+        return result
+
+    # ---- 管理 ----
+
+    def on_registry_change(self, table: str, key: Any, old: Any, new: Any) -> None:
+        """工具被覆盖 / 注销时清掉它的缓存（``RegistryWatcher`` 订阅）"""
+        if table == "tools":
+            self.invalidate(key)
+
+    def invalidate(self, name: Optional[str] = None) -> None:
+        """清掉某个工具（或全部）的缓存"""
+        with self._lock:
+            keys = list(self._per_tool.get(name, ())) if name is not None else list(self._lru)
+            for key in keys:
+                self._drop(key)
+
+    def stats(self) -> ToolCacheStats:
+        with self._lock:
+            tools = [
+                ToolCacheEntryStats(
+                    tool=name,
+                    entries=s.entries,
+                    bytes=s.bytes,
+                    hits=s.hits,
+                    misses=s.misses,
+                    coalesced=s.coalesced,
+                    evicted=s.evicted,
+                    hit_ratio=round(s.hits / (s.hits + s.misses), 4) if s.hits + s.misses else 0.0,
+                )
+                for name, s in self._stats.items()
+            ]
+            return ToolCacheStats(max_bytes=self.max_bytes, entries=len(self._lru), bytes=self._bytes, tools=tools)
+
+
+_memo: Optional[ToolMemo] = None
+_memo_lock = threading.Lock()
+
+
+def get_tool_memo() -> ToolMemo:
+    """返回进程级 ToolMemo"""
+    global _memo
+    if _memo is None:
+        with _memo_lock:
+            if _memo is None:
+                from .registry import get_registry_watcher
+
+                _memo = ToolMemo()
+                get_registry_watcher().subscribe(_memo.on_registry_change)
+    return _memo
@@ -0,0 +1,164 @@
+"""
+按 Agent 预编译的工具 schema：注册表版本变了才重建，请求体直接复用。
+
+tangyuanAI 每轮 LLM 调用都现算一遍工具列表（``_collect_tools_schema``）：
+
+- ``tool_registry.get_all_tools_schema(uuid)``：逐个工具做 ACL 判定（每个都打日志）
+- ``collect_builtin_tools(inst)``：沿 MRO 反射找 ``@builtin_tool`` 方法
+- ``skill_registry.get_all_tool_schemas()``
+
+MCP 一注册就是几十个工具，这些在每个对话的每一轮都重复一次。Anthropic 协议还要在
+transport 里再转换一次格式，然后整个 payload 交给 httpx 重新 ``json.dumps``。
+
+这里按 ``(Agent 类, uuid)`` 缓存一份 ``CompiledTools``：
+
+- 本身就是 OpenAI 风格的 schema 列表（``_collect_tools_schema`` 原样的结果），直接放进 ``ChatRequest``
+- ``.anthropic``：转换好的 Anthropic 格式（计量 transport 的 ``_convert_tools`` 直接取）
+- ``.json``：预序列化的 JSON 字节，``encode_payload`` 把它拼进请求体，不再逐轮序列化
+- ``.names`` / ``.builtin_names`` / ``.registered_names``：``GET /agents/{id}/tools`` 直接用
+- 挂了 ``ask_for_help`` 的 Agent 额外带上 API 层的 ``ask_many``（``api/delegation.py``）
+
+失效条件是 ``api.registry`` 的注册表版本号（工具 / Skill / uuid 映射有写入即 +1）。
+``install_tool_cache`` 由 ``AgentPool`` 在派生副本时调用，只改副本实例属性。
+"""
+
+from __future__ import annotations
+
+import json
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from .registry import get_registry_watcher
+
+
+def _dumps(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class PreEncoded(list):
+    """自带预序列化 JSON 的只读约定列表（``encode_payload`` 识别它）"""
+
+    __slots__ = ("_json",)
+
+    def __init__(self, items: Any = ()):
+        super().__init__(items)
+        self._json: Optional[bytes] = None
+
+    @property
+    def json(self) -> bytes:
+        if self._json is None:
+            self._json = _dumps(list(self))
+        return self._json
+
+
+class CompiledTools(PreEncoded):
+    """一个 Agent 在某个注册表版本下的工具列表（OpenAI 风格 schema）"""
+
+    __slots__ = ("version", "names", "builtin_names", "registered_names", "_anthropic")
+
+    def __init__(
+        self,
+        schemas: List[Dict[str, Any]],
+        *,
+        version: int,
+        builtin_names: Tuple[str, ...] = (),
+        registered_names: Tuple[str, ...] = (),
+    ):
+        super().__init__(schemas)
+        self.version = version
+        self.names = tuple(_schema_name(s) for s in schemas)
+        self.builtin_names = builtin_names
+        self.registered_names = registered_names
+        self._anthropic: Optional[PreEncoded] = None
+
+    @property
+    def anthropic(self) -> PreEncoded:
+        """Anthropic Messages API 格式（与 ``HttpxAnthropicTransport._convert_tools`` 结果一致）"""
+        if self._anthropic is None:
+            from tangyuanAI.llm_transport import HttpxAnthropicTransport
+
+            self._anthropic = PreEncoded(HttpxAnthropicTransport._convert_tools(list(self)))
+        return self._anthropic
+
+
+def _schema_name(schema: Dict[str, Any]) -> str:
+    fn = schema.get("function")
+    if isinstance(fn, dict):
+        return fn.get("name") or ""
+    return schema.get("name") or ""
+
+
+class ToolSchemaCache:
+    """``(Agent 类, uuid) → CompiledTools``，注册表版本变化时按需重建"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[type, str], CompiledTools] = {}
+
+    def get(self, agent: Any) -> CompiledTools:
+        version = get_registry_watcher().version
+        key = (type(agent), agent.uuid)
+        compiled = self._entries.get(key)
+        if compiled is not None and compiled.version == version:
+            return compiled
+        compiled = self._compile(agent, version)
+        with self._lock:
+            self._entries[key] = compiled
+        return compiled
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    @staticmethod
+    def _compile(agent: Any, version: int) -> CompiledTools:
+        from tangyuanAI.agent_tool import tool_registry
+
+        # 走类上原本的实现，协议差异（Anthropic fc_model=False 不挂工具等）保持不变
+        schemas = list(type(agent)._collect_tools_schema(agent) or [])
+        builtin = tuple(
+            s["function"]["name"] for s in tool_registry.collect_builtin_tools(agent)
+        )
+        names = {_schema_name(s) for s in schemas}
+        if "ask_for_help" in names and "ask_many" not in names:
+            from .delegation import ASK_MANY_SCHEMA
+
+            schemas.append(ASK_MANY_SCHEMA)
+            builtin += ("ask_many",)
+        try:
+            registered = tuple(sorted(tool_registry.get_all_tools_info(agent.uuid) or {}))
+        except Exception:
+            registered = ()
+        return CompiledTools(
+            schemas,
+            version=version,
+            builtin_names=builtin,
+            registered_names=registered,
+        )
+
+
+_cache = ToolSchemaCache()
+
+
+def get_tool_schema_cache() -> ToolSchemaCache:
+    """返回进程级 ToolSchemaCache"""
+    return _cache
+
+
+def install_tool_cache(agent: Any) -> None:
+    """让 Agent 副本的 ``_collect_tools_schema`` 走预编译缓存（只改实例属性）"""
+    if callable(getattr(type(agent), "_collect_tools_schema", None)):
+        agent._collect_tools_schema = lambda: _cache.get(agent)
+
+
+def encode_payload(payload: Dict[str, Any]) -> bytes:
+    """
+    序列化请求体；``tools`` 是 ``PreEncoded`` 时直接拼接它的预序列化字节。
+    """
+    tools = payload.get("tools")
+    if not isinstance(tools, PreEncoded) or not payload:
+        return _dumps(payload)
+    rest = _dumps({k: v for k, v in payload.items() if k != "tools"})
+    if rest == b"{}":
+        return b'{"tools":' + tools.json + b"}"
+    return rest[:-1] + b',"tools":' + tools.json + b"}"
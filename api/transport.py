@@ -0,0 +1,421 @@
+"""
+给 Agent 副本装上"计量" transport：记录 provider 报告的 token 用量，顺带做取消检查。
+
+tangyuanAI 的 transport 已经能解析 usage，但：
+
+1. OpenAI 兼容流式默认不返回 usage —— 需要请求里带 ``stream_options.include_usage``
+   （``LLM_STREAM_INCLUDE_USAGE=0`` 可关，给不认这个字段的兼容服务用）
+2. Anthropic 流式只取了 ``message_delta`` 里的输出 token，``message_start`` 里的输入 token
+   （以及 prompt cache 的读写 token）被丢掉
+3. 解析出来的 usage 只用来打日志，没有出口
+
+这里不改 tangyuanAI，而是按原 transport 类派生一个计量子类：
+
+- ``chat`` / ``chat_stream`` / ``achat`` / ``achat_stream`` 结束时把 usage 交给
+  ``api.usage.record_usage``（单请求累加器 + 进程级账本）
+- 流式每读到一个事件检查一次 ``api.cancellation.check_cancelled``
+- 给 ``api.metrics`` 计每次对话的 LLM 调用数，并在发起方 Agent 的第一个文本 token 处记 TTFT
+- HTTP 客户端取 ``api.http_pool`` 里按 provider origin 共享的 keep-alive 客户端，不再每轮新建；
+  ``achat`` / ``achat_stream`` 也一样（按 event loop 共享的异步客户端，原版每次调用都新建一个）
+- XML 标签模式的副本传进来 ``xml_parser`` 时，每段文本都喂给它（``api/xml_calls.py``），工具块边界边收边找
+- 传进来 ``speculator`` 时，流里每个参数收完整的工具调用都交给它投机执行（``api/speculation.py``）；
+  OpenAI 兼容流式的调用原版要到 ``[DONE]`` 才产出，这里在出现下一个调用或 ``finish_reason`` 时就认定前面的已完整
+- OpenAI 兼容 / Anthropic 的流式响应按字节解析（``api/sse.py``）：不逐行解码成 str，有 ``orjson`` 时用它解 JSON，
+  心跳帧不解析
+- 请求体用 ``api.tool_schemas.encode_payload`` 序列化：预编译的工具 schema 直接拼接预序列化字节；
+  Anthropic 的工具格式转换也直接取预编译结果
+
+安装方式（``install_metering``，由 ``AgentPool`` 在派生副本时调用）：
+
+- OpenAI / Responses 协议：副本实例上覆盖 ``_transport_cls`` 和 ``_transport_kwargs``
+- Anthropic 协议（``_build_anthropic_request`` 现构造 transport）：包一层，请求仍由 tangyuanAI
+  （或子类覆写）的实现构造；返回的 transport 就地换成计量子类（``adopt_transport``），客户端换成共享的
+
+注册在 ``agent_list`` 里的模板实例不受影响。
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+from typing import Any, AsyncIterator, Dict, Iterator, Optional
+
+from tangyuanAI.llm_transport import (
+    HttpxAnthropicTransport,
+    HttpxOpenAIResponsesTransport,
+    HttpxOpenAITransport,
+    LLMEvent,
+    LLMTransport,
+    UsageInfo,
+    ToolCall,
+    _OpenAISSEState,
+    _process_responses_sse_line,
+    _ResponsesSSEState,
+)
+
+from .cancellation import check_cancelled
+from .http_pool import get_http_pool
+from .metrics import current_conversation
+from .sse import AnthropicStream, OpenAIStream, aiter_frames, iter_frames
+from .tool_schemas import CompiledTools, encode_payload
+from .usage import record_usage
+
+# 构造参数里接受 ``client=`` 的 transport：计量子类构造时换成连接池里的共享客户端
+_POOLED_TRANSPORTS = (HttpxOpenAITransport, HttpxOpenAIResponsesTransport, HttpxAnthropicTransport)
+
+# Anthropic 里算作"输入"的 usage 字段（含 prompt cache 读写）
+_ANTHROPIC_INPUT_FIELDS = ("input_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+
+
+def _include_usage() -> bool:
+    return os.getenv("LLM_STREAM_INCLUDE_USAGE", "1").lower() not in ("0", "false", "no")
+
+
+class _EncodingClient:
+    """``HTTPClient`` 代理：``json=`` 请求体改由 ``encode_payload`` 序列化"""
+
+    __slots__ = ("_client",)
+
+    def __init__(self, client: Any):
+        self._client = client
+
+    def post(self, url: str, *, json: Any = None, **kwargs: Any):
+        if json is not None and kwargs.get("content") is None:
+            kwargs["content"] = encode_payload(json)
+            json = None
+        return self._client.post(url, json=json, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._client, name)
+
+
+class _MeteredMixin(LLMTransport):
+    """
+    在任意 LLMTransport 子类前面插一层：记账 + 取消检查 + 指标 + 请求体编码
+
+    几个 mixin 都继承 LLMTransport 而不是 object：这样派生类和原类的实例布局一致，
+    ``adopt_transport`` 才能就地改 ``__class__``
+    """
+
+    agent_name: Optional[str] = None
+    xml_parser: Any = None
+    speculator: Any = None
+
+    def __init__(
+        self,
+        *args: Any,
+        agent_name: Optional[str] = None,
+        xml_parser: Any = None,
+        speculator: Any = None,
+        **kwargs: Any,
+    ):
+        if isinstance(self, _POOLED_TRANSPORTS) and kwargs.get("client") is None:
+            endpoint = kwargs.get("endpoint", args[0] if args else None)
+            if endpoint:
+                kwargs["client"] = get_http_pool().client_for(endpoint)
+        super().__init__(*args, **kwargs)
+        self._init_metering(agent_name, xml_parser, speculator)
+
+    def _init_metering(self, agent_name: Optional[str], xml_parser: Any, speculator: Any) -> None:
+        self.agent_name = agent_name
+        self.xml_parser = xml_parser
+        if xml_parser is not None:
+            xml_parser.reset()
+        self.speculator = speculator
+        if speculator is not None:
+            speculator.reset()
+        self._wrap_client()
+
+    def _wrap_client(self) -> None:
+        client = getattr(self, "_client", None)
+        if client is not None and not isinstance(client, _EncodingClient):
+            self._client = _EncodingClient(client)
+
+    def _start_call(self):
+        """计一次 LLM 调用；返回需要标记 TTFT 的对话（只有发起方 Agent 的首个 token 算）"""
+        conv = current_conversation.get()
+        if conv is None:
+            return None
+        conv.count_llm_call()
+        if conv.first_token or conv.agent != self.agent_name:
+            return None
+        return conv
+
+    def chat(self, req):
+        check_cancelled()
+        conv = self._start_call()
+        rsp = super().chat(req)
+        if conv is not None and rsp.text:
+            conv.mark_first_token()
+        if self.xml_parser is not None and rsp.text:
+            self.xml_parser.feed(rsp.text)
+        record_usage(self.agent_name, req.model, rsp.usage)
+        return rsp
+
+    async def achat(self, req):
+        check_cancelled()
+        conv = self._start_call()
+        if isinstance(self, _POOLED_TRANSPORTS):
+            rsp = await self._pooled_achat(req)
+        else:
+            rsp = await super().achat(req)
+        if conv is not None and rsp.text:
+            conv.mark_first_token()
+        if self.xml_parser is not None and rsp.text:
+            self.xml_parser.feed(rsp.text)
+        record_usage(self.agent_name, req.model, rsp.usage)
+        return rsp
+
+    def chat_stream(self, req) -> Iterator[LLMEvent]:
+        check_cancelled()
+        conv = self._start_call()
+        return self._metered(super().chat_stream(req), req.model, conv)
+
+    async def achat_stream(self, req) -> AsyncIterator[LLMEvent]:
+        check_cancelled()
+        conv = self._start_call()
+        recorded = False
+        if isinstance(self, _POOLED_TRANSPORTS):
+            events = self._pooled_achat_stream(req)
+        else:
+            events = super().achat_stream(req)
+        xml_parser, speculator = self.xml_parser, self.speculator
+        async for evt in events:
+            check_cancelled()
+            if conv is not None and evt.type == "text":
+                conv.mark_first_token()
+                conv = None
+            if xml_parser is not None and evt.type == "text":
+                xml_parser.feed(evt.text)
+            if speculator is not None and evt.type == "tool_call":
+                speculator.start(evt.tool_call)
+            if not recorded and evt.usage is not None and evt.type in ("usage", "done"):
+                record_usage(self.agent_name, req.model, evt.usage)
+                recorded = True
+            yield evt
+
+    # ---- 异步：共享的异步客户端（与原版 achat / achat_stream 相同的请求和解析） ----
+
+    async def _pooled_achat(self, req):
+        client = get_http_pool().async_client_for(self.endpoint)
+        rsp = await client.apost(self.endpoint, headers=self.headers, content=encode_payload(self._build_payload(req)))
+        return self._response_to_llm(rsp.json())
+
+    async def _pooled_achat_stream(self, req) -> AsyncIterator[LLMEvent]:
+        client = get_http_pool().async_client_for(self.endpoint)
+        rsp = await client.apost(
+            self.endpoint,
+            headers={**self.headers, "Accept": "text/event-stream"},
+            content=encode_payload(self._build_payload(req)),
+            stream=True,
+        )
+        try:
+            async for evt in self._aiter_events(rsp):
+                yield evt
+        finally:
+            # 提前结束（Anthropic 读到 message_stop、取消）时也把连接还给连接池
+            await rsp.aclose()
+
+    def _aiter_events(self, rsp) -> AsyncIterator[LLMEvent]:
+        if isinstance(self, HttpxAnthropicTransport):
+            return self._aiter_anthropic_sse(rsp)
+        if isinstance(self, HttpxOpenAIResponsesTransport):
+            return self._aiter_responses_sse(rsp)
+        return self._aiter_openai_sse(rsp)
+
+    async def _aiter_responses_sse(self, rsp) -> AsyncIterator[LLMEvent]:
+        state = _ResponsesSSEState(self._parse_usage)
+        async for line in rsp.aiter_lines():
+            for evt in _process_responses_sse_line(line, state):
+                yield evt
+
+    def _metered(self, events: Iterator[LLMEvent], model: str, conv=None) -> Iterator[LLMEvent]:
+        recorded = False
+        xml_parser, speculator = self.xml_parser, self.speculator
+        try:
+            for evt in events:
+                check_cancelled()
+                if conv is not None and evt.type == "text":
+                    conv.mark_first_token()
+                    conv = None
+                if xml_parser is not None and evt.type == "text":
+                    xml_parser.feed(evt.text)
+                if speculator is not None and evt.type == "tool_call":
+                    speculator.start(evt.tool_call)
+                if not recorded and evt.usage is not None and evt.type in ("usage", "done"):
+                    record_usage(self.agent_name, model, evt.usage)
+                    recorded = True
+                yield evt
+        finally:
+            close = getattr(events, "close", None)
+            if close is not None:
+                close()
+
+
+def _completed_calls(state: _OpenAISSEState, done: set) -> Iterator[ToolCall]:
+    """
+    已经收完整、还没交出去的调用：出现了更大的 ``index`` 说明前面的参数都发完了，
+    有了 ``finish_reason`` 说明全部发完了（没有 id 的调用原版会现编一个，对不上，不交）
+    """
+    calls = state.current_calls
+    if len(calls) <= len(done) or (len(calls) == len(done) + 1 and state.finish_reason is None):
+        return
+    last = None if state.finish_reason is not None else max(calls)
+    for idx, slot in list(calls.items()):
+        if idx in done or idx == last:
+            continue
+        done.add(idx)
+        try:
+            args = json.loads(slot["arguments"] or "{}")
+        except ValueError:
+            continue
+        if slot["id"] and isinstance(args, dict):
+            yield ToolCall(id=slot["id"], name=slot["name"], arguments=args)
+
+
+class _OpenAIUsageMixin(LLMTransport):
+    """OpenAI 兼容流式：请求 provider 在最后一帧带上 usage；调用参数收完整就交给 ``speculator``"""
+    def _build_payload(self, req) -> Dict[str, Any]:
+        payload = super()._build_payload(req)
+        if req.stream and _include_usage():
+            options = dict(payload.get("stream_options") or {})
+            options.setdefault("include_usage", True)
+            payload["stream_options"] = options
+        return payload
+
+    def _iter_openai_sse(self, rsp) -> Iterator[LLMEvent]:
+        speculator = self.speculator
+        state, done = OpenAIStream(), set()
+        for _, payload in iter_frames(rsp.iter_bytes()):
+            events = state.feed(payload)
+            if speculator is not None:
+                for call in _completed_calls(state, done):
+                    speculator.start(call)
+            yield from events
+
+    async def _aiter_openai_sse(self, rsp) -> AsyncIterator[LLMEvent]:
+        speculator = self.speculator
+        state, done = OpenAIStream(), set()
+        async for _, payload in aiter_frames(rsp.aiter_bytes()):
+            events = state.feed(payload)
+            if speculator is not None:
+                for call in _completed_calls(state, done):
+                    speculator.start(call)
+            for evt in events:
+                yield evt
+
+
+def _merge_anthropic_usage(start: Dict[str, Any], final: Optional[UsageInfo]) -> Optional[UsageInfo]:
+    """``message_start`` 的 usage（输入侧）+ ``message_delta`` 的 usage（输出侧，后到的覆盖先到的）"""
+    raw = dict(start)
+    if final is not None and isinstance(final.raw, dict):
+        raw.update({k: v for k, v in final.raw.items() if v is not None})
+    if not raw:
+        return final
+    prompt = sum(int(raw.get(k) or 0) for k in _ANTHROPIC_INPUT_FIELDS)
+    completion = int(raw.get("output_tokens") or 0)
+    return UsageInfo(
+        prompt_tokens=prompt,
+        completion_tokens=completion,
+        total_tokens=prompt + completion,
+        raw=raw,
+    )
+
+
+class _AnthropicUsageMixin(LLMTransport):
+    """Anthropic 流式：把 ``message_start`` 的输入 token 合进最终 usage；工具格式取预编译结果"""
+    @staticmethod
+    def _convert_tools(tools):
+        if isinstance(tools, CompiledTools):
+            return tools.anthropic
+        return HttpxAnthropicTransport._convert_tools(tools)
+
+    def _iter_anthropic_sse(self, rsp) -> Iterator[LLMEvent]:
+        state = AnthropicStream()
+        for event, payload in iter_frames(rsp.iter_bytes()):
+            for evt in state.feed(event, payload):
+                if evt.type == "done":
+                    evt.usage = _merge_anthropic_usage(state.start_usage, evt.usage)
+                yield evt
+            if state.stopped:
+                break
+
+    async def _aiter_anthropic_sse(self, rsp) -> AsyncIterator[LLMEvent]:
+        state = AnthropicStream()
+        async for event, payload in aiter_frames(rsp.aiter_bytes()):
+            for evt in state.feed(event, payload):
+                if evt.type == "done":
+                    evt.usage = _merge_anthropic_usage(state.start_usage, evt.usage)
+                yield evt
+            if state.stopped:
+                break
+
+
+_metered_classes: Dict[type, type] = {}
+_metered_lock = threading.Lock()
+
+
+def is_metered_transport(cls: Any) -> bool:
+    """transport 类是否是计量子类（构造时接受 ``xml_parser=`` / ``speculator=``）"""
+    return isinstance(cls, type) and issubclass(cls, _MeteredMixin)
+
+
+def metered_transport_cls(base: type) -> type:
+    """按原 transport 类派生（并缓存）计量子类"""
+    cls = _metered_classes.get(base)
+    if cls is not None:
+        return cls
+    with _metered_lock:
+        cls = _metered_classes.get(base)
+        if cls is None:
+            if issubclass(base, HttpxAnthropicTransport):
+                mixins = (_AnthropicUsageMixin, _MeteredMixin)
+            elif issubclass(base, HttpxOpenAITransport):
+                mixins = (_OpenAIUsageMixin, _MeteredMixin)
+            else:
+                mixins = (_MeteredMixin,)
+            cls = type(f"Metered{base.__name__}", (*mixins, base), {})
+            _metered_classes[base] = cls
+    return cls
+
+
+def adopt_transport(transport: Any, *, agent_name: Optional[str] = None, speculator: Any = None) -> Any:
+    """
+    把已经构造好的 transport 就地换成计量子类：原类的 ``__init__`` 已经跑过，这里补上计量部分的初始化；
+    原版每次新建的 HTTP 客户端换成共享的（新建的那个关掉）
+    """
+    transport.__class__ = metered_transport_cls(type(transport))
+    if isinstance(transport, _POOLED_TRANSPORTS):
+        fresh = getattr(transport, "_client", None)
+        transport._client = get_http_pool().client_for(transport.endpoint)
+        raw = getattr(fresh, "client", None)
+        if raw is not None:
+            try:
+                raw.close()
+            except Exception:  # pragma: no cover - 关不掉也不影响本次请求
+                pass
+    transport._init_metering(agent_name, None, speculator)
+    return transport
+
+
+def install_metering(agent: Any) -> None:
+    """给 Agent 副本装上计量 transport（只改实例属性）"""
+    base = getattr(type(agent), "_transport_cls", None)
+    if isinstance(base, type):
+        transport_kwargs = agent._transport_kwargs
+        agent._transport_cls = metered_transport_cls(base)
+        agent._transport_kwargs = lambda: {**transport_kwargs(), "agent_name": agent.name}
+
+    build_request = getattr(agent, "_build_anthropic_request", None)
+    if build_request is not None:
+        # 请求仍由 tangyuanAI（或子类覆写）的实现构造，只把返回的 transport 换成计量子类 + 共享客户端
+        def _build_anthropic_request():
+            req, transport = build_request()
+            return req, adopt_transport(
+                transport,
+                agent_name=agent.name,
+                speculator=getattr(agent, "_tool_speculator", None),
+            )
+
+        agent._build_anthropic_request = _build_anthropic_request
@@ -0,0 +1,159 @@
+"""
+Token 用量：单请求累加器 + 进程级 Agent × 模型账本。
+
+数据来源是 provider 自己报的 usage（见 ``api/transport.py``）：
+
+- OpenAI 兼容流式：请求带 ``stream_options.include_usage``，最后一帧的 ``usage``
+- Anthropic 流式：``message_start`` 的输入 token + ``message_delta`` 的输出 token
+- 非流式：响应体里的 ``usage``
+
+每次 LLM 调用结束时，transport 调 ``record_usage``：
+
+1. 记到当前 context 的 ``UsageAccumulator``（``current_usage``）—— 一个 chat 请求一份，
+   ``ask_for_help`` 派出去的子 Agent 调用在同一 context 里跑，所以也算进来
+2. 记到进程级 ``UsageLedger``，按 ``(agent, model)`` 汇总，``GET /usage`` 查看
+
+账本无锁：每个线程写自己的分片（只有本线程写，不需要锁），读的时候把各分片加总。
+写路径上没有跨线程竞争，对话线程再多也不会在记账上排队。线程退出后它的分片在下一次读的时候
+并进基数表，不会随着线程池换线程无限增长。
+"""
+
+from __future__ import annotations
+
+import contextvars
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from .models import ChatUsage, UsageLedgerEntry, UsageLedgerResponse
+
+
+class UsageAccumulator:
+    """一个 chat 请求的 token 累加（含嵌套 ask_for_help 子调用）"""
+
+    __slots__ = ("_lock", "prompt_tokens", "completion_tokens", "calls")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.calls = 0
+
+    def update(self, prompt: int, completion: int) -> None:
+        # 子 Agent 可能在别的线程里同时记账
+        with self._lock:
+            self.prompt_tokens += prompt or 0
+            self.completion_tokens += completion or 0
+            self.calls += 1
+
+    def total(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def to_usage(self) -> ChatUsage:
+        return ChatUsage(
+            prompt_tokens=self.prompt_tokens,
+            completion_tokens=self.completion_tokens,
+            total_tokens=self.total(),
+        )
+
+
+# 当前 chat 请求的累加器（ConversationExecutor / asyncio.to_thread 会把 context 带进工作线程）
+current_usage: contextvars.ContextVar[Optional[UsageAccumulator]] = contextvars.ContextVar(
+    "current_usage", default=None,
+)
+
+
+class UsageLedger:
+    """
+    按 ``(agent, model)`` 汇总的进程级账本。
+
+    每个线程一个分片 ``{(agent, model): [calls, prompt, completion]}``，只有所属线程写；
+    ``snapshot`` 读各分片时复制一份再加总，不阻塞写入方。已经退出的线程不会再写，
+    ``snapshot`` 把它们的分片并进 ``_base`` 后丢掉。
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards: List[Tuple[threading.Thread, Dict[Tuple[str, str], List[int]]]] = []
+        self._base: Dict[Tuple[str, str], List[int]] = {}   # 已退出线程的合计
+        self._shards_lock = threading.Lock()      # 注册分片、合并退出线程的分片
+
+    def record(self, agent: str, model: str, prompt: int, completion: int) -> None:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append((threading.current_thread(), shard))
+        row = shard.get((agent, model))
+        if row is None:
+            row = shard[(agent, model)] = [0, 0, 0]
+        row[0] += 1
+        row[1] += prompt or 0
+        row[2] += completion or 0
+
+    @staticmethod
+    def _merge(totals: Dict[Tuple[str, str], List[int]], shard: Dict[Tuple[str, str], List[int]]) -> None:
+        for key, row in list(shard.items()):
+            acc = totals.setdefault(key, [0, 0, 0])
+            calls, prompt, completion = row
+            acc[0] += calls
+            acc[1] += prompt
+            acc[2] += completion
+
+    def snapshot(self) -> UsageLedgerResponse:
+        with self._shards_lock:
+            live = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    self._merge(self._base, shard)
+            self._shards = live
+            totals = {key: list(row) for key, row in self._base.items()}
+        for _, shard in live:
+            self._merge(totals, shard)
+        entries = [
+            UsageLedgerEntry(
+                agent=agent,
+                model=model,
+                calls=calls,
+                prompt_tokens=prompt,
+                completion_tokens=completion,
+                total_tokens=prompt + completion,
+            )
+            for (agent, model), (calls, prompt, completion) in sorted(totals.items())
+        ]
+        return UsageLedgerResponse(
+            entries=entries,
+            prompt_tokens=sum(e.prompt_tokens for e in entries),
+            completion_tokens=sum(e.completion_tokens for e in entries),
+            total_tokens=sum(e.total_tokens for e in entries),
+        )
+
+    def reset(self) -> None:
+        """清空账本（测试 / 运维用）"""
+        with self._shards_lock:
+            self._base.clear()
+            for _, shard in self._shards:
+                shard.clear()
+
+
+_ledger = UsageLedger()
+
+
+def get_usage_ledger() -> UsageLedger:
+    """返回进程级 UsageLedger"""
+    return _ledger
+
+
+def record_usage(agent: Optional[str], model: Optional[str], usage: Any) -> None:
+    """
+    记一次 LLM 调用的用量（``usage`` 是 tangyuanAI 的 ``UsageInfo``；None 表示 provider 没报）。
+    """
+    if usage is None:
+        return
+    prompt = int(getattr(usage, "prompt_tokens", 0) or 0)
+    completion = int(getattr(usage, "completion_tokens", 0) or 0)
+    acc = current_usage.get()
+    if acc is not None:
+        acc.update(prompt, completion)
+    _ledger.record(agent or "unknown", model or "unknown", prompt, completion)
@@ -0,0 +1,284 @@
+"""
+XML 标签模式（``fc_model=False``）的工具调用：流式增量解析，不再整段正则扫描 + 每个调用一遍 BeautifulSoup。
+
+tangyuanAI 的 ``_handle_xml_mode`` 等整条回复收完后用正则在全文里找 ``<工具名>...</工具名>``，
+每个块再 ``BeautifulSoup(block, "xml")`` 解析一遍取参数；工具拿到的 ``xml`` 字符串往往又被
+``BeautifulSoup`` 解析一遍（``docs.md`` 的写法）。这里：
+
+- ``XmlCallParser``：标签状态机，计量 transport（``api/transport.py``）每收到一段文本就 ``feed`` 一次，
+  每段只看新来的字符（外加至多一个闭合标签长度的尾巴），块一闭合就产出 ``XmlToolCall``
+- ``XmlToolCall`` 是原始 XML 字符串（``str`` 子类），同时带着预解析好的 ``name`` / ``args``：
+  老工具 ``def search_web(xml=None)`` 照旧拿到 XML 文本自己解析，新工具可以直接读 ``xml.args``
+- ``handle_xml_mode``：副本版 ``_handle_xml_mode``，执行逻辑与原版一致，只是块和参数直接取解析器的结果；
+  收到的文本与喂给解析器的对不上（如流式中途出错）时对全文重新解析一遍
+
+与原版正则的语义保持一致：``<out_text>`` / ``<thinking>`` 标签先去掉；开标签不带属性；
+一个块到第一个同名闭合标签为止；开了没闭合的标签在流结束时作废，从它后面重新找。
+
+``install_xml_calls`` 由 ``AgentPool`` 在派生副本时调用，只改副本实例属性；``_handle_xml_mode`` 被子类覆写过的不接管。
+"""
+
+from __future__ import annotations
+
+import functools
+import html
+import inspect
+import logging
+import re
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_NAME = r"[\w一-鿿㐀-䶿]"
+_OPEN = re.compile(rf"<({_NAME}+)>")
+_OPEN_PREFIX = re.compile(rf"<{_NAME}*")
+_CLEAN = re.compile(r"</?(out_text|thinking)>")
+_CLEAN_TAGS = ("<out_text>", "</out_text>", "<thinking>", "</thinking>")
+_CHILD = re.compile(rf"<({_NAME}+)(?:\s[^<>]*?)?(?:/>|>(.*?)</\1\s*>)", flags=re.S)
+_CDATA = re.compile(r"<!\[CDATA\[(.*?)\]\]>", flags=re.S)
+_TAG = re.compile(r"<[^<>]*>")
+
+
+class XmlToolCall(str):
+    """一个工具块的原始 XML；``name`` 是工具名，``args`` 是子元素名 → 文本（与原版 BeautifulSoup 的取法一致）"""
+
+    name: str
+    args: Dict[str, str]
+
+    def __new__(cls, raw: str, name: str, args: Dict[str, str]) -> "XmlToolCall":
+        call = super().__new__(cls, raw)
+        call.name = name
+        call.args = args
+        return call
+
+
+def _text(body: str) -> str:
+    """元素内的全部文本：去掉子标签、解开实体，CDATA 原样保留"""
+    parts: List[str] = []
+    pos = 0
+    for m in _CDATA.finditer(body):
+        parts.append(html.unescape(_TAG.sub("", body[pos:m.start()])))
+        parts.append(m.group(1))
+        pos = m.end()
+    parts.append(html.unescape(_TAG.sub("", body[pos:])))
+    return "".join(parts)
+
+
+def parse_args(inner: str) -> Dict[str, str]:
+    """工具块内层 XML → ``{子元素名: 文本}``（同名子元素后出现的覆盖先出现的）"""
+    return {m.group(1): _text(m.group(2) or "") for m in _CHILD.finditer(inner)}
+
+
+def _make_call(name: str, raw: str) -> XmlToolCall:
+    return XmlToolCall(raw, name, parse_args(raw[len(name) + 2:-(len(name) + 3)]))
+
+
+class XmlCallParser:
+    """按 chunk 喂文本，增量找出完整的 ``<工具名>...</工具名>`` 块；``calls`` 是到目前为止找到的全部块"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.length = 0                      # 喂进来的原始字符数（与 full_content 对账用）
+        self.calls: List[XmlToolCall] = []
+        self._carry = ""                     # 可能是 out_text / thinking 标签开头的尾巴
+        self._pending = ""                   # 块外：可能是开标签开头的尾巴（如 "<ask_fo"）
+        self._name: Optional[str] = None     # 块内：当前工具名
+        self._closing = ""
+        self._parts: List[str] = []
+        self._tail = ""                      # 块内：最后不到一个闭合标签长度的字符，跨 chunk 找闭合标签
+
+    def feed(self, chunk: str) -> List[XmlToolCall]:
+        """喂一段文本，返回这段里新闭合的块"""
+        if not chunk:
+            return []
+        self.length += len(chunk)
+        found = self._scan(self._clean(chunk))
+        self.calls.extend(found)
+        return found
+
+    def close(self) -> List[XmlToolCall]:
+        """文本结束：冲掉尾巴；没闭合的块作废，从它的开标签后面重新找"""
+        text, self._carry = self._carry, ""
+        found = self._scan(text)
+        while self._name is not None:
+            rest = "".join(self._parts)[len(self._name) + 2:]
+            self._name, self._parts, self._tail = None, [], ""
+            found.extend(self._scan(rest))
+        self._pending = ""
+        self.calls.extend(found)
+        return found
+
+    def _clean(self, chunk: str) -> str:
+        text = self._carry + chunk
+        self._carry = ""
+        if "<" not in text:
+            return text
+        text = _CLEAN.sub("", text)
+        i = text.rfind("<")
+        if i >= 0 and len(text) - i < len(_CLEAN_TAGS[1]) and any(t.startswith(text[i:]) for t in _CLEAN_TAGS):
+            self._carry = text[i:]
+            return text[:i]
+        return text
+
+    def _scan(self, text: str) -> List[XmlToolCall]:
+        found: List[XmlToolCall] = []
+        pos = 0
+        while True:
+            if self._name is None:
+                if self._pending:
+                    text, pos, self._pending = self._pending + text[pos:], 0, ""
+                i = text.find("<", pos)
+                if i < 0:
+                    return found
+                m = _OPEN.match(text, i)
+                if m is None:
+                    if _OPEN_PREFIX.fullmatch(text, i):
+                        self._pending = text[i:]
+                        return found
+                    pos = i + 1
+                    continue
+                self._name = m.group(1)
+                self._closing = f"</{self._name}>"
+                self._parts = [m.group(0)]
+                self._tail = ""
+                pos = m.end()
+                continue
+
+            window = self._tail + text[pos:]
+            j = window.find(self._closing)
+            if j < 0:
+                self._parts.append(text[pos:])
+                self._tail = window[max(0, len(window) - len(self._closing) + 1):]
+                return found
+            end = pos + j + len(self._closing) - len(self._tail)
+            self._parts.append(text[pos:end])
+            found.append(_make_call(self._name, "".join(self._parts)))
+            self._name, self._parts, self._tail = None, [], ""
+            pos = end
+
+
+def parse_xml_calls(text: str) -> List[XmlToolCall]:
+    """一次性解析整段文本"""
+    parser = XmlCallParser()
+    parser.feed(text)
+    parser.close()
+    return parser.calls
+
+
+@functools.lru_cache(maxsize=512)
+def _signature(func: Any) -> Optional[inspect.Signature]:
+    try:
+        return inspect.signature(func)
+    except (TypeError, ValueError):
+        return None
+
+
+def _invoke(tool_func: Any, call: XmlToolCall, params: Dict[str, Any]) -> Any:
+    """
+    与原版相同的传参规则：只有一个必填参数且只给了一个参数时按位置传；能按参数名绑定就按名传；
+    否则把整个块当 ``xml`` 传（``XmlToolCall``，即原始 XML 文本）。原版是先按名调用、
+    抛 TypeError 再退回传 XML，工具自己抛的 TypeError 也会让它再执行一遍，这里改成先检查能否绑定
+    """
+    sig = _signature(tool_func)
+    if sig is None:
+        return tool_func(**params)
+    values = sig.parameters.values()
+    required = [p for p in values if p.default is inspect.Parameter.empty
+                and p.kind not in (inspect.Parameter.VAR_POSITIONAL, inspect.Parameter.VAR_KEYWORD)]
+    has_kwargs = any(p.kind is inspect.Parameter.VAR_KEYWORD for p in values)
+    if not has_kwargs and len(required) == 1 and len(params) == 1:
+        return tool_func(next(iter(params.values())))
+    try:
+        sig.bind(**params)
+    except TypeError:
+        return tool_func(call)
+    return tool_func(**params)
+
+
+def handle_xml_mode(agent: Any, work_history: List[dict], full_content: str):
+    """副本版 ``_handle_xml_mode``：块和参数取自流式解析器，执行 / 钩子 / 回填与原版一致"""
+    from tangyuanAI.agent_tool import _validate_tool_args_for, tool_registry
+
+    parser: Optional[XmlCallParser] = getattr(agent, "_xml_parser", None)
+    if parser is not None and parser.length == len(full_content):
+        parser.close()
+        calls = list(parser.calls)
+    else:
+        calls = parse_xml_calls(full_content)
+    if parser is not None:
+        parser.reset()
+
+    if not calls:
+        if agent.fc_model:
+            return None
+        return full_content
+
+    results: List[tuple] = []
+    reported = False
+    for call in calls:
+        logger.debug("发现工具块：%s...", call[:50])
+        tool_name = call.name
+        tool_info = tool_registry.get_tool_info(tool_name) if tool_registry.check_permission(agent.uuid, tool_name) else None
+        tool_func = tool_info["function"] if tool_info is not None else None
+
+        if tool_func is None:
+            available_tools = agent.get_all_available_tools()
+            tool_error = f"工具错误：工具 '{tool_name}' 未注册或无权限。"
+            if available_tools:
+                tool_error += f" 你可以使用以下工具：{', '.join(available_tools)}"
+            work_history.append({"role": "system", "content": tool_error})
+            # 原版把错误也塞进结果列表、工具名却不记，之后 zip 会把结果和工具名错位；这里只记一次系统消息
+            reported = True
+            logger.warning("工具 %s 未注册或无权限，可用工具: %s", tool_name, available_tools)
+            continue
+
+        params: Dict[str, Any] = dict(call.args)
+        agent.current_task_id = agent._generate_task_id()
+        agent._execute_hooks("before", tool_name, params)
+        agent.pack(tool_name=tool_name, tool_parameter=params)
+
+        try:
+            params = _validate_tool_args_for(agent, tool_name, params)
+        except Exception as e:
+            result = f"工具参数校验失败：{e}"
+            results.append((tool_name, result))
+            agent._execute_hooks("error", tool_name, params, result)
+            continue
+
+        result = _invoke(tool_func, call, params)
+        agent._execute_hooks("after", tool_name, params, result)
+        agent.pack(tool_result=result, tool_name=tool_name)
+        if not result:
+            result = f"no return for the tool {tool_name}"
+        results.append((tool_name, result))
+
+    if "<attempt_completion>" in full_content:
+        agent.pack("\n[系统] AI 已标记任务完成，程序退出。", tool_name="attempt_completion")
+
+    if results or reported:
+        for name, res in results:
+            work_history.append({"role": "system", "content": f"{name} results: {res}"})
+        return agent.conversation()
+    return full_content
+
+
+def install_xml_calls(agent: Any) -> None:
+    """给 OpenAI 协议的 Agent 副本换上流式解析版 XML 标签模式（只改实例属性；子类覆写过的不动）"""
+    try:
+        from tangyuanAI.agent import _OpenAIBase
+    except ImportError:  # pragma: no cover
+        return
+    from .transport import is_metered_transport
+
+    cls = type(agent)
+    if not isinstance(agent, _OpenAIBase) or cls._handle_xml_mode is not _OpenAIBase._handle_xml_mode:
+        return
+    if not is_metered_transport(getattr(agent, "_transport_cls", None)):
+        return
+    parser = agent._xml_parser = XmlCallParser()
+    transport_kwargs = agent._transport_kwargs
+    # FC 模式下 XML 块很少见，不逐段解析，结束时（如有需要）对全文解析一次
+    agent._transport_kwargs = lambda: transport_kwargs() if agent.fc_model else {**transport_kwargs(), "xml_parser": parser}
+    agent._handle_xml_mode = functools.partial(handle_xml_mode, agent)
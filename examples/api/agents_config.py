@@ -14,7 +14,7 @@ Agent 配置示例 —— 业务方在这个文件里写 @template_agent。
 
 只要 import 这个文件，@template_agent 装饰器就把 Agent 类登记到
 ``agent_template_pool``；需要实例化时调 ``tangyuanAI.activate_template(name)``
-（API 启动时 app.py 会自动激活所有已登记模板）。
+（本文件末尾在 import 时激活；``AGENTS_LAZY_ACTIVATION=1`` 时改由 API 按需激活）。
 """
 
 import os
@@ -23,6 +23,8 @@ import uuid
 import tangyuanAI
 from tangyuanAI.Agent_list import activate_template
 
+from api.activation import lazy_activation_enabled
+
 
 # 示例 Agent 1：单 Agent 基础用法（OpenAI 协议）
 @tangyuanAI.template_agent(
@@ -69,6 +71,8 @@ def echo(text: str) -> str:
     return f"echo: {text}"
 
 
-# 在 import 时自动激活（让 GET /agents 立即能看到）
-activate_template("api_demo_agent")
-activate_template("api_claude_agent")
\ No newline at end of file
+# 在 import 时自动激活（让 GET /agents 立即能看到）；
+# AGENTS_LAZY_ACTIVATION=1 时跳过，由 API 在第一次用到时再激活
+if not lazy_activation_enabled():
+    activate_template("api_demo_agent")
+    activate_template("api_claude_agent")
\ No newline at end of file
@@ -39,7 +39,11 @@ if str(_ROOT) not in sys.path:
 # Mock HTTP servers —— 假装是 OpenAI / Anthropic 真实 API
 # ---------------------------------------------------------------------------
 
-def _make_openai_sse_chunks(text: str = "hello world", tool_calls: Optional[list] = None) -> list:
+def _make_openai_sse_chunks(
+    text: str = "hello world",
+    tool_calls: Optional[list] = None,
+    include_usage: bool = False,
+) -> list:
     """构造 OpenAI Chat Completions 的 SSE 流（与 tangyuanAI.llm_transport.HttpxOpenAITransport 期望的格式一致）"""
     chunks = []
     chunks.append({
@@ -82,6 +86,16 @@ def _make_openai_sse_chunks(text: str = "hello world", tool_calls: Optional[list
         "model": "test-model",
         "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
     })
+    if include_usage:
+        # stream_options.include_usage：最后一帧 choices 为空，只带 usage
+        chunks.append({
+            "id": "chatcmpl-test",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": "test-model",
+            "choices": [],
+            "usage": {"prompt_tokens": 7, "completion_tokens": len(text), "total_tokens": 7 + len(text)},
+        })
     return chunks
 
 
@@ -127,23 +141,33 @@ class _OpenAIMockHandler(BaseHTTPRequestHandler):
     # 类级可配置：默认 mock 返回内容
     response_text: str = "hello world"
     tool_calls: Optional[list] = None
+    chunk_delay: float = 0.0                 # 每帧之间 sleep（模拟慢 provider）
+    last_request: Optional[dict] = None      # 最近一次请求体（验证发给 provider 的 messages）
 
     def do_POST(self):
-        # 读 body 但不解析（mock 不关心 input）
         length = int(self.headers.get("Content-Length", 0))
         if length:
-            self.rfile.read(length)
+            try:
+                type(self).last_request = json.loads(self.rfile.read(length))
+            except ValueError:
+                pass
 
         self.send_response(200)
         self.send_header("Content-Type", "text/event-stream")
         self.send_header("Cache-Control", "no-cache")
         self.end_headers()
 
-        for chunk in _make_openai_sse_chunks(self.response_text, self.tool_calls):
-            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+        include_usage = bool(((self.last_request or {}).get("stream_options") or {}).get("include_usage"))
+        try:
+            for chunk in _make_openai_sse_chunks(self.response_text, self.tool_calls, include_usage):
+                if self.chunk_delay:
+                    time.sleep(self.chunk_delay)
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
             self.wfile.flush()
-        self.wfile.write(b"data: [DONE]\n\n")
-        self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # 客户端（transport）提前断开
 
     def log_message(self, format, *args):  # noqa: A002
         pass  # 静默访问日志
@@ -246,7 +270,7 @@ def client(mock_urls):
 
     # 3. 构造 FastAPI app
     from fastapi import FastAPI
-    from api.routes import agents, health, mcp, skills, tools
+    from api.routes import agents, health, mcp, metrics, skills, tools, usage
 
     app = FastAPI(title="AI Company API (test)", version=_da.__version__)
     app.include_router(health.router)
@@ -254,6 +278,8 @@ def client(mock_urls):
     app.include_router(tools.router)
     app.include_router(skills.router)
     app.include_router(mcp.router)
+    app.include_router(usage.router)
+    app.include_router(metrics.router)
 
     from fastapi.testclient import TestClient
     yield TestClient(app)
@@ -275,6 +301,7 @@ def test_health(client):
     assert "version" in body
     assert body["n_agents"] >= 1
     assert body["n_tools"] >= 1
+    assert body["executor"]["max_workers"] >= 1
 
 
 def test_list_agents(client):
@@ -362,6 +389,39 @@ def test_chat_non_stream_anthropic(client):
     assert text == "hello from anthropic mock"
 
 
+def test_chat_non_stream_runs_off_event_loop(client):
+    """非流式 chat 走 ConversationExecutor 线程池，完成后计入统计"""
+    from api.executor import get_executor
+
+    before = get_executor().stats().completed
+    rsp = client.post(
+        "/agents/api_demo_agent/chat",
+        json={"messages": [{"role": "user", "content": "hi"}]},
+    )
+    assert rsp.status_code == 200
+    stats = get_executor().stats()
+    assert stats.completed == before + 1
+    assert stats.queued == 0
+    assert stats.running == 0
+
+
+def test_conversation_executor_stats():
+    import asyncio
+    from api.executor import ConversationExecutor
+
+    ex = ConversationExecutor(max_workers=1)
+
+    async def main():
+        return await asyncio.gather(*(ex.run(time.sleep, 0.02) for _ in range(3)))
+
+    asyncio.run(main())
+    stats = ex.stats()
+    ex.shutdown()
+    assert stats.completed == 3
+    # 单线程串行：后两个任务必然排过队
+    assert stats.wait_seconds_max > 0.0
+
+
 def test_chat_stream_openai(client):
     """流式 chat 走 OpenAI mock server —— 验证 SSE 事件链路完整"""
     rsp = client.post(
@@ -398,6 +458,597 @@ def test_chat_stream_anthropic(client):
     assert '"event": "done"' in body
 
 
+def test_chat_does_not_touch_template_instance(client):
+    """chat 跑在 AgentPool 副本上：注册的模板实例 out / history 保持原样"""
+    import tangyuanAI as _da
+
+    inst = _da.agent_list["api_demo_agent"]
+    history_len = len(inst.history)
+    assert "out" not in inst.__dict__
+    for stream in (False, True):
+        rsp = client.post(
+            "/agents/api_demo_agent/chat",
+            json={"messages": [{"role": "user", "content": "hi"}], "stream": stream},
+        )
+        assert rsp.status_code == 200
+    assert len(inst.history) == history_len
+    assert "out" not in inst.__dict__
+
+
+def test_concurrent_streams_do_not_mix(client):
+    """同一个 Agent 的并发流各自拿到完整、独立的事件序列"""
+    results: list = []
+
+    def one():
+        rsp = client.post(
+            "/agents/api_demo_agent/chat",
+            json={"messages": [{"role": "user", "content": "hi"}], "stream": True},
+        )
+        deltas = [
+            json.loads(line[len("data: "):])["data"].get("delta", "")
+            for line in rsp.text.splitlines()
+            if line.startswith("data: ") and '"event": "text"' in line
+        ]
+        results.append("".join(deltas))
+
+    threads = [threading.Thread(target=one) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(results) == 4
+    for text in results:
+        assert text.startswith("hello from openai mock")
+        assert text.count("hello from openai mock") == 1
+
+
+def test_agent_pool_isolates_clones():
+    from api.pool import AgentPool
+
+    class _Template:
+        def __init__(self):
+            self.history = [{"role": "system", "content": "sys"}]
+            self.tool_call_hooks = []
+
+        def out(self, content):
+            pass
+
+    tpl = _Template()
+    pool = AgentPool(max_idle_per_agent=1)
+    a = pool.acquire(tpl, out=lambda c: None)
+    b = pool.acquire(tpl)
+    a.history.append({"role": "user", "content": "x"})
+    assert b.history == tpl.history == [{"role": "system", "content": "sys"}]
+    assert "out" in a.__dict__ and "out" not in b.__dict__
+    pool.release(a)
+    pool.release(b)
+    c = pool.acquire(tpl)
+    assert c is a                                    # 复用空闲副本
+    assert c.history == [{"role": "system", "content": "sys"}]
+    assert "out" not in c.__dict__
+    assert pool.stats()["reused"] == 1
+
+
+def test_agent_pool_does_not_pin_templates():
+    import gc
+    import weakref
+
+    from api.pool import AgentPool
+
+    class _Template:
+        def __init__(self):
+            self.history = []
+            self.tool_call_hooks = []
+
+    tpl = _Template()
+    pool = AgentPool(max_idle_per_agent=1)
+    pool.release(pool.acquire(tpl))
+    assert pool.stats()["idle"] == 1
+    ref = weakref.ref(tpl)
+    del tpl
+    gc.collect()
+    assert ref() is None                             # 空闲副本不会把模板留住
+    assert pool.stats()["idle"] == 0
+
+
+def test_admission_controller_queue_and_reject():
+    import asyncio
+    from fastapi import HTTPException
+    from api.admission import AdmissionController
+
+    ctrl = AdmissionController(max_concurrency=1, max_per_agent=1, max_queue=1, queue_timeout=5)
+
+    async def main():
+        assert await ctrl.acquire("a") == 0.0
+        waiter = asyncio.create_task(ctrl.acquire("a"))
+        await asyncio.sleep(0.01)
+        # 队列（容量 1）已被 waiter 占满 → 429 + Retry-After
+        with pytest.raises(HTTPException) as exc:
+            await ctrl.acquire("b")
+        assert exc.value.status_code == 429
+        assert "Retry-After" in exc.value.headers
+        ctrl.release("a")
+        waited = await waiter
+        assert waited > 0.0
+        ctrl.release("a")
+
+    asyncio.run(main())
+    stats = ctrl.stats()
+    assert stats.active == 0 and stats.waiting == 0
+    assert stats.admitted == 2 and stats.rejected == 1
+
+
+def test_admission_controller_queue_timeout():
+    import asyncio
+    from fastapi import HTTPException
+    from api.admission import AdmissionController
+
+    ctrl = AdmissionController(max_concurrency=4, max_per_agent=1, max_queue=4, queue_timeout=0.05)
+
+    async def main():
+        await ctrl.acquire("a")
+        # 其他 Agent 不受 a 的单 Agent 上限影响
+        await ctrl.acquire("b")
+        with pytest.raises(HTTPException) as exc:
+            await ctrl.acquire("a")
+        assert exc.value.status_code == 503
+
+    asyncio.run(main())
+    assert ctrl.stats().timed_out == 1
+    assert ctrl.stats().waiting == 0
+
+
+def test_admission_waiter_does_not_block_other_agents():
+    """a 的等待者排在队里时，b 只要全局和自己的名额都有空就直接放行"""
+    import asyncio
+    from api.admission import AdmissionController
+
+    ctrl = AdmissionController(max_concurrency=10, max_per_agent=1, max_queue=4, queue_timeout=1)
+
+    async def main():
+        await ctrl.acquire("a")
+        waiter = asyncio.create_task(ctrl.acquire("a"))
+        await asyncio.sleep(0.01)
+        assert ctrl.stats().waiting == 1
+        assert await asyncio.wait_for(ctrl.acquire("b"), timeout=0.2) == 0.0
+        # 同一 Agent 仍按 FIFO：a 的名额归还后先给排队的那个
+        ctrl.release("a")
+        assert await waiter > 0.0
+        ctrl.release("a")
+        ctrl.release("b")
+
+    asyncio.run(main())
+    stats = ctrl.stats()
+    assert stats.active == 0 and stats.waiting == 0 and stats.timed_out == 0
+
+
+def test_stream_slot_released_when_body_never_starts(client):
+    """发响应头时客户端已断开（send 抛错），body 生成器没启动，名额也要归还"""
+    import asyncio
+    from api.admission import get_admission
+
+    body = json.dumps({"messages": [{"role": "user", "content": "hi"}], "stream": True}).encode()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/agents/api_demo_agent/chat", "raw_path": b"/agents/api_demo_agent/chat",
+        "query_string": b"", "root_path": "", "headers": [(b"content-type", b"application/json")],
+        "client": ("test", 1), "server": ("test", 80),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            raise OSError("client gone")
+
+    before = get_admission().stats().active
+    with pytest.raises(Exception):
+        asyncio.run(client.app(scope, receive, send))
+    assert get_admission().stats().active == before
+
+
+def test_chat_rejected_when_overloaded(client, monkeypatch):
+    from api import admission
+
+    ctrl = admission.AdmissionController(max_concurrency=0, max_per_agent=1, max_queue=0)
+    monkeypatch.setattr(admission, "_default_controller", ctrl)
+    rsp = client.post(
+        "/agents/api_demo_agent/chat",
+        json={"messages": [{"role": "user", "content": "hi"}]},
+    )
+    assert rsp.status_code == 429
+    assert int(rsp.headers["retry-after"]) >= 1
+
+    # 被拒的请求不新建会话
+    rsp = client.post(
+        "/agents/api_demo_agent/chat",
+        json={
+            "messages": [
+                {"role": "user", "content": "earlier"},
+                {"role": "assistant", "content": "reply"},
+                {"role": "user", "content": "hi"},
+            ],
+            "session_id": "rejected-session",
+        },
+    )
+    assert rsp.status_code == 429
+    monkeypatch.undo()
+    assert client.get("/agents/api_demo_agent/sessions/rejected-session").status_code == 404
+
+
+def test_chat_reports_queue_wait(client):
+    rsp = client.post(
+        "/agents/api_demo_agent/chat",
+        json={"messages": [{"role": "user", "content": "hi"}]},
+    )
+    assert rsp.status_code == 200
+    assert float(rsp.headers["x-queue-wait-ms"]) >= 0.0
+    body = client.get("/health").json()
+    assert body["admission"]["active"] == 0
+
+
+def test_stream_cancel_stops_agent_run(client, monkeypatch):
+    """SSE 消费方取消后，后台对话在一个 chunk 内停下，不再继续读 provider 的流"""
+    import asyncio
+    import tangyuanAI as _da
+    from api.cancellation import CancelToken
+    from api.deps import stream_agent_chat
+    from api.pool import get_agent_pool
+
+    monkeypatch.setattr(_OpenAIMockHandler, "response_text", "x" * 200)
+    monkeypatch.setattr(_OpenAIMockHandler, "chunk_delay", 0.01)
+    inst = _da.agent_list["api_demo_agent"]
+    in_use = get_agent_pool().stats()["in_use"]
+
+    async def main():
+        token = CancelToken()
+        gen = stream_agent_chat(inst, messages="hi", cancel_token=token)
+        first = await gen.__anext__()
+        assert first.get("message") == "x"
+        token.cancel()
+        started = time.perf_counter()
+        rest = [item async for item in gen]
+        return rest, time.perf_counter() - started
+
+    rest, elapsed = asyncio.run(main())
+    # 整段流要 ~2s；取消后应在几个 chunk 内收尾
+    assert elapsed < 1.0
+    assert len(rest) <= 2
+    # 后台线程已结束并归还副本
+    assert get_agent_pool().stats()["in_use"] == in_use
+
+
+def test_stream_coalesces_text_deltas(client):
+    """逐字符的 provider 流被合成少量 SSE 帧，拼起来的文本不变"""
+    rsp = client.post(
+        "/agents/api_demo_agent/chat",
+        json={"messages": [{"role": "user", "content": "hi"}], "stream": True},
+    )
+    frames = [
+        json.loads(line[len("data: "):])
+        for line in rsp.text.splitlines()
+        if line.startswith("data: ")
+    ]
+    text_frames = [f for f in frames if f["event"] == "text"]
+    text = "".join(f["data"]["delta"] for f in text_frames)
+    assert text.startswith("hello from openai mock")
+    assert len(text_frames) < len(text)
+    assert frames[-1]["event"] == "done"
+    assert frames[-1]["agent_name"] == "api_demo_agent"
+
+
+def test_sse_encoder_and_coalesce():
+    import asyncio
+    from api.streaming import SSEEncoder, coalesce
+
+    enc = SSEEncoder("名字", "uid")
+    for event, data in [("text", {"delta": "你\"好\n"}), ("tool_call", {"name": "echo", "input": {}})]:
+        expected = "data: " + json.dumps(
+            {"event": event, "data": data, "agent_name": "名字", "agent_uuid": "uid"},
+            ensure_ascii=False,
+        ) + "\n\n"
+        assert enc.frame(event, data) == expected
+
+    async def source():
+        for ch in "abcd":
+            yield "text", {"delta": ch}
+        yield "tool_call", {"name": "echo"}
+        yield "text", {"delta": "e" * 10}
+        await asyncio.sleep(0.05)
+        yield "text", {"delta": "f"}
+
+    async def collect(**kw):
+        return [item async for item in coalesce(source(), **kw)]
+
+    out = asyncio.run(collect(window_ms=20, max_bytes=3))
+    assert out == [
+        ("text", {"delta": "abc"}),
+        ("text", {"delta": "d"}),
+        ("tool_call", {"name": "echo"}),
+        ("text", {"delta": "e" * 10}),
+        ("text", {"delta": "f"}),
+    ]
+    out = asyncio.run(collect(window_ms=20, max_bytes=1024))
+    assert [d["delta"] for e, d in out if e == "text"] == ["abcd", "e" * 10, "f"]
+    assert len(asyncio.run(collect(window_ms=0))) == 7
+
+
+def test_chat_session_keeps_history(client):
+    """带 session_id：服务端保存历史，续聊只发新消息，provider 能看到之前的轮次"""
+    sid = "test-session-history"
+    rsp = client.post(
+        "/agents/api_demo_agent/chat",
+        json={
+            "messages": [
+                {"role": "user", "content": "第一轮问题"},
+                {"role": "assistant", "content": "第一轮回答"},
+                {"role": "user", "content": "第二轮"},
+            ],
+            "session_id": sid,
+        },
+    )
+    assert rsp.status_code == 200
+    assert rsp.json()["session_id"] == sid
+
+    rsp = client.post(
+        "/agents/api_demo_agent/chat",
+        json={"messages": [{"role": "user", "content": "第三轮"}], "session_id": sid, "stream": True},
+    )
+    assert rsp.status_code == 200
+    assert rsp.headers["x-session-id"] == sid
+    sent = json.dumps(_OpenAIMockHandler.last_request, ensure_ascii=False)
+    for text in ("第一轮问题", "第一轮回答", "第二轮", "第三轮"):
+        assert text in sent
+
+    body = client.get(f"/agents/api_demo_agent/sessions/{sid}").json()
+    contents = [m.get("content") for m in body["messages"]]
+    assert contents[:3] == ["第一轮问题", "第一轮回答", "第二轮"]
+    assert "第三轮" in contents
+    assert client.get("/health").json()["sessions"]["sessions"] >= 1
+
+    assert client.delete(f"/agents/api_demo_agent/sessions/{sid}").status_code == 200
+    assert client.get(f"/agents/api_demo_agent/sessions/{sid}").status_code == 404
+
+
+def test_session_store_bounds(tmp_path, monkeypatch):
+    from api import sessions
+    from api.sessions import SessionStore
+
+    def turn(i):
+        return [{"role": "user", "content": f"q{i}"}, {"role": "assistant", "content": "a" * 50}]
+
+    # 单会话字节上限：从头裁剪，且保留的历史以 user 消息开头
+    store = SessionStore(max_sessions=2, idle_ttl=0, max_bytes=300)
+    h = store.open("agent", "s1")
+    for i in range(10):
+        h.commit(turn(i))
+    msgs = store.open("agent", "s1").history
+    assert msgs[0]["role"] == "user"
+    assert msgs[-1] == turn(9)[1]
+    assert store.stats().bytes <= 300
+
+    # LRU：超过 max_sessions 淘汰最久未用的
+    store.open("agent", "s2", seed=turn(0))
+    store.open("agent", "s3", seed=turn(0))
+    assert store.open("agent", "s1").history == []
+    assert store.stats().evicted == 1
+
+    # 空闲 TTL
+    store = SessionStore(max_sessions=8, idle_ttl=60, max_bytes=1024)
+    store.open("agent", "old", seed=turn(0))
+    now = time.monotonic()
+    monkeypatch.setattr(sessions.time, "monotonic", lambda: now + 120)
+    assert store.open("agent", "old").history == []
+    assert store.stats().expired == 1
+    monkeypatch.undo()
+
+    # 落盘：淘汰出内存后从 append-only 日志重放
+    store = SessionStore(max_sessions=1, idle_ttl=0, max_bytes=1024, spill_dir=str(tmp_path))
+    store.open("agent", "a", seed=turn(1))
+    store.open("agent", "a").commit(turn(2))
+    store.open("agent", "b", seed=turn(0))
+    assert store.open("agent", "a").history == turn(1) + turn(2)
+    assert store.stats().restored == 1
+    assert store.delete("agent", "a")
+    assert store.open("agent", "a").history == []
+
+
+def test_session_evicted_mid_request_keeps_history(tmp_path):
+    """请求进行中会话被淘汰出内存：提交时先从日志重放，不丢之前的轮次，压缩也不会把它们写丢"""
+    from api.sessions import SessionStore
+
+    def turn(i):
+        return [{"role": "user", "content": f"u{i}"}, {"role": "assistant", "content": f"a{i}"}]
+
+    store = SessionStore(max_sessions=1, idle_ttl=0, max_bytes=1024, spill_dir=str(tmp_path))
+    handle = store.open("a", "s1")
+    handle.commit(turn(1))
+    handle = store.open("a", "s1")
+    store.open("a", "s2", seed=turn(0))            # 把 s1 挤出内存
+    handle.commit(turn(2))
+    assert store.open("a", "s1").history == turn(1) + turn(2)
+
+    # 反复淘汰 + 提交到触发日志压缩，历史仍然完整（在字节上限内）
+    store = SessionStore(max_sessions=1, idle_ttl=0, max_bytes=200, spill_dir=str(tmp_path / "compact"))
+    for i in range(20):
+        handle = store.open("a", "s1")
+        store.open("a", "s2", seed=turn(0))
+        handle.commit(turn(i))
+    assert store.open("a", "s1").history[-4:] == turn(18) + turn(19)
+
+
+def test_session_log_io_does_not_hold_store_lock(tmp_path):
+    """一个会话写日志卡住时，其它会话的读写不受影响"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from api.sessions import SessionStore
+
+    store = SessionStore(max_sessions=8, idle_ttl=0, max_bytes=1024, spill_dir=str(tmp_path))
+    entered, release = threading.Event(), threading.Event()
+    write_log = store._write_log
+
+    def slow_write_log(key, sess, lines):
+        if key[1] == "slow":
+            entered.set()
+            release.wait(5)
+        write_log(key, sess, lines)
+
+    store._write_log = slow_write_log
+    t = threading.Thread(target=store.append, args=(("agent", "slow"), [{"role": "user", "content": "q"}]))
+    t.start()
+    try:
+        assert entered.wait(5)
+        other = ThreadPoolExecutor(1).submit(
+            lambda: store.open("agent", "fast", seed=[{"role": "user", "content": "hi"}]).history,
+        )
+        assert other.result(timeout=2) == [{"role": "user", "content": "hi"}]
+        assert store.stats().sessions == 2
+    finally:
+        release.set()
+        t.join()
+    assert store.open("agent", "slow").history == [{"role": "user", "content": "q"}]
+
+
+def test_chat_reports_token_usage(client):
+    """provider 报告的 usage 进 ChatResponse.usage / 流式 usage 事件，并记入 /usage 账本"""
+    rsp = client.post(
+        "/agents/api_demo_agent/chat",
+        json={"messages": [{"role": "user", "content": "hi"}]},
+    )
+    usage = rsp.json()["usage"]
+    n = len("hello from openai mock")
+    assert usage == {"prompt_tokens": 7, "completion_tokens": n, "total_tokens": 7 + n}
+    assert _OpenAIMockHandler.last_request["stream_options"] == {"include_usage": True}
+
+    # Anthropic：输入 token 来自 message_start，输出 token 来自 message_delta
+    rsp = client.post(
+        "/agents/api_claude_agent/chat",
+        json={"messages": [{"role": "user", "content": "hi"}], "stream": True},
+    )
+    frames = [json.loads(line[len("data: "):]) for line in rsp.text.splitlines() if line.startswith("data: ")]
+    assert [f["event"] for f in frames[-2:]] == ["usage", "done"]
+    n = len("hello from anthropic mock")
+    assert frames[-2]["data"] == {"prompt_tokens": 5, "completion_tokens": n, "total_tokens": 5 + n}
+
+    ledger = client.get("/usage").json()
+    rows = {(e["agent"], e["model"]): e for e in ledger["entries"]}
+    assert rows[("api_demo_agent", "test-model")]["calls"] >= 1
+    assert rows[("api_claude_agent", "test-model")]["prompt_tokens"] >= 5
+    assert ledger["total_tokens"] == sum(e["total_tokens"] for e in ledger["entries"])
+
+
+def test_usage_includes_ask_for_help(client):
+    """ask_for_help 子 Agent 的用量记到发起方请求的累加器里，且不碰子 Agent 模板"""
+    import tangyuanAI as _da
+    from api.pool import get_agent_pool
+    from api.usage import UsageAccumulator, current_usage
+
+    target = _da.agent_list["api_claude_agent"]
+    history_len = len(target.history)
+    acc = UsageAccumulator()
+    token = current_usage.set(acc)
+    try:
+        with get_agent_pool().lease(_da.agent_list["api_demo_agent"]) as clone:
+            result = clone._dispatch_tool("ask_for_help", {"agent_id": "api_claude_agent", "message": "hi"})
+    finally:
+        current_usage.reset(token)
+    assert "hello from anthropic mock" in str(result[0])
+    assert acc.prompt_tokens == 5
+    assert acc.completion_tokens == len("hello from anthropic mock")
+    assert len(target.history) == history_len
+
+
+def test_usage_ledger_folds_dead_thread_shards():
+    """退出线程的分片在 snapshot 时并进基数表：合计不变，分片列表不随线程数增长"""
+    from api.usage import UsageLedger
+
+    ledger = UsageLedger()
+    for i in range(8):
+        t = threading.Thread(target=ledger.record, args=("a", "m", 10, i))
+        t.start()
+        t.join()
+    ledger.record("a", "m", 1, 1)
+    first = ledger.snapshot()
+    assert len(ledger._shards) == 1
+    assert first.entries[0].calls == 9
+    assert first.prompt_tokens == 81 and first.completion_tokens == sum(range(8)) + 1
+    assert ledger.snapshot() == first
+    ledger.reset()
+    assert ledger.snapshot().total_tokens == 0
+
+
+def test_chat_batch_ndjson(client):
+    """chat:batch 按完成顺序逐行返回 NDJSON，每行带 index / id / 用量"""
+    items = [
+        {"id": f"t{i}", "messages": [{"role": "user", "content": f"ticket {i}"}]}
+        for i in range(5)
+    ]
+    rsp = client.post("/agents/api_demo_agent/chat:batch", json={"items": items, "concurrency": 2})
+    assert rsp.status_code == 200
+    assert rsp.headers["content-type"].startswith("application/x-ndjson")
+    assert rsp.headers["x-batch-concurrency"] == "2"
+    rows = [json.loads(line) for line in rsp.text.splitlines()]
+    assert sorted(r["index"] for r in rows) == list(range(5))
+    for r in rows:
+        assert r["id"] == f"t{r['index']}"
+        assert r["error"] is None and r["status_code"] == 200
+        assert r["content"] == "hello from openai mock"
+        assert r["usage"]["prompt_tokens"] == 7
+
+    rsp = client.post(
+        "/agents/api_demo_agent/chat:batch",
+        json={"items": [{"messages": [{"role": "system", "content": "x"}]}]},
+    )
+    assert rsp.status_code == 400
+
+
+def test_metrics_endpoint(client):
+    """/metrics 导出 Prometheus 文本：TTFT / 对话耗时 / LLM 调用数 / SSE 帧 / 排队时间"""
+    rsp = client.post(
+        "/agents/api_demo_agent/chat",
+        json={"messages": [{"role": "user", "content": "hi"}], "stream": True},
+    )
+    assert rsp.status_code == 200
+
+    rsp = client.get("/metrics")
+    assert rsp.status_code == 200
+    assert rsp.headers["content-type"].startswith("text/plain; version=0.0.4")
+    samples = {}
+    for line in rsp.text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    assert samples['aicompany_chat_ttft_seconds_count{agent="api_demo_agent"}'] >= 1
+    assert samples['aicompany_chat_duration_seconds_count{agent="api_demo_agent",outcome="ok"}'] >= 1
+    assert samples['aicompany_chat_llm_calls_bucket{agent="api_demo_agent",le="+Inf"}'] >= 1
+    assert samples['aicompany_chat_queue_wait_seconds_count{agent="api_demo_agent"}'] >= 1
+    assert samples['aicompany_sse_frames_total{agent="api_demo_agent",event="done"}'] >= 1
+    assert samples['aicompany_chat_in_flight{agent="api_demo_agent"}'] == 0
+
+
+def test_metrics_histogram_render():
+    """直方图按桶累计导出；各线程分片在导出时合并"""
+    from api.metrics import Histogram
+
+    h = Histogram("t_seconds", "test", (0.1, 1), ("tool",))
+    h.observe(0.05, "echo")
+    t = threading.Thread(target=h.observe, args=(0.5, "echo"))
+    t.start()
+    t.join()
+    h.observe(3, "echo")
+    assert h.render()[2:] == [
+        't_seconds_bucket{tool="echo",le="0.1"} 1',
+        't_seconds_bucket{tool="echo",le="1"} 2',
+        't_seconds_bucket{tool="echo",le="+Inf"} 3',
+        't_seconds_sum{tool="echo"} 3.55',
+        't_seconds_count{tool="echo"} 3',
+    ]
+
+
 # ---------------------------------------------------------------------------
 # tests —— tools
 # ---------------------------------------------------------------------------
@@ -411,6 +1062,1030 @@ def test_list_tools(client):
     assert "echo" in names
 
 
+def test_registry_snapshots_etag(client):
+    """GET /agents、/tools 带 ETag；未变化时 If-None-Match 返 304，注册表变化后 ETag / 版本更新"""
+    import tangyuanAI as _da
+
+    rsp = client.get("/agents")
+    etag = rsp.headers["etag"]
+    assert rsp.json()["total"] >= 2
+    rsp2 = client.get("/agents", headers={"If-None-Match": etag})
+    assert rsp2.status_code == 304
+    assert rsp2.content == b""
+    assert rsp2.headers["x-registry-version"] == rsp.headers["x-registry-version"]
+
+    rsp = client.get("/tools")
+    etag, version = rsp.headers["etag"], int(rsp.headers["x-registry-version"])
+    assert client.get("/tools", headers={"If-None-Match": f'W/{etag}'}).status_code == 304
+
+    @_da.tool_registry.register_tool(name="snapshot_probe", description="probe", overwrite=True)
+    def snapshot_probe() -> str:
+        return "ok"
+
+    try:
+        rsp = client.get("/tools", headers={"If-None-Match": etag})
+        assert rsp.status_code == 200
+        assert rsp.headers["etag"] != etag
+        assert int(rsp.headers["x-registry-version"]) == version + 1
+        probe = next(t for t in rsp.json()["tools"] if t["name"] == "snapshot_probe")
+        assert probe["description"] == "probe"
+    finally:
+        _da.tool_registry._tools.pop("snapshot_probe", None)
+
+
+def test_registry_snapshots_keyed_on_version(client, monkeypatch):
+    """注册表没变时轮询不再扫描条目；直接写原 agent_list 的改动也能看到"""
+    import copy
+
+    import tangyuanAI as _da
+    from api import snapshots
+    from tangyuanAI.Agent_list import agent_list as raw_agent_list
+
+    fingerprint = snapshots.get_agent_snapshot()._fingerprint
+    monkeypatch.setattr(fingerprint, "rescan", 3600.0)
+    client.get("/agents")
+    client.get("/tools")
+    assert _da.agent_list is raw_agent_list          # 不替换 tangyuanAI 的模块全局 dict
+
+    scans = []
+    list_tools = _da.tool_registry.list_tools
+    pending = snapshots._pending_templates
+    monkeypatch.setattr(_da.tool_registry, "list_tools", lambda: scans.append("tools") or list_tools())
+    monkeypatch.setattr(snapshots, "_pending_templates", lambda: scans.append("agents") or pending())
+    rsp = client.get("/agents")
+    etag, total = rsp.headers["etag"], rsp.json()["total"]
+    assert client.get("/agents", headers={"If-None-Match": etag}).status_code == 304
+    tools_etag = client.get("/tools").headers["etag"]
+    assert client.get("/tools", headers={"If-None-Match": tools_etag}).status_code == 304
+    assert not scans
+
+    # 增删条目：看表的大小立刻发现
+    demo = raw_agent_list["api_demo_agent"]
+    probe = copy.copy(demo)
+    probe.uuid = "api-snapshot-probe"
+    raw_agent_list[probe.uuid] = probe
+    try:
+        rsp = client.get("/agents", headers={"If-None-Match": etag})
+        assert rsp.status_code == 200
+        assert rsp.json()["total"] == total + 1
+    finally:
+        raw_agent_list.pop(probe.uuid, None)
+    assert client.get("/agents", headers={"If-None-Match": etag}).status_code == 304
+
+    # 同一个 key 换实例（大小不变）：下一次全量扫描时发现
+    swapped = copy.copy(demo)
+    swapped.uuid = "api-snapshot-swapped"
+    raw_agent_list["api_demo_agent"] = swapped
+    try:
+        assert client.get("/agents", headers={"If-None-Match": etag}).status_code == 304
+        monkeypatch.setattr(fingerprint, "rescan", 0.0)
+        rsp = client.get("/agents", headers={"If-None-Match": etag})
+        assert rsp.status_code == 200
+        assert rsp.json()["total"] == total + 1
+    finally:
+        raw_agent_list["api_demo_agent"] = demo
+
+
+def test_tool_schema_cache(client):
+    """副本的工具 schema 预编译一次；注册表有写入才重建；请求体拼接预序列化字节"""
+    import tangyuanAI as _da
+    from api.delegation import ASK_MANY_SCHEMA
+    from api.pool import get_agent_pool
+    from api.tool_schemas import CompiledTools, encode_payload
+
+    template = _da.agent_list["api_demo_agent"]
+    with get_agent_pool().lease(template) as clone:
+        first = clone._collect_tools_schema()
+        assert isinstance(first, CompiledTools)
+        assert clone._collect_tools_schema() is first
+        # 挂了 ask_for_help 的 Agent 额外带上 API 层的 ask_many
+        assert list(first) == type(clone)._collect_tools_schema(clone) + [ASK_MANY_SCHEMA]
+
+        @_da.tool_registry.register_tool(name="schema_probe", description="probe", overwrite=True)
+        def schema_probe() -> str:
+            return "ok"
+
+        try:
+            second = clone._collect_tools_schema()
+            assert second is not first
+            assert "schema_probe" in second.names
+        finally:
+            _da.tool_registry._tools.pop("schema_probe", None)
+        assert "schema_probe" not in clone._collect_tools_schema().names
+
+    payload = {"model": "m", "messages": [{"role": "user", "content": "你好"}], "tools": first}
+    assert json.loads(encode_payload(payload)) == json.loads(json.dumps(payload))
+
+    rsp = client.get("/agents/api_demo_agent/tools")
+    assert "echo" in rsp.json()["tool_names"]
+
+    client.post("/agents/api_demo_agent/chat", json={"messages": [{"role": "user", "content": "hi"}]})
+    sent = {t["function"]["name"] for t in _OpenAIMockHandler.last_request.get("tools", [])}
+    assert "echo" in sent
+
+
+def test_acl_inverted_index_matches_registry(client):
+    """倒排索引的判定 / 列表与原版 check_permission 逐项一致，注册 / 注销后增量更新"""
+    import tangyuanAI as _da
+    from api.registry import get_registry_watcher
+
+    reg = _da.tool_registry
+    get_registry_watcher()
+    cls = type(reg)
+    demo = _da.agent_list["api_demo_agent"]
+    agents = [demo.uuid, demo.name, "api_claude_agent", "nobody"]
+
+    def probe():
+        return "ok"
+
+    reg.register_tool(name="acl_by_name", allowed_agents="api_demo_agent", overwrite=True)(probe)
+    reg.register_tool(name="acl_shared", allowed_agents=["api_demo_agent", "api_claude_agent"], overwrite=True)(probe)
+    reg.register_tool(name="acl_global", overwrite=True)(probe)
+    try:
+        for agent in agents:
+            for name in list(reg._tools) + ["missing"]:
+                assert reg.check_permission(agent, name) == cls.check_permission(reg, agent, name)
+            assert reg.get_all_tools_schema(agent) == cls.get_all_tools_schema(reg, agent)
+            assert reg.get_all_tools_info(agent) == cls.get_all_tools_info(reg, agent)
+
+        # 覆盖注册：权限随之变化
+        reg.register_tool(name="acl_by_name", allowed_agents="api_claude_agent", overwrite=True)(probe)
+        assert not reg.check_permission(demo.uuid, "acl_by_name")
+        assert reg.check_permission("api_claude_agent", "acl_by_name")
+    finally:
+        for name in ("acl_by_name", "acl_shared", "acl_global"):
+            reg._tools.pop(name, None)
+    assert "acl_global" not in reg.get_all_tools_info("nobody")
+    assert not reg.check_permission("api_claude_agent", "acl_shared")
+
+
+def test_prompt_segments_mark_dirty_incrementally(client):
+    """按段缓存的 system prompt 与全量重建一致；只有受影响的 Agent 被标脏，副本不用 reload 就能看到新工具"""
+    import tangyuanAI as _da
+    from api.pool import get_agent_pool
+    from api.prompts import get_prompt_builder
+
+    reg = _da.tool_registry
+    builder = get_prompt_builder()
+    demo = _da.agent_list["api_demo_agent"]
+    demo.reload()
+    assert builder.system_prompt(demo) == demo.history[0]["content"]
+    assert not builder.is_dirty(demo)
+
+    def probe():
+        return "ok"
+
+    try:
+        reg.register_tool(name="prompt_other", description="other", allowed_agents="api_claude_agent", overwrite=True)(probe)
+        assert not builder.is_dirty(demo)
+
+        reg.register_tool(name="prompt_mine", description="mine", allowed_agents="api_demo_agent", overwrite=True)(probe)
+        assert builder.is_dirty(demo)
+        with get_agent_pool().lease(demo) as clone:
+            assert "- prompt_mine: mine" in clone.history[0]["content"]
+            assert "prompt_other" not in clone.history[0]["content"]
+        assert not builder.is_dirty(demo)
+
+        reg.register_tool(name="prompt_global", description="global", overwrite=True)(probe)
+        assert builder.is_dirty(demo)
+        demo.reload()
+        assert builder.system_prompt(demo) == demo.history[0]["content"]
+    finally:
+        for name in ("prompt_other", "prompt_mine", "prompt_global"):
+            reg._tools.pop(name, None)
+    assert "prompt_global" not in builder.system_prompt(demo)
+
+
+def test_prompt_skills_segment_follows_skill_reload(client, tmp_path):
+    """SKILL.md 改动后 ``reload_skill`` 只发工具表事件，skills 段也要跟着重拼"""
+    import tangyuanAI as _da
+    from api.prompts import get_prompt_builder
+    from tangyuanAI.skill import skill_registry
+
+    builder = get_prompt_builder()
+    demo = _da.agent_list["api_demo_agent"]
+    skill_dir = tmp_path / "prompt_skill"
+    skill_dir.mkdir()
+    skill_md = skill_dir / "SKILL.md"
+    skill_md.write_text("---\nname: prompt_skill\ndescription: 旧描述\n---\nbody\n", encoding="utf-8")
+    try:
+        skill_registry.register_skill(skill_dir)
+        assert "- prompt_skill: 旧描述" in builder.system_prompt(demo)
+
+        skill_md.write_text("---\nname: prompt_skill\ndescription: 新描述\n---\nbody\n", encoding="utf-8")
+        skill_registry.reload_skill("prompt_skill")
+        prompt = builder.system_prompt(demo)
+        assert "- prompt_skill: 新描述" in prompt
+        assert "旧描述" not in prompt
+    finally:
+        skill_registry.unregister_skill("prompt_skill")
+    assert "prompt_skill" not in builder.system_prompt(demo)
+
+
+def test_lazy_template_activation_single_flight(client, monkeypatch):
+    """惰性模式：未激活的模板按元数据列出；并发首次请求只实例化一次"""
+    import tangyuanAI as _da
+    from api.activation import get_template_activator
+    from api.deps import get_agent_or_404
+
+    monkeypatch.setenv("AGENTS_LAZY_ACTIVATION", "1")
+    created = []
+
+    @_da.template_agent("api_lazy_agent", uuid="api-lazy-uuid", description="惰性激活")
+    class LazyAgent(_da.BaseAgent):
+        prompt = "lazy"
+        api_provider = "http://127.0.0.1:1/v1/chat/completions"
+        enable_connectivity = False
+        fc_model = True
+
+        def __init__(self, *args, **kwargs):
+            created.append(1)
+            time.sleep(0.05)
+            super().__init__(*args, **kwargs)
+
+    try:
+        agents = {a["name"]: a for a in client.get("/agents").json()["agents"]}
+        assert agents["api_lazy_agent"]["active"] is False
+        assert agents["api_lazy_agent"]["uuid"] == "api-lazy-uuid"
+        assert agents["api_demo_agent"]["active"] is True
+        assert not created
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda k=k: results.append(get_agent_or_404(k)))
+            for k in ("api_lazy_agent", "api-lazy-uuid") * 4
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(created) == 1
+        assert len({id(r) for r in results}) == 1
+        assert results[0] is _da.agent_list["api-lazy-uuid"]
+
+        agents = {a["name"]: a for a in client.get("/agents").json()["agents"]}
+        assert agents["api_lazy_agent"]["active"] is True
+        assert not any(name == "api_lazy_agent" for name, _ in get_template_activator().pending())
+    finally:
+        _da.agent_template_pool.pop("api_lazy_agent", None)
+        _da.agent_list.pop("api_lazy_agent", None)
+        _da.agent_list.pop("api-lazy-uuid", None)
+
+
+def test_lazy_activation_runs_off_event_loop(client, monkeypatch):
+    """async 路由里的惰性激活放到线程池：实例化 Agent 时不在 event loop 上"""
+    import asyncio
+
+    import tangyuanAI as _da
+
+    monkeypatch.setenv("AGENTS_LAZY_ACTIVATION", "1")
+    on_loop = []
+
+    @_da.template_agent("api_lazy_route_agent", uuid="api-lazy-route-uuid")
+    class LazyRouteAgent(_da.BaseAgent):
+        prompt = "lazy"
+        api_provider = "http://127.0.0.1:1/v1/chat/completions"
+        enable_connectivity = False
+        fc_model = True
+
+        def __init__(self, *args, **kwargs):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(True)
+            except RuntimeError:
+                on_loop.append(False)
+            super().__init__(*args, **kwargs)
+
+    try:
+        rsp = client.get("/agents/api_lazy_route_agent")
+        assert rsp.status_code == 200
+        assert rsp.json()["uuid"] == "api-lazy-route-uuid"
+        assert on_loop == [False]
+    finally:
+        _da.agent_template_pool.pop("api_lazy_route_agent", None)
+        _da.agent_list.pop("api_lazy_route_agent", None)
+        _da.agent_list.pop("api-lazy-route-uuid", None)
+
+
+def test_provider_health_dedup_and_ttl(client, monkeypatch):
+    """同一 (endpoint, key) 的 Agent 只探测一次；结果按 TTL 缓存；探测失败时 /health 为 degraded"""
+    from api import provider_health
+    from api.provider_health import ProviderHealth, get_provider_health
+
+    class FakeAgent:
+        headers = {}
+
+        def __init__(self, name, endpoint, key):
+            self.name, self.api_provider, self.api_key = name, endpoint, key
+
+        def _ping_endpoint(self):
+            return self.api_provider
+
+        def _ping_payload(self):
+            return {}
+
+    pings = []
+    service = ProviderHealth(ttl=60)
+    monkeypatch.setattr(service, "_ping", lambda agent: (pings.append(agent.name), (True, None))[1])
+
+    agents = [FakeAgent(f"a{i}", "http://p1/v1/chat/completions", "k1") for i in range(3)]
+    agents.append(FakeAgent("b", "http://p1/v1/chat/completions", "k2"))
+    service.sync(agents + agents)
+    deadline = time.time() + 5
+    while time.time() < deadline and any(p.status == "unknown" for p in service.statuses()):
+        time.sleep(0.01)
+
+    statuses = {p.agents[0]: p for p in service.statuses()}
+    assert len(pings) == 2
+    assert statuses["a0"].agents == ["a0", "a1", "a2"] and statuses["a0"].status == "ok"
+    assert statuses["a0"].key != statuses["b"].key and "k1" not in statuses["a0"].key
+    service.subscribe(FakeAgent("a3", "http://p1/v1/chat/completions", "k1"))
+    service.statuses()
+    assert len(pings) == 2
+
+    shared = get_provider_health()
+    down = FakeAgent("down_agent", "http://down.invalid/v1", "k")
+    monkeypatch.setattr(shared, "_ping", lambda agent: (False, "status=503"))
+    key = shared.subscribe(down)
+    try:
+        shared.probe(key)
+        body = client.get("/health").json()
+        assert body["status"] == "degraded"
+        assert any(p["endpoint"] == "http://down.invalid/v1" and p["status"] == "down" for p in body["providers"])
+    finally:
+        shared._providers.pop(key, None)
+    assert client.get("/health").json()["status"] == "ok"
+    assert provider_health.key_fingerprint("") == ""
+
+
+def test_provider_health_probes_through_shared_pool(client, mock_urls):
+    """探测走共享连接池；类上自己打开 enable_connectivity 的 Agent 不再重复订阅"""
+    from api.http_pool import get_http_pool
+    from api.provider_health import ProviderHealth
+
+    class FakeAgent:
+        headers = {"Authorization": "Bearer test-key"}
+        name = "pool_probe"
+        api_provider = mock_urls["openai_url"] + "/v1/chat/completions"
+        api_key = "k"
+
+        def _ping_endpoint(self):
+            return self.api_provider
+
+        def _ping_payload(self):
+            return {"model": "test-model", "messages": [{"role": "user", "content": "ping"}], "max_tokens": 1}
+
+    class SelfProbingAgent(FakeAgent):
+        enable_connectivity = True
+
+    service = ProviderHealth(ttl=60)
+    assert service.key_for(SelfProbingAgent()) is None
+    key = service.key_for(FakeAgent())
+    assert key is not None
+
+    def requests():
+        return sum(o.requests for o in get_http_pool().stats().origins if o.origin in FakeAgent.api_provider)
+
+    before = requests()
+    assert service._ping(FakeAgent()) == (True, None)
+    assert requests() == before + 1
+
+
+def test_anthropic_request_built_by_library(client):
+    """Anthropic 请求由 tangyuanAI 自己构造，只把 transport 换成计量子类、客户端换成共享的"""
+    import tangyuanAI as _da
+    from api.http_pool import get_http_pool
+    from api.pool import get_agent_pool
+    from api.transport import is_metered_transport
+    from tangyuanAI.llm_transport import HttpxAnthropicTransport
+
+    template = _da.agent_list["api_claude_agent"]
+    _, original = type(template)._build_anthropic_request(template)
+    with get_agent_pool().lease(template) as clone:
+        req, transport = clone._build_anthropic_request()
+    assert isinstance(transport, HttpxAnthropicTransport) and is_metered_transport(type(transport))
+    assert transport.agent_name == template.name
+    assert transport.headers == original.headers and transport.max_tokens == original.max_tokens
+    assert transport._client._client is get_http_pool().client_for(transport.endpoint)
+    assert req.model == template.model_name
+
+
+def test_http_pool_reuses_connections_per_origin(client):
+    """同一 origin 共享一个客户端，连续请求复用 keep-alive 连接；计量 transport 用的就是它"""
+    from tangyuanAI.llm_transport import HttpxOpenAITransport
+
+    from api.http_pool import HttpClientPool, get_http_pool
+    from api.transport import metered_transport_cls
+
+    class KeepAliveHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            body = b'{"ok":true}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    url, server = _start_mock_server(KeepAliveHandler)
+    pool = HttpClientPool(max_keepalive=4)
+    try:
+        http = pool.client_for(url + "/v1/chat/completions")
+        assert pool.client_for(url + "/v1/responses") is http
+        for _ in range(3):
+            assert http.post(url + "/v1/chat/completions", json={}).json() == {"ok": True}
+        origin = pool.stats().origins[0]
+        assert origin.requests == 3
+        assert origin.new_connections == 1 and origin.reused == 2
+        assert origin.reuse_ratio == round(2 / 3, 4)
+    finally:
+        pool.close()
+        server.shutdown()
+        server.server_close()
+
+    transport = metered_transport_cls(HttpxOpenAITransport)(endpoint=url + "/v1/chat/completions", api_key="k")
+    assert transport._client._client is get_http_pool().client_for(url)
+    assert "http_pool" in client.get("/health").json()
+
+
+def test_native_async_engine_awaits_async_tools(client, monkeypatch):
+    """原生异步引擎：对话循环和 async 工具都在 event loop 上跑，多个对话并发；事件与同步版一致"""
+    import asyncio
+    import uuid
+
+    import tangyuanAI as _da
+    from api.async_engine import aconversation_with_tool, supports_native_async
+    from api.deps import stream_agent_chat
+    from api.pool import get_agent_pool
+
+    class ToolRoundHandler(BaseHTTPRequestHandler):
+        # 最后一条消息是工具结果时收尾，否则要求调用 async_weather
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if body["messages"][-1]["role"] == "tool":
+                chunks = _make_openai_sse_chunks("查好了")
+            else:
+                call = {"id": uuid.uuid4().hex, "name": "async_weather", "arguments": {"city": "北京"}}
+                chunks = _make_openai_sse_chunks("", [call])
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for chunk in chunks:
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            self.wfile.write(b"data: [DONE]\n\n")
+
+        def log_message(self, *args):
+            pass
+
+    state = {"active": 0, "peak": 0, "threads": set()}
+
+    async def async_weather(city: str) -> str:
+        state["threads"].add(threading.get_ident())
+        state["active"] += 1
+        state["peak"] = max(state["peak"], state["active"])
+        await asyncio.sleep(0.05)
+        state["active"] -= 1
+        return f"{city} 晴"
+
+    url, server = _start_mock_server(ToolRoundHandler)
+    inst = _da.agent_list["api_demo_agent"]
+    monkeypatch.setattr(type(inst), "api_provider", url + "/v1/chat/completions")
+    monkeypatch.setenv("CHAT_ASYNC_ENGINE", "1")
+    _da.tool_registry.register_tool(
+        name="async_weather",
+        description="查天气",
+        parameters={"type": "object", "properties": {"city": {"type": "string"}}, "required": ["city"]},
+        overwrite=True,
+    )(async_weather)
+    pool = get_agent_pool()
+    in_use = pool.stats()["in_use"]
+    assert supports_native_async(inst)
+
+    async def one():
+        with pool.lease(inst) as clone:
+            text = await aconversation_with_tool(clone, messages="北京天气？")
+            return text, [m["content"] for m in clone.history if m.get("role") == "tool"]
+
+    async def main():
+        results = await asyncio.gather(*(one() for _ in range(8)))
+        events = [item async for item in stream_agent_chat(inst, messages="北京天气？")]
+        return threading.get_ident(), results, events
+
+    try:
+        loop_thread, results, events = asyncio.run(main())
+    finally:
+        _da.tool_registry._tools.pop("async_weather", None)
+        server.shutdown()
+        server.server_close()
+
+    for text, tool_messages in results:
+        assert text == "查好了"
+        assert tool_messages[0]["value"] == "北京 晴"
+    assert state["threads"] == {loop_thread}
+    assert state["peak"] > 1
+    assert [e["tool_name"] for e in events if "tool_result" in e] == ["async_weather"]
+    assert "".join(e["message"] for e in events if e.get("message") and not e.get("other")) == "查好了"
+    assert pool.stats()["in_use"] == in_use
+
+
+def test_parallel_tool_calls_keep_order_and_hooks(client, monkeypatch):
+    """一轮的多个工具调用并发执行；parallel_safe=False 的单独跑；钩子逐个触发、结果按原顺序回填"""
+    import uuid
+
+    import tangyuanAI as _da
+    from api.pool import get_agent_pool
+    from api.tool_dispatch import install
+
+    calls = [("slow_lookup", "a"), ("slow_lookup", "b"), ("ledger_write", "c"), ("slow_lookup", "d")]
+
+    class MultiCallHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if body["messages"][-1]["role"] == "tool":
+                chunks = _make_openai_sse_chunks("完成")
+            else:
+                chunks = _make_openai_sse_chunks("", [
+                    {"id": uuid.uuid4().hex, "name": name, "arguments": {"key": key}} for name, key in calls
+                ])
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for chunk in chunks:
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            self.wfile.write(b"data: [DONE]\n\n")
+
+        def log_message(self, *args):
+            pass
+
+    lock = threading.Lock()
+    state = {"active": 0, "peak": 0, "ledger_overlap": False}
+
+    def slow_lookup(key: str) -> str:
+        with lock:
+            state["active"] += 1
+            state["peak"] = max(state["peak"], state["active"])
+        time.sleep(0.2)
+        with lock:
+            state["active"] -= 1
+        return f"value-{key}"
+
+    def ledger_write(key: str) -> str:
+        with lock:
+            state["ledger_overlap"] = state["active"] > 0
+        time.sleep(0.05)
+        with lock:
+            state["ledger_overlap"] = state["ledger_overlap"] or state["active"] > 0
+        return f"written-{key}"
+
+    install()
+    schema = {"type": "object", "properties": {"key": {"type": "string"}}, "required": ["key"]}
+    _da.tool_registry.register_tool(name="slow_lookup", description="慢查询", parameters=schema,
+                                    overwrite=True)(slow_lookup)
+    _da.tool_registry.register_tool(name="ledger_write", description="记账", parameters=schema,
+                                    overwrite=True, parallel_safe=False)(ledger_write)
+    url, server = _start_mock_server(MultiCallHandler)
+    inst = _da.agent_list["api_demo_agent"]
+    monkeypatch.setattr(type(inst), "api_provider", url + "/v1/chat/completions")
+    hooks = []
+
+    def hook(event_type, tool_name, tool_args, tool_result, task_id):
+        hooks.append((event_type, tool_args["key"], task_id))
+
+    try:
+        with get_agent_pool().lease(inst) as clone:
+            clone.register_tool_hook(hook)
+            text = clone.conversation_with_tool("查一下")
+            tool_messages = [m for m in clone.history if m.get("role") == "tool"]
+    finally:
+        _da.tool_registry._tools.pop("slow_lookup", None)
+        _da.tool_registry._tools.pop("ledger_write", None)
+        server.shutdown()
+        server.server_close()
+
+    assert text == "完成"
+    assert [m["content"]["value"] for m in tool_messages] == ["value-a", "value-b", "written-c", "value-d"]
+    assert state["peak"] == 2
+    assert not state["ledger_overlap"]
+    assert [(e, k) for e, k, _ in hooks] == [("before", k) for _, k in calls] + [("after", k) for _, k in calls]
+    before_ids = [t for e, _, t in hooks if e == "before"]
+    assert len(set(before_ids)) == 4
+    assert before_ids == [t for e, _, t in hooks if e == "after"]
+
+
+def test_ask_many_fans_out_concurrently(client, monkeypatch):
+    """ask_many 并发跑多个子对话、按请求顺序返回；调用链跨线程保留，循环 / 深度检查照旧"""
+    import tangyuanAI as _da
+    from api.delegation import current_call_chain
+    from api.pool import get_agent_pool
+
+    lock = threading.Lock()
+    state = {"active": 0, "peak": 0}
+
+    class SlowAnthropicHandler(_AnthropicMockHandler):
+        def do_POST(self):
+            with lock:
+                state["active"] += 1
+                state["peak"] = max(state["peak"], state["active"])
+            time.sleep(0.2)
+            with lock:
+                state["active"] -= 1
+            super().do_POST()
+
+    url, server = _start_mock_server(SlowAnthropicHandler)
+    target = _da.agent_list["api_claude_agent"]
+    monkeypatch.setattr(type(target), "api_provider", url)
+    requests = [{"agent_id": "api_claude_agent", "message": f"第{i}题"} for i in range(3)]
+    try:
+        with get_agent_pool().lease(_da.agent_list["api_demo_agent"]) as clone:
+            assert "ask_many" in clone._collect_tools_schema().names
+            result, async_id = clone._dispatch_tool("ask_many", {"requests": requests})
+
+            reset = current_call_chain.set((target.uuid,))
+            try:
+                cycle = clone.ask_for_help("api_claude_agent", "再问一次")
+            finally:
+                current_call_chain.reset(reset)
+            monkeypatch.setenv("ASK_FOR_HELP_MAX_DEPTH", "1")
+            reset = current_call_chain.set(("other",))
+            try:
+                too_deep = clone.ask_for_help("api_claude_agent", "再问一次")
+            finally:
+                current_call_chain.reset(reset)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert async_id is None
+    replies = json.loads(result)
+    assert [r["agent_id"] for r in replies] == ["api_claude_agent"] * 3
+    assert all("hello from anthropic mock" in r["reply"] for r in replies)
+    assert state["peak"] == 3
+    assert "循环调用被拒绝" in cycle
+    assert "最大调用深度 1" in too_deep
+
+
+def test_tool_result_cache_single_flight(client):
+    """cache= 的工具：并发相同调用只执行一次，之后命中缓存；按条数淘汰；覆盖注册后失效；计数进 /health"""
+    import tangyuanAI as _da
+    from api.pool import get_agent_pool
+    from api.tool_dispatch import execute_tool_calls, install
+    from api.tool_memo import get_tool_memo
+
+    executed = []
+
+    def fx_rate(pair: str) -> dict:
+        executed.append(pair.upper())
+        time.sleep(0.1)
+        return {"pair": pair.upper(), "rate": 7.1}
+
+    install()
+    schema = {"type": "object", "properties": {"pair": {"type": "string"}}, "required": ["pair"]}
+    register = _da.tool_registry.register_tool
+    register(name="fx_rate", description="汇率", parameters=schema, overwrite=True,
+             cache={"ttl": 60, "max_entries": 2, "key": lambda args: args["pair"].upper()})(fx_rate)
+
+    def round_of(*pairs):
+        calls = [
+            {"id": f"call-{time.monotonic_ns()}-{i}", "type": "function",
+             "function": {"name": "fx_rate", "arguments": json.dumps({"pair": p})}}
+            for i, p in enumerate(pairs)
+        ]
+        history = []
+        execute_tool_calls(clone, history, calls)
+        return [m["content"]["value"] for m in history if m.get("role") == "tool"]
+
+    def tool_stats():
+        return next(t for t in get_tool_memo().stats().tools if t.tool == "fx_rate")
+
+    try:
+        with get_agent_pool().lease(_da.agent_list["api_demo_agent"]) as clone:
+            assert round_of("usd/cny", "USD/CNY", "usd/cny") == [{"pair": "USD/CNY", "rate": 7.1}] * 3
+            assert executed == ["USD/CNY"]
+            stats = tool_stats()
+            assert (stats.misses, stats.coalesced, stats.hits) == (1, 2, 0)
+
+            round_of("usd/cny")
+            assert executed == ["USD/CNY"] and tool_stats().hits == 1
+
+            round_of("eur/cny", "jpy/cny")  # 每个工具最多 2 条：最久没用的 usd/cny 被淘汰
+            assert tool_stats().evicted == 1 and tool_stats().entries == 2
+            round_of("usd/cny")
+            assert executed.count("USD/CNY") == 2
+
+            register(name="fx_rate", description="汇率", parameters=schema, overwrite=True, cache=60)(fx_rate)
+            assert tool_stats().entries == 0
+            round_of("usd/cny")
+            assert executed.count("USD/CNY") == 3
+    finally:
+        _da.tool_registry._tools.pop("fx_rate", None)
+
+    health = client.get("/health").json()["tool_cache"]
+    assert any(t["tool"] == "fx_rate" and t["hits"] == 1 for t in health["tools"])
+
+
+def test_tool_timeout_and_process_executor(client):
+    """timeout= 超时按工具错误返回、同一轮其他调用照常；executor="process" 在工具进程池里执行"""
+    import os
+
+    import tangyuanAI as _da
+    from api.pool import get_agent_pool
+    from api.tool_dispatch import execute_tool_calls, install
+    from api.tool_exec import shutdown_process_pool
+
+    def hang() -> str:
+        time.sleep(1)
+        return "late"
+
+    install()
+    register = _da.tool_registry.register_tool
+    register(name="hang", description="卡住", overwrite=True, timeout=0.2)(hang)
+    register(name="worker_pid", description="进程号", overwrite=True, executor="process", timeout=30)(os.getpid)
+    with pytest.raises(ValueError):
+        register(name="bad_proc", description="闭包", overwrite=True, executor="process")(lambda: 1)
+
+    calls = [
+        {"id": f"call-{i}", "type": "function", "function": {"name": name, "arguments": "{}"}}
+        for i, name in enumerate(["hang", "worker_pid"])
+    ]
+    try:
+        with get_agent_pool().lease(_da.agent_list["api_demo_agent"]) as clone:
+            history = []
+            execute_tool_calls(clone, history, calls)
+            hung, pid = [m["content"] for m in history if m.get("role") == "tool"]
+            assert isinstance(hung, str) and "超过 0.2 秒" in hung
+            assert pid["ok"] and isinstance(pid["value"], int) and pid["value"] != os.getpid()
+    finally:
+        for name in ("hang", "worker_pid", "bad_proc"):
+            _da.tool_registry._tools.pop(name, None)
+        shutdown_process_pool()
+
+
+def test_xml_mode_streaming_parser(client):
+    """XML 标签模式：块边收边解析（任意切分结果一致）；工具拿到的 xml 仍是原始文本，另带预解析的参数"""
+    import tangyuanAI as _da
+    from api.pool import get_agent_pool
+    from api.xml_calls import XmlCallParser
+
+    text = ("<thinking>想想</thinking>先查一下 <lookup><city>北京 &amp; 天津</city><days>3</days></lookup>"
+            "<a>没闭合 <get_time></get_time>")
+    for size in (1, 2, 3, 7, len(text)):
+        parser = XmlCallParser()
+        for i in range(0, len(text), size):
+            parser.feed(text[i:i + size])
+        parser.close()
+        assert [(c.name, c.args) for c in parser.calls] == [
+            ("lookup", {"city": "北京 & 天津", "days": "3"}), ("get_time", {}),
+        ]
+
+    seen = []
+
+    def lookup(xml=None):
+        seen.append(xml)
+        _OpenAIMockHandler.response_text = "查好了"
+        return "晴"
+
+    _da.tool_registry.register_tool(name="lookup", description="查天气", overwrite=True)(lookup)
+    _OpenAIMockHandler.response_text = "<lookup><city>北京</city></lookup>"
+    try:
+        with get_agent_pool().lease(_da.agent_list["api_demo_agent"]) as clone:
+            fc_model, clone.fc_model = clone.fc_model, False
+            try:
+                assert clone.conversation("北京天气") == "查好了"
+            finally:
+                clone.fc_model = fc_model
+            assert {"role": "system", "content": "lookup results: 晴"} in clone.history
+    finally:
+        _OpenAIMockHandler.response_text = "hello from openai mock"
+        _da.tool_registry._tools.pop("lookup", None)
+
+    assert seen == ["<lookup><city>北京</city></lookup>"]
+    assert seen[0].name == "lookup" and seen[0].args == {"city": "北京"}
+
+
+def test_tool_speculation_starts_before_stream_ends(client, monkeypatch):
+    """speculative=True 的工具在流里一收完整就开始执行；流结束后准备调用时直接用投机结果，不重复执行"""
+    import tangyuanAI as _da
+    from api.pool import get_agent_pool
+    from api.tool_dispatch import install
+
+    class SlowStreamHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if body["messages"][-1]["role"] == "tool":
+                chunks = _make_openai_sse_chunks("完成")
+            else:
+                chunks = _make_openai_sse_chunks("", [
+                    {"id": "c1", "name": "probe", "arguments": {"q": "a"}},
+                    {"id": "c2", "name": "probe", "arguments": {"q": "b"}},
+                ])
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for chunk in chunks:
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(0.05)
+            self.wfile.write(b"data: [DONE]\n\n")
+
+        def log_message(self, *args):
+            pass
+
+    lock = threading.Lock()
+    events = []
+
+    def probe(q: str) -> str:
+        with lock:
+            events.append(("run", q))
+        return f"got-{q}"
+
+    def hook(event_type, tool_name, tool_args, tool_result, task_id):
+        with lock:
+            events.append((event_type, tool_args["q"]))
+
+    install()
+    schema = {"type": "object", "properties": {"q": {"type": "string"}}, "required": ["q"]}
+    _da.tool_registry.register_tool(name="probe", description="探针", parameters=schema,
+                                    overwrite=True, speculative=True, parallel_safe=True)(probe)
+    url, server = _start_mock_server(SlowStreamHandler)
+    inst = _da.agent_list["api_demo_agent"]
+    monkeypatch.setattr(type(inst), "api_provider", url + "/v1/chat/completions")
+    try:
+        with get_agent_pool().lease(inst) as clone:
+            clone.register_tool_hook(hook)
+            text = clone.conversation_with_tool("查一下")
+            tool_messages = [m for m in clone.history if m.get("role") == "tool"]
+    finally:
+        _da.tool_registry._tools.pop("probe", None)
+        server.shutdown()
+        server.server_close()
+
+    assert text == "完成"
+    assert [m["content"]["value"] for m in tool_messages] == ["got-a", "got-b"]
+    # 第一个调用在流还没结束（before 钩子之前）就开始执行；两个调用各只执行一次
+    assert events.index(("run", "a")) < events.index(("before", "a"))
+    assert sorted(e for e in events if e[0] == "run") == [("run", "a"), ("run", "b")]
+    samples = {}
+    for line in client.get("/metrics").text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    assert samples['aicompany_tool_speculation_total{tool="probe",result="used"}'] >= 1
+
+
+def test_tool_speculation_requires_explicit_safety_and_respects_cancel():
+    """只投机显式声明 parallel_safe=True / cache 的工具；对话已取消时 start 直接抛出，不启动执行"""
+    import tangyuanAI as _da
+    from tangyuanAI.llm_transport import ToolCall
+    from api.cancellation import CancelToken, ConversationCancelled, current_cancel_token
+    from api.speculation import ToolSpeculator, is_speculative
+    from api.tool_dispatch import install
+
+    runs = []
+
+    def plain(q: str) -> str:
+        runs.append(q)
+        return q
+
+    install()
+    schema = {"type": "object", "properties": {"q": {"type": "string"}}, "required": ["q"]}
+    inst = _da.agent_list["api_demo_agent"]
+    try:
+        _da.tool_registry.register_tool(name="spec_plain", description="默认", parameters=schema,
+                                        overwrite=True, speculative=True)(plain)
+        _da.tool_registry.register_tool(name="spec_safe", description="显式", parameters=schema,
+                                        overwrite=True, speculative=True, parallel_safe=True)(plain)
+        _da.tool_registry.register_tool(name="spec_cached", description="缓存", parameters=schema,
+                                        overwrite=True, speculative=True, cache=60)(plain)
+        assert not is_speculative(inst, "spec_plain")
+        assert is_speculative(inst, "spec_safe")
+        assert is_speculative(inst, "spec_cached")
+
+        token = CancelToken()
+        token.cancel("disconnected")
+        reset = current_cancel_token.set(token)
+        try:
+            with pytest.raises(ConversationCancelled):
+                ToolSpeculator(inst).start(ToolCall(id="c1", name="spec_safe", arguments={"q": "x"}))
+        finally:
+            current_cancel_token.reset(reset)
+    finally:
+        for name in ("spec_plain", "spec_safe", "spec_cached"):
+            _da.tool_registry._tools.pop(name, None)
+    assert runs == []
+
+
+def test_sse_byte_parser_matches_line_parser():
+    """字节级 SSE 解析：任意切块、CRLF、心跳帧下产出的事件与 tangyuanAI 逐行解析一致"""
+    import random
+
+    from tangyuanAI.llm_transport import (
+        _AnthropicSSEState,
+        _OpenAISSEState,
+        _parse_usage_anthropic,
+        _process_anthropic_sse_line,
+        _process_openai_sse_line,
+    )
+
+    from api.sse import AnthropicStream, OpenAIStream, iter_frames
+
+    chunks = _make_openai_sse_chunks("你好，世界", [
+        {"id": "c1", "name": "search", "arguments": {"q": "天气"}},
+        {"id": "c2", "name": "lookup", "arguments": {}},
+    ], include_usage=True)
+    openai_raw = "".join(f"data: {json.dumps(c, ensure_ascii=False)}\r\n\r\n" for c in chunks)
+    openai_raw = (": keep-alive\n\n" + openai_raw + ": keep-alive\n\ndata: [DONE]\n\n").encode()
+    anthropic_raw = "".join(
+        f"event: {ev['type']}\ndata: {json.dumps(ev, ensure_ascii=False)}\n\n"
+        + ('event: ping\ndata: {"type": "ping"}\n\n' if i == 1 else "")
+        for i, ev in enumerate(_make_anthropic_sse_events("多字节文本"))
+    ).encode()
+
+    def by_lines(raw, state, process):
+        events = []
+        for line in raw.decode().splitlines():
+            events.extend(process(line, state))
+        return [(e.type, e.text, e.tool_call, e.stop_reason, e.usage) for e in events]
+
+    def by_bytes(raw, feed, size):
+        events = []
+        for frame in iter_frames([raw[i:i + size] for i in range(0, len(raw), size)]):
+            events.extend(feed(*frame))
+        return [(e.type, e.text, e.tool_call, e.stop_reason, e.usage) for e in events]
+
+    expected_openai = by_lines(openai_raw, _OpenAISSEState(), _process_openai_sse_line)
+    expected_anthropic = by_lines(anthropic_raw, _AnthropicSSEState(_parse_usage_anthropic), _process_anthropic_sse_line)
+    assert [e[2].name for e in expected_openai if e[0] == "tool_call"] == ["search", "lookup"]
+    rng = random.Random(7)
+    for size in [1, 2, 3, 7, len(openai_raw)] + [rng.randint(1, 64) for _ in range(20)]:
+        openai = OpenAIStream()
+        assert by_bytes(openai_raw, lambda _, payload: openai.feed(payload), size) == expected_openai
+        anthropic = AnthropicStream()
+        assert by_bytes(anthropic_raw, anthropic.feed, size) == expected_anthropic
+        assert anthropic.start_usage == {"input_tokens": 5, "output_tokens": 0}
+
+
+def test_llm_record_and_replay(client, monkeypatch, tmp_path):
+    """录制真实（mock）provider 的请求和流式响应；回放时不连 provider，按录制内容和节奏（或零延迟）重放"""
+    import tangyuanAI as _da
+    from api.http_pool import shutdown_http_pool
+    from api.llm_replay import Cassette, get_llm_replay, shutdown_llm_replay
+    from api.pool import get_agent_pool
+
+    path = str(tmp_path / "session.jsonl.gz")
+    inst = _da.agent_list["api_demo_agent"]
+
+    def converse() -> tuple:
+        started = time.perf_counter()
+        with get_agent_pool().lease(inst) as clone:
+            text = clone.conversation("你好")
+        return text, time.perf_counter() - started
+
+    class SlowHandler(_OpenAIMockHandler):
+        response_text = "录下来的回复"
+        chunk_delay = 0.03
+
+    url, server = _start_mock_server(SlowHandler)
+    monkeypatch.setattr(type(inst), "api_provider", url + "/v1/chat/completions")
+    shutdown_http_pool()
+    shutdown_llm_replay()
+    try:
+        monkeypatch.setenv("LLM_RECORD_PATH", path)
+        recorded_text, recorded_elapsed = converse()
+        shutdown_http_pool()
+        shutdown_llm_replay()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    cassette = Cassette.load(path)
+    assert len(cassette.exchanges) == 1
+    exchange = cassette.exchanges[0]
+    assert exchange.url.endswith("/v1/chat/completions") and exchange.status == 200
+    assert b"data: [DONE]" in exchange.body and len(exchange.chunks) > 1
+    assert exchange.chunks[-1][0] >= 0.03 * len("录下来的回复")
+
+    # provider 已经关了：回放只读文件
+    monkeypatch.delenv("LLM_RECORD_PATH")
+    monkeypatch.setenv("LLM_REPLAY_PATH", path)
+    try:
+        for speed, check in (("1", lambda t: t >= exchange.chunks[-1][0]), ("0", lambda t: t < recorded_elapsed / 2)):
+            monkeypatch.setenv("LLM_REPLAY_SPEED", speed)
+            text, elapsed = converse()
+            assert text == recorded_text == "录下来的回复"
+            assert check(elapsed), (speed, elapsed)
+            assert get_llm_replay().replayer.cassette.misses == 0
+            shutdown_http_pool()
+            shutdown_llm_replay()
+    finally:
+        shutdown_http_pool()
+        shutdown_llm_replay()
+
+
 def test_register_tool_runtime(client):
     rsp = client.post(
         "/tools",